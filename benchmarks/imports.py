@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import subprocess
+import argparse
+import datetime
+import socket
+import json
+import glob
+import sys
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+#Scientific and visualisation packages that should only be loaded when a task compute or render something
+HEAVY = ["numpy", "scipy", "nibabel", "dipy", "matplotlib", "vtk", "amico", "jinja2"]
+
+#Modules loaded by toad before any task is implemented
+MODULES = ["core.toad.subjectmanager", "core.toad.tasksmanager", "core.toad.generictask", "core.toad.qa",
+           "lib.util", "lib.mriutil"]
+
+PROBE = '''
+import time
+import sys
+sys.path.append({toadDir!r})
+sys.path.append({tasksDir!r})
+start = time.time()
+__import__({module!r})
+elapsed = time.time() - start
+sys.stdout.write(repr((elapsed, sorted(set(name.split(".")[0] for name in sys.modules if name.split(".")[0] in {heavy!r})))) + "\\n")
+'''
+
+
+def measure(python, toadDir, module, importTime=False):
+    """Import a module into a fresh interpreter
+
+    Args:
+        python: the python interpreter
+        toadDir: the root directory of toad
+        module: the name of the module to import
+        importTime: pass -X importtime to the interpreter, python >= 3.7 only
+
+    Returns:
+        a tuple (seconds, the heavy packages loaded, the -X importtime report or None)
+    """
+    code = PROBE.format(toadDir=toadDir, tasksDir=os.path.join(toadDir, "tasks"), module=module, heavy=HEAVY)
+    command = [python] + (["-X", "importtime"] if importTime else []) + ["-c", code]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=toadDir)
+    output, error = process.communicate()
+    if process.returncode != 0:
+        return None, [], error.strip().splitlines()[-1] if error.strip() else "import failed"
+    elapsed, loaded = eval(output.strip().splitlines()[-1])
+    return elapsed, loaded, error if importTime else None
+
+
+def getSlowestImports(report, limit):
+    """Parse a -X importtime report
+
+    Args:
+        report: the standard error of an interpreter started with -X importtime
+        limit: the number of entries to return
+
+    Returns:
+        a list of (cumulative microseconds, module name), slowest first
+    """
+    entries = []
+    for line in report.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            fields = line[len("import time:"):].split("|")
+            try:
+                entries.append((int(fields[1]), fields[2].rstrip()))
+            except ValueError:
+                pass
+    return sorted(entries, reverse=True)[:limit]
+
+
+def supportImportTime(python):
+    """Look if an interpreter support the -X importtime option
+
+    Args:
+        python: the python interpreter
+
+    Returns:
+        True if -X importtime is available, python >= 3.7
+    """
+    command = [python, "-c", "import sys; print(sys.version_info >= (3, 7))"]
+    return subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].strip() == "True"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the import time of the toad modules into fresh interpreters "
+                                                 "and make sure the scientific packages are loaded lazily")
+    parser.add_argument("-p", "--python", default=sys.executable, help="Interpreter to benchmark")
+    parser.add_argument("-n", "--slowest", type=int, default=5,
+                        help="Number of slowest imports reported by -X importtime, when supported")
+    parser.add_argument("-H", "--history", default=os.path.expanduser("~/.toad/imports.jsonl"),
+                        help="Json lines file where runs are recorded and compared")
+    arguments = parser.parse_args()
+
+    toadDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    modules = MODULES + sorted(os.path.splitext(os.path.basename(filename))[0]
+                               for filename in glob.glob(os.path.join(toadDir, "tasks", "[0-9]*.py")))
+    importTime = supportImportTime(arguments.python)
+
+    previous = {}
+    if arguments.history and os.path.exists(arguments.history):
+        with open(arguments.history, 'r') as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        if runs:
+            previous = runs[-1]['modules']
+
+    results = {}
+    offenders = []
+    for module in modules:
+        elapsed, loaded, report = measure(arguments.python, toadDir, module, importTime)
+        if elapsed is None:
+            print "{:<35}{:>10}   {}".format(module, "failed", report)
+            continue
+        results[module] = elapsed
+        change = ""
+        if previous.get(module):
+            change = "{:>+8.1f} %".format(100.0 * (elapsed - previous[module]) / previous[module])
+        print "{:<35}{:>10.3f} s {}{}".format(module, elapsed, change, "   loads {}".format(", ".join(loaded)) if loaded else "")
+        if loaded:
+            offenders.append(module)
+        if report:
+            for microseconds, name in getSlowestImports(report, arguments.slowest):
+                print "{:<35}{:>10.3f} s   {}".format("", microseconds / 1e6, name.strip())
+
+    if arguments.history:
+        if not os.path.exists(os.path.dirname(arguments.history)):
+            os.makedirs(os.path.dirname(arguments.history))
+        with open(arguments.history, 'a') as f:
+            f.write(json.dumps({'date': datetime.datetime.now().strftime("%Y%m%d %Hh%M"),
+                                'host': socket.gethostname(),
+                                'python': arguments.python,
+                                'modules': results}, sort_keys=True) + "\n")
+
+    if offenders:
+        print "\nModule(s) {} load scientific packages at import time".format(", ".join(offenders))
+        sys.exit(1)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import subprocess
+import argparse
+import tempfile
+import datetime
+import socket
+import struct
+import shutil
+import gzip
+import json
+import time
+import sys
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+#Neuroimaging binaries replaced by a stub that answer instantly. qsub and matlab are stubbed too so
+#toad do not pause to warn the user that they are missing
+STUBS = ["mrinfo", "mrconvert", "mrcalc", "mrmath", "mrtransform", "mrcat", "dwiextract", "dwidenoise",
+         "dwi2tensor", "tensor2metric", "dwi2response", "dwi2fod", "fod2fixel", "fixel2voxel", "5ttgen",
+         "5tt2gmwmi", "tckgen", "tcksift", "tckedit", "tckresample", "tck2connectome", "transformconvert",
+         "transformcalc", "flirt", "fslmaths", "convert_xfm", "eddy", "eddy_openmp", "topup", "applytopup",
+         "bet", "dtifit", "fugue", "fast", "recon-all", "mri_convert", "convert", "qsub", "matlab"]
+
+STUB = '''#!/usr/bin/env python
+# Stub of a neuroimaging binary used by the toad orchestration benchmark
+import os
+import sys
+
+binary = os.path.basename(sys.argv[0])
+arguments = sys.argv[1:]
+with open(os.environ["TOAD_STUB_LOG"], "a") as f:
+    f.write("{} {}\\n".format(binary, " ".join(arguments)))
+
+#versions reported to toad at startup
+if binary == "fast" and not arguments:
+    sys.stderr.write("Part of FSL (build 509)\\n")
+elif binary == "tckgen" and "-version" in arguments:
+    print "== tckgen 3.0_RC3 =="
+elif binary == "convert" and "-version" in arguments:
+    print "Version: ImageMagick 6.9.7-4 Q16 x86_64"
+elif binary == "mrinfo":
+    if "-shells" in arguments:
+        print "0 1000"
+    else:
+        dimensions = "16 x 16 x 16 x 7" if "dwi" in os.path.basename(arguments[0]) else "32 x 32 x 32"
+        print "  Dimensions:        {}".format(dimensions)
+        print "  Voxel size:        2 x 2 x 2 x 1"
+        print "  Data strides:      [ 1 2 3 4 ]"
+else:
+    for argument in arguments:
+        if argument.endswith((".nii.gz", ".nii", ".mif", ".tck", ".mat", ".txt")) and not os.path.exists(argument):
+            open(argument, "a").close()
+'''
+
+
+def writeNifti(filename, shape, voxelSize=2.0):
+    """Write a small gzip compressed NIfTI-1 image filled with zeros
+
+    No numpy or nibabel is required so the benchmark measure toad and not the scientific stack
+
+    Args:
+        filename: the name of the image, should end with .nii.gz
+        shape: a tuple of 3 or 4 dimensions
+        voxelSize: the size of the voxel in millimeters
+
+    """
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pixdim = [1.0] + [voxelSize] * 3 + [1.0] * 4
+    header = struct.pack('<i10s18sihcb8h3fhhhh8ffffhcbffffii80s24shh6f4f4f4f16s4s',
+                         348, '', '', 0, 0, 'r', 0, *(dims + [0.0, 0.0, 0.0, 0, 4, 16, 0] + pixdim +
+                         [352.0, 1.0, 0.0, 0, '\x00', 10, 0.0, 0.0, 0.0, 0.0, 0, 0, 'toad benchmark', '', 0, 1,
+                          0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+                          voxelSize, 0.0, 0.0, 0.0, 0.0, voxelSize, 0.0, 0.0, 0.0, 0.0, voxelSize, 0.0,
+                          '', 'n+1\x00']))
+    size = 1
+    for dimension in shape:
+        size *= dimension
+    with gzip.open(filename, 'wb') as f:
+        f.write(header + '\x00' * 4)
+        f.write('\x00' * (size * 2))
+
+
+def createStubs(directory):
+    """Write the stub binaries into a directory
+
+    Args:
+        directory: the directory that will be prepend to the PATH
+
+    """
+    os.makedirs(directory)
+    for binary in STUBS:
+        filename = os.path.join(directory, binary)
+        with open(filename, 'w') as f:
+            f.write(STUB)
+        os.chmod(filename, 0755)
+
+
+def createSubject(directory):
+    """Create a synthetic toad subject: anatomical, diffusion, gradients and a fake freesurfer structure
+
+    Args:
+        directory: the subject directory
+
+    """
+    os.makedirs(directory)
+    writeNifti(os.path.join(directory, "anat_001.nii.gz"), (32, 32, 32), 1.0)
+    writeNifti(os.path.join(directory, "dwi_001.nii.gz"), (16, 16, 16, 7))
+    with open(os.path.join(directory, "dwi_001.bvals"), 'w') as f:
+        f.write("0 1000 1000 1000 1000 1000 1000\n")
+    with open(os.path.join(directory, "dwi_001.bvecs"), 'w') as f:
+        f.write("0 1 0 0 0.707 0.707 0\n0 0 1 0 0.707 0 0.707\n0 0 0 1 0 0.707 0.707\n")
+
+    freesurfer = os.path.join(directory, "freesurfer")
+    for subdir, images in [("mri", ["T1.mgz", "aparc+aseg.mgz", "rh.ribbon.mgz", "lh.ribbon.mgz", "norm.mgz"]),
+                           ("mri/transforms", ["talairach.m3z"]), ("surf", ["lh.white", "rh.white"]),
+                           ("label", ["lh.cortex.label"]), ("scripts", ["recon-all.done"])]:
+        os.makedirs(os.path.join(freesurfer, subdir))
+        for image in images:
+            open(os.path.join(freesurfer, subdir, image), 'a').close()
+
+
+def createEnvironment(root, stubsDir):
+    """Build the environment of the toad processes
+
+    The stubs come first into the PATH. Empty FSL and FreeSurfer installations are created when none is set
+
+    Args:
+        root: the directory of the benchmark
+        stubsDir: the directory of the stub binaries
+
+    Returns:
+        a dictionary of environment variables
+    """
+    environment = dict(os.environ)
+    environment["TOAD_STUB_LOG"] = os.path.join(root, "stubs.log")
+    environment["PATH"] = "{}{}{}".format(stubsDir, os.pathsep, environment["PATH"])
+    environment.pop("TOADSERVER", None)
+    if "FSLDIR" not in environment:
+        environment["FSLDIR"] = os.path.join(root, "fsl")
+        os.makedirs(environment["FSLDIR"])
+    if "FREESURFER_HOME" not in environment:
+        environment["FREESURFER_HOME"] = os.path.join(root, "freesurfer")
+        os.makedirs(environment["FREESURFER_HOME"])
+        with open(os.path.join(environment["FREESURFER_HOME"], "build-stamp.txt"), 'w') as f:
+            f.write("freesurfer-benchmark-stub\n")
+    return environment
+
+
+def toad(toadDir, environment, log, *arguments):
+    """Execute bin/toad into a separate process, like an user would
+
+    Args:
+        toadDir: the root directory of toad
+        environment: a dictionary of environment variables, see createEnvironment
+        log: the name of the file that receive the output of toad
+        arguments: the command line arguments
+
+    Returns:
+        the exit status of toad
+    """
+    command = [sys.executable, os.path.join(toadDir, "bin", "toad")] + list(arguments)
+    with open(log, 'a') as f:
+        f.write("\n$ {}\n".format(" ".join(command)))
+        f.flush()
+        return subprocess.call(command, env=environment, stdin=open(os.devnull, 'r'), stdout=f, stderr=subprocess.STDOUT)
+
+
+def countStubCalls(filename):
+    """Count how many time each stub have been executed
+
+    Args:
+        filename: the log written by the stubs
+
+    Returns:
+        a dictionary of binary names and number of calls, empty if no stub have been executed
+    """
+    counts = {}
+    if not os.path.exists(filename):
+        return counts
+    with open(filename, 'r') as f:
+        for line in f:
+            binary = line.split(" ", 1)[0].strip()
+            if binary:
+                counts[binary] = counts.get(binary, 0) + 1
+    return counts
+
+
+class Timer(object):
+
+    def __init__(self):
+        """Accumulate the wall time of named phases
+
+        """
+        self.phases = []
+
+
+    def measure(self, name, function, *args):
+        """Execute a function and record it duration
+
+        Args:
+            name: the name of the phase
+            function: a callable
+            args: the arguments of the callable
+
+        Returns:
+            the value returned by the callable
+        """
+        start = time.time()
+        result = function(*args)
+        self.phases.append((name, time.time() - start))
+        print "{:<20}{:>10.3f} s".format(name, self.phases[-1][1])
+        return result
+
+
+def run(arguments):
+    """Generate a synthetic study and measure the orchestration phases of toad
+
+    Every phase execute bin/toad end to end:
+        plan: validation, discovery and planning of every subject, see --plan
+        execute: local execution of the pipeline against the stubs. The stubs write empty images, the
+                 first task that read their content fail, use --stopBeforeTask to bound the execution
+        replan: planning of the study once executed, every task fingerprint is verified
+
+    Args:
+        arguments: the command line arguments
+
+    Returns:
+        a dictionary describing the benchmark run
+    """
+    toadDir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    root = tempfile.mkdtemp(prefix="toad_benchmark_")
+    study = os.path.join(root, "study")
+    stubsDir = os.path.join(root, "bin")
+    log = os.path.join(root, "toad.log")
+    planFile = os.path.join(root, "plan.json")
+    timer = Timer()
+
+    try:
+        createStubs(stubsDir)
+        environment = createEnvironment(root, stubsDir)
+        timer.measure("generate", lambda: [createSubject(os.path.join(study, "subject{:03d}".format(index)))
+                                           for index in range(arguments.subjects)])
+
+        status = {}
+        status['plan'] = timer.measure("plan", toad, toadDir, environment, log, "-l", "-p", "--plan", planFile, study)
+        runnable = 0
+        if os.path.exists(planFile):
+            with open(planFile, 'r') as f:
+                runnable = sum(len(plan['runnable']) for plan in json.load(f)['subjects'])
+
+        executeArguments = ["-l", "-p"]
+        if arguments.stopBeforeTask:
+            executeArguments += ["-b", arguments.stopBeforeTask]
+        status['execute'] = timer.measure("execute", toad, toadDir, environment, log, *(executeArguments + [study]))
+        stubCalls = countStubCalls(environment["TOAD_STUB_LOG"])
+        status['replan'] = timer.measure("replan", toad, toadDir, environment, log, "-l", "-p", "--plan", "", study)
+
+        for phase, code in sorted(status.items()):
+            if code != 0:
+                print "toad exited with status {} during {}, see {}".format(code, phase, log)
+
+    finally:
+        if not arguments.keep:
+            shutil.rmtree(root)
+        else:
+            print "Synthetic study kept into {}".format(root)
+
+    return {'date': datetime.datetime.now().strftime("%Y%m%d %Hh%M"),
+            'host': socket.gethostname(),
+            'subjects': arguments.subjects,
+            'phases': dict(timer.phases),
+            'status': status,
+            'calls': {'runnable': runnable, 'stubs': sum(stubCalls.values()), 'binaries': len(stubCalls)}}
+
+
+def report(result, history):
+    """Print the comparison of a run with the previous one recorded into the history file, then record it
+
+    Args:
+        result: a dictionary as return by run
+        history: a json lines filename, None or empty to disable the history
+
+    """
+    print "\n{:<20}{:>10}".format("calls", "")
+    for name, count in sorted(result['calls'].items()):
+        print "{:<20}{:>10}".format(name, count)
+
+    if not history:
+        return
+
+    previous = None
+    if os.path.exists(history):
+        with open(history, 'r') as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+        runs = [run for run in runs if run['subjects'] == result['subjects']]
+        if runs:
+            previous = runs[-1]
+
+    if previous is not None:
+        print "\nCompared to the run of {} on {}".format(previous['date'], previous['host'])
+        for name, duration in sorted(result['phases'].items()):
+            if name in previous['phases'] and previous['phases'][name] > 0:
+                change = 100.0 * (duration - previous['phases'][name]) / previous['phases'][name]
+                print "{:<20}{:>10.3f} s {:>+8.1f} %".format(name, duration, change)
+
+    with open(history, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure toad orchestration overhead on a synthetic study, "
+                                                 "neuroimaging binaries are replaced by stubs")
+    parser.add_argument("-n", "--subjects", type=int, default=10, help="Number of synthetic subjects")
+    parser.add_argument("-b", "--stopBeforeTask", help="Stop the execution of the pipeline before this task")
+    parser.add_argument("-H", "--history", default=os.path.expanduser("~/.toad/benchmarks.jsonl"),
+                        help="Json lines file where runs are recorded and compared")
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the synthetic study")
+    arguments = parser.parse_args()
+
+    if arguments.history and os.path.dirname(arguments.history) and not os.path.exists(os.path.dirname(arguments.history)):
+        os.makedirs(os.path.dirname(arguments.history))
+    report(run(arguments), arguments.history)
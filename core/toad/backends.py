@@ -0,0 +1,874 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import socket
+import signal
+import errno
+import pipes
+import json
+import glob
+import time
+import re
+import os
+
+from logger import Logger
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+#states of a unit of work recorded into a JobStore
+ACTIVE_STATES = ["pending", "running"]
+FAILED_STATES = ["failed", "lost"]
+
+
+class JobStore(object):
+
+    def __init__(self, logDir):
+        """Record the jobs submitted for a subject and follow their state
+
+        The store is a json file into the log directory of the subject. A unit of work is either
+        a task executed alone (--perTaskJobs) or the whole pipeline of the subject. Each job write
+        it exit status into the jobs subdirectory of the log directory once toad returns, so the state
+        of a unit is known whatever the backend that executed it.
+
+        Args:
+            logDir: the log directory of the subject
+
+        """
+        self.__logDir = logDir
+        self.__filename = os.path.join(logDir, "jobs.json")
+
+
+    def getFilename(self):
+        """Return the filename of the store
+
+        Returns:
+            the filename of the store
+        """
+        return self.__filename
+
+
+    def getExitFile(self, unit):
+        """Return the file where the job of a unit write it exit status
+
+        Args:
+            unit: the name of the unit, a task name or pipeline
+
+        Returns:
+            a filename
+        """
+        return os.path.join(self.__logDir, "jobs", "{}.exit".format(unit))
+
+
+    def load(self):
+        """Read the records of the store
+
+        Returns:
+            a dictionary of unit names and records, empty if the store do not exists or is corrupted
+        """
+        if not os.path.isfile(self.__filename):
+            return {}
+        try:
+            with open(self.__filename, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def save(self, records):
+        """Write the records of the store
+
+        The file is written under a temporary name then renamed, so a crash never leave a truncated store
+
+        Args:
+            records: a dictionary of unit names and records
+        """
+        temporary = "{}.tmp".format(self.__filename)
+        with open(temporary, 'w') as f:
+            json.dump(records, f, indent=2, sort_keys=True)
+        os.rename(temporary, self.__filename)
+
+
+    def record(self, unit, backend, jobId, holds, resources):
+        """Record the submission of a unit
+
+        Args:
+            unit: the name of the unit
+            backend: the name of the backend the unit was submitted to
+            jobId: the identifier of the job, None if the submission failed
+            holds: the identifiers of the jobs this job wait for
+            resources: a tuple (slots, walltime, memory)
+
+        """
+        exitFile = self.getExitFile(unit)
+        if not os.path.exists(os.path.dirname(exitFile)):
+            os.makedirs(os.path.dirname(exitFile))
+        if os.path.exists(exitFile):
+            os.remove(exitFile)
+
+        records = self.load()
+        records[unit] = {'backend': backend,
+                         'job': jobId,
+                         'holds': list(holds),
+                         'resources': list(resources),
+                         'submitted': time.time(),
+                         'state': "pending" if jobId is not None else "failed",
+                         'finished': None,
+                         'exit': None}
+        self.save(records)
+
+
+    def refresh(self, backends):
+        """Update the state of the active units
+
+        A unit whose exit status have been written is completed or failed. Otherwise the backend is asked
+        for the state of the job, a job that the backend do not know anymore is lost.
+
+        Args:
+            backends: a dictionary of backend names and Backend instances
+
+        Returns:
+            a dictionary of unit names and records
+        """
+        records = self.load()
+        active = dict((unit, record) for unit, record in records.items() if record['state'] in ACTIVE_STATES)
+        if not active:
+            return records
+
+        states = {}
+        for name in set(record['backend'] for record in active.values()):
+            if name in backends:
+                states[name] = backends[name].poll([record['job'] for record in active.values() if record['backend'] == name])
+
+        for unit, record in active.items():
+            exitFile = self.getExitFile(unit)
+            if os.path.isfile(exitFile):
+                try:
+                    with open(exitFile, 'r') as f:
+                        record['exit'] = int(f.read().strip())
+                except (IOError, ValueError):
+                    record['exit'] = -1
+                record['state'] = "completed" if record['exit'] == 0 else "failed"
+                record['finished'] = os.path.getmtime(exitFile)
+            elif record['backend'] in states:
+                record['state'] = states[record['backend']].get(record['job'], "lost")
+        self.save(records)
+        return records
+
+
+class Backend(Logger):
+
+    def __init__(self, config):
+        """Interface of the execution backends that run the units of work of the pipeline
+
+        Subclasses implement submit, poll and cancel. wait is called once every unit have been submitted.
+
+        Args:
+            config: a configuration structure containing pipeline options
+
+        """
+        self.config = config
+        Logger.__init__(self)
+
+
+    def getName(self):
+        """Return the name of this backend as accepted by the backend option of the general section
+
+        Returns:
+            the name of the backend
+        """
+        raise NotImplementedError
+
+
+    def submit(self, units, holds):
+        """Submit units of work that execute the same task for many subjects
+
+        Args:
+            units: a list of unit dictionaries with the keys subject, name, unit, task, logDir, flags and resources
+            holds: for each unit, the list of the job identifiers that must complete before the unit start
+
+        Returns:
+            for each unit, the identifier of it job or None if the submission failed
+        """
+        raise NotImplementedError
+
+
+    def poll(self, jobIds):
+        """Ask the state of some jobs
+
+        Args:
+            jobIds: a list of job identifiers
+
+        Returns:
+            a dictionary of the job identifiers known by the backend and their state: pending or running
+        """
+        return {}
+
+
+    def cancel(self, jobId):
+        """Cancel a job
+
+        Args:
+            jobId: the identifier of the job
+
+        """
+        raise NotImplementedError
+
+
+    def wait(self):
+        """Called once every units have been submitted, backends that execute the units themselves block here
+
+        """
+        pass
+
+
+    def getScript(self, unit, subject=None):
+        """Return the shell script executed by the job of a unit
+
+        The script launch toad then write it exit status where JobStore expect it
+
+        Args:
+            unit: a unit dictionary
+            subject: a shell expression that evaluate to the subject directory, the subject of the unit if None
+
+        Returns:
+            a shell script
+        """
+        logDirName = os.path.relpath(unit['logDir'], unit['subject'])
+        return ('subject={0}\n'
+                '{1}/bin/toad "$subject" {2}\n'
+                'status=$?\n'
+                'echo $status > "$subject/{3}/jobs/{4}.exit"\n'
+                'exit $status\n').format(subject or pipes.quote(unit['subject']),
+                                                                  self.config.get('arguments', 'toad_dir'),
+                                                                  unit['flags'], logDirName, unit['unit'])
+
+
+    def writeExitStatus(self, unit, logDir, status):
+        """Write the exit status of a unit that will not be executed because a unit it depend on failed
+
+        Args:
+            unit: the name of the unit
+            logDir: the log directory of the subject
+            status: the exit status
+
+        """
+        with open(os.path.join(logDir, "jobs", "{}.exit".format(unit)), 'w') as f:
+            f.write("{}\n".format(status))
+
+
+    def getJobName(self, units):
+        """Return the name of the job of some units
+
+        Args:
+            units: a list of unit dictionaries
+
+        Returns:
+            the subject name for a single unit or toad for an array, followed by the task name if any
+        """
+        prefix = units[0]['name'] if len(units) == 1 else "toad"
+        return prefix if units[0]['task'] is None else "{}_{}".format(prefix, units[0]['task'])
+
+
+    def writeSubjectsList(self, units):
+        """Write the directories of the subjects of an array job, one per line
+
+        Args:
+            units: a list of unit dictionaries
+
+        Returns:
+            the filename of the list, into the jobs directory of the first subject
+        """
+        directory = os.path.join(units[0]['logDir'], "jobs")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        listFile = os.path.join(directory, "{}-{}.subjects".format(self.getJobName(units), time.strftime("%Y%m%d%H%M%S")))
+        with open(listFile, 'w') as f:
+            f.write("\n".join(unit['subject'] for unit in units) + "\n")
+        return listFile
+
+
+    def execute(self, command, script=None):
+        """Launch a submission command line
+
+        Args:
+            command: a list of arguments
+            script: a text sent to the standard input of the command
+
+        Returns:
+            the standard output of the command, None if it failed
+        """
+        self.info("Command launch: {}".format(" ".join(command)))
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as error:
+            self.warning("Cannot launch {}: {}".format(command[0], error))
+            return None
+        output, error = process.communicate(script)
+        if process.returncode != 0:
+            self.warning("{} failed: {}".format(command[0], error.strip()))
+            return None
+        return output
+
+
+class LocalBackend(Backend):
+
+    def __init__(self, config):
+        """Execute the units as toad processes on this machine
+
+        nb_parallel_subjects units are executed concurrently, a unit start once the units it wait for completed
+
+        Args:
+            config: a configuration structure containing pipeline options
+
+        """
+        Backend.__init__(self, config)
+        self.__count = 0
+        self.__queue = []
+        self.__processes = {}
+        self.__returncodes = {}
+
+
+    def getName(self):
+        return "local"
+
+
+    def submit(self, units, holds):
+        jobIds = []
+        for unit, hold in zip(units, holds):
+            self.__count += 1
+            jobId = "local-{}-{}".format(os.getpid(), self.__count)
+            self.__queue.append((jobId, unit, list(hold)))
+            jobIds.append(jobId)
+        return jobIds
+
+
+    def poll(self, jobIds):
+        states = {}
+        for jobId, unit, hold in self.__queue:
+            states[jobId] = "pending"
+        for jobId, process in self.__processes.values():
+            states[jobId] = "running"
+        return dict((jobId, states[jobId]) for jobId in jobIds if jobId in states)
+
+
+    def cancel(self, jobId):
+        self.__queue = [item for item in self.__queue if item[0] != jobId]
+        for pid, (runningId, process) in self.__processes.items():
+            if runningId == jobId:
+                os.killpg(pid, signal.SIGTERM)
+
+
+    def __getNumberOfWorkers(self):
+        """Return the number of units executed concurrently
+
+        Returns:
+            the value of nb_parallel_subjects from the general section, 1 if the value is not valid
+        """
+        if self.config.has_option('general', 'nb_parallel_subjects'):
+            try:
+                return max(1, int(self.config.get('general', 'nb_parallel_subjects')))
+            except ValueError:
+                pass
+        return 1
+
+
+    def wait(self):
+        """Execute the units submitted, block until all of them completed
+
+        """
+        nbWorkers = self.__getNumberOfWorkers()
+        while self.__queue or self.__processes:
+            queued = len(self.__queue)
+            for item in list(self.__queue):
+                if len(self.__processes) >= nbWorkers:
+                    break
+                jobId, unit, hold = item
+                if any(self.__returncodes.get(dependency) not in [None, 0] for dependency in hold):
+                    self.warning("Unit {} of {} will not be executed, a unit it depend on failed".format(unit['unit'], unit['name']))
+                    self.writeExitStatus(unit['unit'], unit['logDir'], 1)
+                    self.__returncodes[jobId] = 1
+                    self.__queue.remove(item)
+                elif all(dependency in self.__returncodes or not self.__isKnown(dependency) for dependency in hold):
+                    self.info("Starting unit {} of {}".format(unit['unit'], unit['name']))
+                    process = subprocess.Popen(self.getScript(unit), shell=True, preexec_fn=os.setpgrp)
+                    self.__processes[process.pid] = (jobId, process)
+                    self.__queue.remove(item)
+
+            if not self.__processes:
+                if len(self.__queue) == queued:
+                    self.warning("Unit(s) {} wait for each other and will not be executed"
+                                 .format(", ".join(item[1]['unit'] for item in self.__queue)))
+                    break
+                continue
+            try:
+                pid, status = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.__processes:
+                jobId, process = self.__processes.pop(pid)
+                self.__returncodes[jobId] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+    def __isKnown(self, jobId):
+        """Look if a job have been submitted to this backend
+
+        Args:
+            jobId: the identifier of a job
+
+        Returns:
+            True if the job is queued, running or completed
+        """
+        return (jobId in self.__returncodes or any(item[0] == jobId for item in self.__queue)
+                or any(runningId == jobId for runningId, process in self.__processes.values()))
+
+
+class GridEngineBackend(Backend):
+
+    def __init__(self, config, torque=False):
+        """Submit the units into a Sun Grid Engine or a Torque server with qsub
+
+        On a Sun Grid Engine, units that execute the same task for many subjects are submitted as an array job
+
+        Args:
+            config: a configuration structure containing pipeline options
+            torque: True for a Torque server
+
+        """
+        Backend.__init__(self, config)
+        self.__torque = torque
+
+
+    def getName(self):
+        return "torque" if self.__torque else "sge"
+
+
+    def __getFlags(self, units, holds):
+        """Return the qsub flags of a job
+
+        Args:
+            units: the units executed by the job
+            holds: the job identifiers the job must wait for
+
+        Returns:
+            a list of qsub arguments
+        """
+        flags = ["-V", "-N", self.getJobName(units), "-o", units[0]['logDir'], "-e", units[0]['logDir'],
+                 "-q", self.config.get('general', 'sge_queue')]
+        if self.config.get('general', 'server') in ['magma', 'stark']:
+            flags.append("-notify")
+
+        slots, walltime, memory = units[0]['resources']
+        if units[0]['task'] is None and self.config.get('general', 'server') in ['mammouth']:
+            walltime = "48:00:00"
+        if self.__torque:
+            if units[0]['task'] is not None:
+                flags.extend(["-l", "nodes=1:ppn={}".format(slots)])
+            if walltime:
+                flags.extend(["-l", "walltime={}".format(walltime)])
+            if memory:
+                flags.extend(["-l", "mem={}".format(memory)])
+            if holds:
+                flags.extend(["-W", "depend=afterok:{}".format(":".join(holds))])
+        else:
+            if slots > 1:
+                flags.extend(["-pe", self.config.get('general', 'sge_parallel_environment'), str(slots)])
+            if walltime:
+                flags.extend(["-l", "h_rt={}".format(walltime)])
+            if memory:
+                flags.extend(["-l", "h_vmem={}".format(memory)])
+            if holds:
+                flags.extend(["-hold_jid_ad" if len(units) > 1 else "-hold_jid", ",".join(holds)])
+        return flags
+
+
+    def __qsub(self, units, holds, subject=None):
+        """Submit a job
+
+        Args:
+            units: the units executed by the job, more than one for an array job
+            holds: the job identifiers the job must wait for
+            subject: a shell expression that evaluate to the subject directory of an array element
+
+        Returns:
+            the identifier of the job, None if the submission failed
+        """
+        flags = self.__getFlags(units, holds)
+        if len(units) > 1:
+            flags.extend(["-t", "1-{}".format(len(units))])
+        output = self.execute(["qsub"] + flags, self.getScript(units[0], subject))
+        if output is None:
+            return None
+        if self.__torque:
+            return output.strip().split()[0] if output.strip() else None
+        #Your job 1234 ("name") has been submitted, or Your job-array 1234.1-10:1 ("name") has been submitted
+        match = re.search(r"job(?:-array)? (\d+)", output)
+        return match.group(1) if match else None
+
+
+    def submit(self, units, holds):
+        if len(units) > 1 and not self.__torque:
+            #element i of the array wait for element i of the arrays it depend on
+            listFile = self.writeSubjectsList(units)
+            jobId = self.__qsub(units, sorted(set(sum(holds, []))), '"$(sed -n "${{SGE_TASK_ID}}p" {})"'.format(listFile))
+            return [jobId] * len(units)
+        return [self.__qsub([unit], hold) for unit, hold in zip(units, holds)]
+
+
+    def poll(self, jobIds):
+        output = self.execute(["qstat"])
+        if output is None:
+            return {}
+        states = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) < 5 or not fields[0][0].isdigit():
+                continue
+            if self.__torque:
+                jobId, state = fields[0], fields[4]
+                states[jobId] = "running" if state == "R" else "pending" if state in ["Q", "H", "W", "T"] else None
+            else:
+                jobId, state = fields[0], fields[4]
+                states[jobId] = "running" if "r" in state or "t" in state else None if "E" in state else "pending"
+        return dict((jobId, states[jobId]) for jobId in jobIds if states.get(jobId) is not None)
+
+
+    def cancel(self, jobId):
+        self.execute(["qdel", jobId])
+
+
+class SlurmBackend(Backend):
+
+    def __init__(self, config):
+        """Submit the units into a SLURM cluster with sbatch
+
+        Units that execute the same task for many subjects are submitted as an array job
+
+        Args:
+            config: a configuration structure containing pipeline options
+
+        """
+        Backend.__init__(self, config)
+
+
+    def getName(self):
+        return "slurm"
+
+
+    def submit(self, units, holds):
+        slots, walltime, memory = units[0]['resources']
+        flags = ["--parsable", "-J", self.getJobName(units), "--cpus-per-task", str(slots)]
+        if self.config.has_option('general', 'slurm_partition'):
+            flags.extend(["-p", self.config.get('general', 'slurm_partition')])
+        if walltime:
+            flags.extend(["--time", walltime])
+        if memory:
+            flags.extend(["--mem", memory])
+
+        if len(units) > 1:
+            #element i of the array wait for element i of the arrays it depend on
+            listFile = self.writeSubjectsList(units)
+            hold = sorted(set(sum(holds, [])))
+            arrayFlags = ["--array", "1-{}".format(len(units)), "-o", os.path.join(units[0]['logDir'], "%x.%A_%a.out")]
+            if hold:
+                arrayFlags.extend(["--dependency", "aftercorr:{}".format(":".join(hold))])
+            script = self.getScript(units[0], '"$(sed -n "${{SLURM_ARRAY_TASK_ID}}p" {})"'.format(listFile))
+            return [self.__sbatch(flags + arrayFlags, script)] * len(units)
+
+        jobIds = []
+        for unit, hold in zip(units, holds):
+            unitFlags = ["-o", os.path.join(unit['logDir'], "%x.%j.out")]
+            if hold:
+                unitFlags.extend(["--dependency", "afterok:{}".format(":".join(hold))])
+            jobIds.append(self.__sbatch(flags + unitFlags, self.getScript(unit)))
+        return jobIds
+
+
+    def __sbatch(self, flags, script):
+        """Submit a job
+
+        Args:
+            flags: a list of sbatch arguments
+            script: the script of the job
+
+        Returns:
+            the identifier of the job, None if the submission failed
+        """
+        output = self.execute(["sbatch"] + flags, "#!/bin/sh\n{}".format(script))
+        if output is None or not output.strip():
+            return None
+        return output.strip().split(";")[0]
+
+
+    def poll(self, jobIds):
+        output = self.execute(["squeue", "-h", "-o", "%i %T"])
+        if output is None:
+            return {}
+        states = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                #array elements are reported as jobid_index
+                jobId = fields[0].split("_")[0]
+                state = "running" if fields[1] in ["RUNNING", "COMPLETING"] else "pending"
+                if states.get(jobId) != "running":
+                    states[jobId] = state
+        return dict((jobId, states[jobId]) for jobId in jobIds if jobId in states)
+
+
+    def cancel(self, jobId):
+        self.execute(["scancel", jobId])
+
+
+class FileQueueBackend(Backend):
+
+    def __init__(self, config):
+        """Queue the units as json files into a directory shared with the workers started by: toad queue
+
+        A unit move from pending to running, then to done or failed. A worker claim a unit by renaming
+        it file, so many workers, on many hosts sharing the directory, may serve the same queue.
+        This backend do not need any cluster and is suitable for tests.
+
+        Args:
+            config: a configuration structure containing pipeline options
+
+        """
+        Backend.__init__(self, config)
+        directory = "~/.toad/queue"
+        if config.has_option('general', 'file_queue'):
+            directory = config.get('general', 'file_queue')
+        self.__directory = os.path.expanduser(os.path.expandvars(directory))
+        self.__count = 0
+        for state in ["pending", "running", "done", "failed"]:
+            if not os.path.exists(os.path.join(self.__directory, state)):
+                os.makedirs(os.path.join(self.__directory, state))
+
+
+    def getName(self):
+        return "filequeue"
+
+
+    def getDirectory(self):
+        """Return the directory of the queue
+
+        Returns:
+            the directory of the queue
+        """
+        return self.__directory
+
+
+    def __getFilename(self, state, jobId):
+        return os.path.join(self.__directory, state, "{}.json".format(jobId))
+
+
+    def __write(self, filename, content):
+        """Write a json file under a temporary name then rename it, so workers never read a truncated file
+
+        """
+        temporary = os.path.join(self.__directory, ".{}.tmp".format(os.path.basename(filename)))
+        with open(temporary, 'w') as f:
+            json.dump(content, f, indent=2, sort_keys=True)
+        os.rename(temporary, filename)
+
+
+    def __read(self, filename):
+        try:
+            with open(filename, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+    def submit(self, units, holds):
+        jobIds = []
+        for unit, hold in zip(units, holds):
+            self.__count += 1
+            jobId = "{}-{}-{}-{:05d}".format(time.strftime("%Y%m%d%H%M%S"), socket.gethostname(), os.getpid(), self.__count)
+            self.__write(self.__getFilename("pending", jobId),
+                         {'id': jobId, 'name': self.getJobName([unit]), 'unit': unit['unit'], 'logDir': unit['logDir'],
+                          'script': self.getScript(unit), 'holds': list(hold), 'submitted': time.time()})
+            jobIds.append(jobId)
+        return jobIds
+
+
+    def getState(self, jobId):
+        """Return the state of a job from the directory that contain it
+
+        Args:
+            jobId: the identifier of a job
+
+        Returns:
+            pending, running, completed, failed or None if the job is unknown
+        """
+        for state, name in [("pending", "pending"), ("running", "running"), ("done", "completed"), ("failed", "failed")]:
+            if os.path.exists(self.__getFilename(state, jobId)):
+                return name
+        return None
+
+
+    def poll(self, jobIds):
+        states = {}
+        for jobId in jobIds:
+            state = self.getState(jobId)
+            if state in ACTIVE_STATES:
+                states[jobId] = state
+        return states
+
+
+    def cancel(self, jobId):
+        try:
+            os.remove(self.__getFilename("pending", jobId))
+        except OSError:
+            job = self.__read(self.__getFilename("running", jobId))
+            if job is not None and job.get('host') == socket.gethostname():
+                os.killpg(job['pid'], signal.SIGTERM)
+
+
+    def work(self, wait=False, interval=10):
+        """Execute the units of the queue one after another
+
+        A unit whose holds failed is moved to failed without being executed
+
+        Args:
+            wait: keep waiting for new units once the queue is empty
+            interval: number of seconds between two looks into the queue when nothing could be executed
+
+        Returns:
+            the number of units executed
+        """
+        executed = 0
+        while True:
+            pending = sorted(glob.glob(os.path.join(self.__directory, "pending", "*.json")))
+            claimed = None
+            for filename in pending:
+                job = self.__read(filename)
+                if job is None:
+                    continue
+                states = [self.getState(hold) for hold in job['holds']]
+                if "failed" in states:
+                    self.warning("Job {} will not be executed, a job it depend on failed".format(job['name']))
+                    self.writeExitStatus(job['unit'], job['logDir'], 1)
+                    os.rename(filename, self.__getFilename("failed", job['id']))
+                    continue
+                if any(state in ACTIVE_STATES for state in states):
+                    continue
+                try:
+                    os.rename(filename, self.__getFilename("running", job['id']))
+                except OSError:
+                    #claimed by an other worker
+                    continue
+                claimed = job
+                break
+
+            if claimed is None:
+                if wait or pending:
+                    time.sleep(interval)
+                    continue
+                return executed
+
+            self.info("Executing job {}".format(claimed['name']))
+            process = subprocess.Popen(claimed['script'], shell=True, preexec_fn=os.setpgrp)
+            claimed.update({'host': socket.gethostname(), 'pid': process.pid, 'started': time.time()})
+            self.__write(self.__getFilename("running", claimed['id']), claimed)
+            process.wait()
+            claimed.update({'returncode': process.returncode, 'finished': time.time()})
+            self.__write(self.__getFilename("done" if process.returncode == 0 else "failed", claimed['id']), claimed)
+            os.remove(self.__getFilename("running", claimed['id']))
+            executed += 1
+
+
+def getBackendNames():
+    """Return the names of the backends accepted by the backend option of the general section
+
+    Returns:
+        a list of names
+    """
+    return ["local", "sge", "torque", "slurm", "filequeue"]
+
+
+def getBackend(config, name=None):
+    """Instanciate an execution backend
+
+    Args:
+        config: a configuration structure containing pipeline options
+        name: the name of the backend, the backend option of the general section if None.
+              auto select torque on mammouth and sge elsewhere
+
+    Returns:
+        a Backend
+    """
+    if name is None:
+        name = config.get('general', 'backend') if config.has_option('general', 'backend') else "auto"
+    if name == "auto":
+        name = "torque" if config.get('general', 'server') in ['mammouth'] else "sge"
+
+    if name == "local":
+        return LocalBackend(config)
+    elif name in ["sge", "torque"]:
+        return GridEngineBackend(config, name == "torque")
+    elif name == "slurm":
+        return SlurmBackend(config)
+    elif name == "filequeue":
+        return FileQueueBackend(config)
+    raise ValueError("Unknown backend {}, valid values are auto, {}".format(name, ", ".join(getBackendNames())))
+
+
+def findStores(directories, logDirName):
+    """Find the job stores of every subject of some study directories
+
+    Args:
+        directories: a list of study or subject directories
+        logDirName: the name of the log directory of a subject, see the dir section of the config file
+
+    Returns:
+        a list of JobStore
+    """
+    filenames = []
+    for directory in directories:
+        for pattern in ["{}/{}/jobs.json", "{}/*/{}/jobs.json"]:
+            filenames.extend(glob.glob(pattern.format(os.path.abspath(directory), logDirName)))
+    return [JobStore(os.path.dirname(filename)) for filename in sorted(set(filenames))]
+
+
+def summarize(stores, config):
+    """Refresh the job stores and summarize the progress of a study
+
+    Args:
+        stores: a list of JobStore
+        config: a configuration structure containing pipeline options
+
+    Returns:
+        a dictionary with the keys:
+            subjects: (subject, units by state dictionary) for each store
+            states: the number of units by state
+            throughput: completed units per hour since the first submission, None if nothing completed
+    """
+    backends = {}
+    summary = {'subjects': [], 'states': {}, 'throughput': None}
+    first, completed = None, 0
+    for store in stores:
+        records = store.load()
+        for name in set(record['backend'] for record in records.values()):
+            if name not in backends:
+                try:
+                    backends[name] = getBackend(config, name)
+                except ValueError:
+                    pass
+        records = store.refresh(backends)
+
+        states = {}
+        for unit, record in records.items():
+            states[record['state']] = states.get(record['state'], 0) + 1
+            summary['states'][record['state']] = summary['states'].get(record['state'], 0) + 1
+            first = record['submitted'] if first is None else min(first, record['submitted'])
+            if record['state'] == "completed":
+                completed += 1
+        subject = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(store.getFilename()))))
+        summary['subjects'].append((subject, states))
+
+    if completed and first is not None:
+        summary['throughput'] = completed / max((time.time() - first) / 3600.0, 1.0 / 60)
+    return summary
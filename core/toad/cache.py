@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import shutil
+import fcntl
+import errno
+import stat
+import json
+import time
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#ioctl request used by linux to share the extents of a file on copy on write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class ResultCache(object):
+
+    def __init__(self, directory, maxSize=None, materialize="reflink"):
+        """Content addressed store of tasks outputs shared across subjects and studies
+
+        The store contains two directories:
+            objects: every file produced by a task, named by the md5 of it content
+            entries: one json document per task execution, keyed on the task name, the content
+                     of it inputs, the options of it config section and the softwares versions
+
+        Args:
+            directory: the root directory of the store
+            maxSize: the maximum size of the store in gigabytes, None for no limit
+            materialize: how objects are copied into a working directory: reflink, hardlink or copy.
+                         reflink fallback to a regular copy when the filesystem do not support it
+
+        """
+        self.__directory = directory
+        self.__objectsDir = os.path.join(directory, "objects")
+        self.__entriesDir = os.path.join(directory, "entries")
+        self.__maxSize = maxSize
+        self.__materialize = materialize
+        for path in [self.__objectsDir, self.__entriesDir]:
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError as error:
+                    if error.errno != errno.EEXIST:
+                        raise
+
+
+    def getDirectory(self):
+        """Return the root directory of the store
+
+        Returns:
+            the root directory of the store
+        """
+        return self.__directory
+
+
+    def computeKey(self, taskName, fingerprint):
+        """Compute the key of a task execution
+
+        Only the content of the inputs is taken into account, so the same scans processed into two
+        different subjects or studies share the same key
+
+        Args:
+            taskName: the name of the task
+            fingerprint: a fingerprint dictionary computed in content mode, see Manifest
+
+        Returns:
+            a hexadecimal key, None if some inputs have not been hashed
+        """
+        digests = []
+        for name, record in fingerprint['inputs'].items():
+            if record.get('md5') is None:
+                return None
+            digests.append(record['md5'])
+        if not digests:
+            return None
+
+        document = json.dumps({'task': taskName,
+                               'inputs': sorted(digests),
+                               'settings': fingerprint['settings'],
+                               'versions': fingerprint['versions']}, sort_keys=True)
+        return hashlib.sha1(document).hexdigest()
+
+
+    def fetch(self, key, target):
+        """Materialize the outputs recorded under a key into a directory
+
+        Args:
+            key: a key as return by computeKey
+            target: the working directory of the task
+
+        Returns:
+            True if the key have been found and materialize, False otherwise
+        """
+        entry = self.__loadEntry(key)
+        if entry is None:
+            return False
+
+        for name, digest in entry['files'].items():
+            if not os.path.isfile(self.__getObjectName(digest)):
+                return False
+
+        for name, digest in entry['files'].items():
+            destination = os.path.join(target, name)
+            if not os.path.exists(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            self.__materializeObject(self.__getObjectName(digest), destination)
+
+        for name, link in entry['links'].items():
+            destination = os.path.join(target, name)
+            if not os.path.exists(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            if not os.path.lexists(destination):
+                os.symlink(link, destination)
+
+        #access time of the entry drive the eviction policy
+        os.utime(self.__getEntryName(key), None)
+        return True
+
+
+    def store(self, key, source, taskName, excludes=None):
+        """Record every file of a working directory under a key
+
+        Symbolic links, to files or to directories, are recorded relative to the link location. They must
+        point into the subject directory, the parent of the working directory, so they could be restored
+        into the working directory of an other subject.
+
+        Args:
+            key: a key as return by computeKey
+            source: the working directory of the task
+            taskName: the name of the task
+            excludes: a list of filenames that should not be recorded
+
+        Returns:
+            the size in bytes of the recorded outputs, None if the outputs cannot be recorded because
+            some links point outside of the subject directory
+        """
+        excludes = excludes or []
+        subjectDir = os.path.dirname(os.path.abspath(source))
+        files = {}
+        links = {}
+        size = 0
+        for root, directories, filenames in os.walk(source):
+            #links to directories are listed into directories and are not followed by os.walk
+            for filename in filenames + directories:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, source)
+                if name in excludes:
+                    continue
+                if os.path.islink(path):
+                    link = self.__relativeLink(path, subjectDir)
+                    if link is None:
+                        return None
+                    links[name] = link
+                elif filename in filenames:
+                    digest = self.__storeObject(path)
+                    files[name] = digest
+                    size += os.path.getsize(path)
+
+        entry = {'task': taskName, 'files': files, 'links': links, 'size': size, 'created': time.time()}
+        temporary = "{}.{}.tmp".format(self.__getEntryName(key), os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+        os.rename(temporary, self.__getEntryName(key))
+
+        if self.__maxSize is not None:
+            self.evict(self.__maxSize)
+        return size
+
+
+    def discard(self, key, target):
+        """Remove from a working directory the outputs materialized from an entry
+
+        Args:
+            key: a key as return by computeKey
+            target: the working directory of the task
+
+        """
+        entry = self.__loadEntry(key)
+        if entry is None:
+            return
+        for name in entry['files'].keys() + entry['links'].keys():
+            destination = os.path.join(target, name)
+            if os.path.lexists(destination):
+                os.remove(destination)
+
+
+    def getEntries(self):
+        """Return every entries of the store, least recently used first
+
+        Returns:
+            a list of (key, entry, last access time) tuples
+        """
+        entries = []
+        for filename in os.listdir(self.__entriesDir):
+            if filename.endswith(".json"):
+                key = filename[:-len(".json")]
+                entry = self.__loadEntry(key)
+                if entry is not None:
+                    entries.append((key, entry, os.path.getmtime(self.__getEntryName(key))))
+        return sorted(entries, key=lambda item: item[2])
+
+
+    def getSize(self):
+        """Return the size of the objects of the store
+
+        Returns:
+            the size in bytes
+        """
+        size = 0
+        for root, directories, filenames in os.walk(self.__objectsDir):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(root, filename))
+        return size
+
+
+    def evict(self, maxSize):
+        """Remove the least recently used entries until the store fit into maxSize
+
+        Args:
+            maxSize: the maximum size of the store in gigabytes
+
+        Returns:
+            the list of the keys removed
+        """
+        removed = []
+        limit = maxSize * 1024 ** 3
+        entries = self.getEntries()
+        while entries and self.getSize() > limit:
+            key, entry, accessed = entries.pop(0)
+            os.remove(self.__getEntryName(key))
+            removed.append(key)
+            self.collect()
+        return removed
+
+
+    def clear(self):
+        """Remove every entries and objects from the store
+
+        """
+        for key, entry, accessed in self.getEntries():
+            os.remove(self.__getEntryName(key))
+        self.collect()
+
+
+    def collect(self):
+        """Remove the objects that are not referenced by any entry
+
+        Returns:
+            the number of objects removed
+        """
+        referenced = set()
+        for key, entry, accessed in self.getEntries():
+            referenced.update(entry['files'].values())
+
+        count = 0
+        for root, directories, filenames in os.walk(self.__objectsDir):
+            for filename in filenames:
+                if filename not in referenced:
+                    os.remove(os.path.join(root, filename))
+                    count += 1
+        return count
+
+
+    def __relativeLink(self, path, subjectDir):
+        """Return the target of a symbolic link relative to the link location
+
+        Args:
+            path: the name of the link
+            subjectDir: the directory the link must point into
+
+        Returns:
+            a relative path, None if the link point outside of subjectDir
+        """
+        destination = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+        if not destination.startswith(subjectDir + os.sep):
+            return None
+        return os.path.relpath(destination, os.path.dirname(path))
+
+
+    def __getEntryName(self, key):
+        return os.path.join(self.__entriesDir, "{}.json".format(key))
+
+
+    def __getObjectName(self, digest):
+        return os.path.join(self.__objectsDir, digest[:2], digest)
+
+
+    def __loadEntry(self, key):
+        """Read an entry of the store
+
+        Args:
+            key: a key as return by computeKey
+
+        Returns:
+            the entry dictionary, None if the entry do not exists or is corrupted
+        """
+        try:
+            with open(self.__getEntryName(key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+    def __storeObject(self, source):
+        """Copy a file into the objects directory
+
+        Objects are read only so a materialized hardlink could not be modified in place by mistake
+
+        Args:
+            source: a filename
+
+        Returns:
+            the md5 of the file content
+        """
+        md5 = hashlib.md5()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+        digest = md5.hexdigest()
+
+        target = self.__getObjectName(digest)
+        if not os.path.exists(target):
+            if not os.path.exists(os.path.dirname(target)):
+                try:
+                    os.makedirs(os.path.dirname(target))
+                except OSError as error:
+                    if error.errno != errno.EEXIST:
+                        raise
+            temporary = "{}.{}.tmp".format(target, os.getpid())
+            self.__materializeObject(source, temporary)
+            os.chmod(temporary, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(temporary, target)
+        return digest
+
+
+    def __materializeObject(self, source, target):
+        """Copy a file using the materialize policy of the store
+
+        Args:
+            source: the source filename
+            target: the target filename
+
+        """
+        if os.path.lexists(target):
+            os.remove(target)
+
+        if self.__materialize == "hardlink":
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass
+
+        elif self.__materialize == "reflink":
+            with open(source, 'rb') as s:
+                with open(target, 'wb') as t:
+                    try:
+                        fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+                        return
+                    except IOError:
+                        pass
+            os.remove(target)
+
+        shutil.copyfile(source, target)
+        os.chmod(target, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
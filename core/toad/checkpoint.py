@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import os
+
+from core.toad.manifest import Manifest
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class Checkpoint(Manifest):
+
+    def __init__(self, filename, mode="content"):
+        """Record the steps of a task that have been completed into it working directory
+
+        Each step is recorded with the records of it input files, the size and modification time
+        of it output files and the value it returned. A step is consider completed as long as
+        it inputs did not change and it outputs are still there.
+
+        Args:
+            filename: the name of the checkpoint file, usually into the task working directory
+            mode: how inputs are hashed, see Manifest
+
+        """
+        Manifest.__init__(self, filename, mode)
+
+
+    def getSteps(self):
+        """Return the steps recorded into the checkpoint file
+
+        Returns:
+            a list of step dictionaries, in order of completion
+        """
+        content = self.load()
+        return content.get('steps', []) if content else []
+
+
+    def getSettings(self):
+        """Return the settings of the task when the implementation that recorded the steps started
+
+        Returns:
+            a dictionary, None if no steps have been recorded
+        """
+        content = self.load()
+        return content.get('settings') if content else None
+
+
+    def isCompleted(self, name, inputs, outputs):
+        """Look if a step have been completed with the same inputs and if all it outputs are unchanged
+
+        Args:
+            name: the name of the step
+            inputs: a list of input filenames
+            outputs: a list of output filenames
+
+        Returns:
+            the recorded step dictionary if completed, None otherwise
+        """
+        for step in self.getSteps():
+            if step['name'] != name:
+                continue
+            if sorted(step['outputs'].keys()) != sorted(self.__relative(output) for output in outputs):
+                return None
+            for output in outputs:
+                if not os.path.isfile(output) or self.__stat(output) != step['outputs'][self.__relative(output)]:
+                    return None
+            if self.__digests(self.__hashInputs(inputs, step['inputs'])) != self.__digests(step['inputs']):
+                return None
+            return step
+        return None
+
+
+    def recordStep(self, name, inputs, outputs, result, settings):
+        """Add a completed step to the checkpoint file
+
+        A step already recorded under the same name is replaced, with every step recorded after it
+
+        Args:
+            name: the name of the step
+            inputs: a list of input filenames
+            outputs: a list of output filenames
+            result: the value returned by the step, must be json serializable
+            settings: a dictionary that identify the configuration of the task
+
+        """
+        steps = []
+        for step in self.getSteps():
+            if step['name'] == name:
+                break
+            steps.append(step)
+        steps.append({'name': name,
+                      'inputs': self.__hashInputs(inputs),
+                      'outputs': dict((self.__relative(output), self.__stat(output))
+                                      for output in outputs if os.path.isfile(output)),
+                      'result': result})
+        self.save({'settings': settings, 'steps': steps})
+
+
+    def discard(self, outputs=False):
+        """Remove the checkpoint file
+
+        Args:
+            outputs: remove the outputs of the recorded steps too, so they are not mistaken for the outputs
+                     of the next execution
+
+        """
+        if outputs:
+            root = os.path.dirname(os.path.dirname(os.path.abspath(self.getFilename())))
+            for step in self.getSteps():
+                for output in step['outputs'].keys():
+                    filename = os.path.join(root, output)
+                    if os.path.isfile(filename):
+                        os.remove(filename)
+        if self.exists():
+            os.remove(self.getFilename())
+
+
+    def __relative(self, source):
+        """Return a filename relative to the subject directory so a study could be moved
+
+        Args:
+            source: a filename
+
+        Returns:
+            a relative filename
+        """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(self.getFilename())))
+        return os.path.relpath(os.path.abspath(source), root)
+
+
+    def __stat(self, source):
+        """Return the size and modification time of a file
+
+        Args:
+            source: a filename
+
+        Returns:
+            a [size, mtime] list
+        """
+        stat = os.stat(source)
+        return [stat.st_size, int(stat.st_mtime)]
+
+
+    def __hashInputs(self, inputs, previous=None):
+        """Compute the records of the input files of a step
+
+        Args:
+            inputs: a list of filenames
+            previous: the records of a previous execution of the step, reused when a file did not change
+
+        Returns:
+            a dictionary of relative filenames and records
+        """
+        records = {}
+        for source in sorted(set(inputs)):
+            if source and os.path.isfile(source):
+                name = self.__relative(source)
+                records[name] = self.hashFile(os.path.abspath(source), (previous or {}).get(name))
+        return records
+
+
+    def __digests(self, records):
+        """Return the part of the records that identify the content of the files
+
+        Args:
+            records: a dictionary of relative filenames and records
+
+        Returns:
+            a dictionary of relative filenames and md5, or size and mtime when files are not hashed
+        """
+        return dict((name, record['md5'] if record.get('md5') else (record['size'], record['mtime']))
+                    for name, record in records.items())
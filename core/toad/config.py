@@ -51,6 +51,26 @@ class Config(object):
         else:
             config.set('arguments', 'local', 'False')
 
+        if arguments.plan is not None:
+            config.set('arguments', 'plan', 'True')
+            if isinstance(arguments.plan, basestring) and arguments.plan:
+                config.set('arguments', 'plan_file', os.path.abspath(arguments.plan))
+        else:
+            config.set('arguments', 'plan', 'False')
+
+        if arguments.perTaskJobs:
+            config.set('arguments', 'per_task_jobs', 'True')
+        else:
+            config.set('arguments', 'per_task_jobs', 'False')
+
+        if arguments.resubmitFailed:
+            config.set('arguments', 'resubmit_failed', 'True')
+        else:
+            config.set('arguments', 'resubmit_failed', 'False')
+
+        if arguments.onlyTask and isinstance(arguments.onlyTask, basestring):
+            config.set('arguments', 'only_task', arguments.onlyTask.lower())
+
         if arguments.reinitialize:
             config.set('arguments', 'reinitialize', 'True')
         else:
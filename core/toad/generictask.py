@@ -4,14 +4,23 @@ from datetime import datetime
 import glob
 import subprocess
 import traceback
+import tempfile
+import sqlite3
 import shutil
+import time
+import sys
 import os
 
 from lib.images import Images
 from core.toad.logger import Logger
+from core.toad.manifest import Manifest
+from core.toad.checkpoint import Checkpoint
+from core.toad.cache import ResultCache
+from core.toad.scratch import Scratch
+from core.toad.timing import Timing
 from core.toad.qa import Qa
 from load import Load
-from lib import util
+from lib import util, pgzip
 
 
 __author__ = "Mathieu Desrosiers"
@@ -38,6 +47,11 @@ class GenericTask(Logger, Load, Qa):
         self.__name = self.__class__.__name__.lower()
         self.__moduleName = self.__class__.__module__.split(".")[-1]
         self.__cleanupBeforeImplement = True
+        self.__resuming = False
+        #options of the task section written by the task itself during implementation, see set
+        self.__runtimeOptions = set()
+        #settings of the task when the implementation started, recorded with the completed steps
+        self.__stepSettings = None
         self.config = subject.getConfig()
         self.subject = subject
         self.subjectDir = self.subject.getDir()
@@ -46,7 +60,11 @@ class GenericTask(Logger, Load, Qa):
         self.logDir = os.path.join(self.subjectDir, self.get('dir', 'log'))
         self.qaDir = os.path.join(self.subjectDir, '00-qa')
         self.tasksAsReferences = None
-        Logger.__init__(self, subject.getLogDir())
+        self.__timing = Timing(self.logDir, subject.getName())
+        #while the runnable tasks are planned, nothing is written into the task log file
+        Logger.__init__(self, None if self.__isArgumentSet('planning') else subject.getLogDir(),
+                        self.config.has_option('general', 'log_json') and self.config.getboolean('general', 'log_json'))
+        self.setLogContext(subject=subject.getName(), task=self.getName())
         Load.__init__(self, self.config)
         Qa.__init__(self)
         self.dependencies = []
@@ -245,12 +263,58 @@ class GenericTask(Logger, Load, Qa):
             os.mkdir(self.workingDir)
 
         os.chdir(self.workingDir)
+        self.__resuming = True
+        #options written by the task while it run must not change the settings the steps are recorded with
+        self.__stepSettings = {'settings': dict(self.getFingerprintSettings()), 'versions': self.__getSoftwareVersions()}
         util.symlink(self.getLogFileName(), self.workingDir)
         if "qaSupplier" in dir(self):
             self.updateQaMenu()
 
+        #every command launched by this task, including those from lib, is recorded into the timing database
+        previousObserver = util.setCommandObserver(self.__recordCommand)
+        #images compressed in process by this task use it share of the node
+        pgzip.setDefaultThreads(self.getNTreadsGzip())
+        #fsl ignore the extension of the filenames it receive and write the images in FSLOUTPUTTYPE format
+        previousOutputType = os.environ.get('FSLOUTPUTTYPE')
+        if util.getImageExtension(self.config) == ".nii":
+            os.environ['FSLOUTPUTTYPE'] = "NIFTI"
+        try:
+            self.__implementOrRestore()
+        finally:
+            util.setCommandObserver(previousObserver)
+            if previousOutputType is None:
+                os.environ.pop('FSLOUTPUTTYPE', None)
+            else:
+                os.environ['FSLOUTPUTTYPE'] = previousOutputType
+        os.chdir(self.subjectDir)
+
 
-        self.implement()
+    def __implementOrRestore(self):
+        """Restore the outputs of this task from the result cache or call implement, then supply the qa report
+
+        """
+        cache, key = self.__getResultCache()
+        restored = cache is not None and cache.fetch(key, self.workingDir)
+        if restored:
+            util.invalidateImageIndex(self.workingDir)
+            self.info("Outputs of task {} restored from cache {}, entry {}".format(self.getName(), cache.getDirectory(), key))
+            if self.__isIncomplete():
+                self.warning("Outputs of task {} restored from cache entry {} are incomplete, implementing the task"
+                             .format(self.getName(), key))
+                cache.discard(key, self.workingDir)
+                util.invalidateImageIndex(self.workingDir)
+                restored = False
+
+        if not restored:
+            self.__implementIntoScratch()
+            #the outputs of this task must be found by the following image lookups
+            util.invalidateImageIndex(self.workingDir)
+            if cache is not None and not self.__isIncomplete():
+                self.info("Recording outputs of task {} into cache {}, entry {}".format(self.getName(), cache.getDirectory(), key))
+                excludes = ["{}.manifest".format(self.__moduleName), os.path.basename(self.getLogFileName())]
+                if cache.store(key, self.workingDir, self.getName(), excludes) is None:
+                    self.info("Task {} link files outside of the subject directory, it outputs are not cached".format(self.getName()))
+        self.__recordFingerprint()
 
         # Save ConfigRunning File
         configRunningPath = os.path.join(
@@ -263,7 +327,123 @@ class GenericTask(Logger, Load, Qa):
         else:
             self.info("task {} does not implement qaSupplier method".format(self.getName()))
 
-        os.chdir(self.subjectDir)
+
+    def __isIncomplete(self):
+        """Look if some outputs of this task are missing
+
+        Returns:
+            True if the task is dirty, False otherwise
+        """
+        result = self.isDirty()
+        return result.isSomeImagesMissing() if isinstance(result, Images) else result
+
+
+    def __isScratchEnable(self):
+        """Look if this task should be executed into a node local scratch directory
+
+        The scratch option of the general section enable the staging, the scratch option of the task own section overwrite it
+
+        Returns:
+            a Boolean
+        """
+        for section in [self.getName(), 'general']:
+            if self.config.has_option(section, 'scratch'):
+                return self.config.getboolean(section, 'scratch')
+        return False
+
+
+    def __implementIntoScratch(self):
+        """Call implement into a node local scratch directory when staging is enable
+
+        The working directory is copied into the scratch, the inputs declared into meetRequirement are
+        copied into the images of the dependencies directories and the other files of those directories
+        are symlinked. The working directory and the dependencies directories attributes point into the
+        scratch during the implementation, then the outputs are synchronized back into the subject.
+
+        """
+        if not self.__isScratchEnable():
+            self.implement()
+            return
+
+        root = os.path.expandvars(self.config.get('general', 'scratch_dir'))
+        if not os.path.isdir(root):
+            root = tempfile.gettempdir()
+        try:
+            nbThreads = int(self.config.get('general', 'scratch_threads'))
+        except ValueError:
+            nbThreads = 4
+
+        scratch = Scratch(root, self.subject.getName(), nbThreads)
+        workingDir = self.workingDir
+        dependenciesDirNames = dict(self.__dependenciesDirNames)
+        inputs = self.getFingerprintInputs()
+        self.info("Staging task {} into scratch directory {}".format(self.getName(), scratch.getDirectory()))
+        failure = None
+        try:
+            for name, directory in dependenciesDirNames.items():
+                self.__dependenciesDirNames[name] = scratch.stage(directory, inputs)
+                setattr(self, name, self.__dependenciesDirNames[name])
+            self.workingDir = scratch.stage(workingDir)
+            os.chdir(self.workingDir)
+            self.implement()
+        except BaseException:
+            failure = sys.exc_info()
+
+        self.workingDir = workingDir
+        for name, directory in dependenciesDirNames.items():
+            self.__dependenciesDirNames[name] = directory
+            setattr(self, name, directory)
+        os.chdir(self.workingDir)
+
+        #outputs of a failed implementation are synchronized too, the completed steps are resumed on the next attempt.
+        #a failed synchronization leave the scratch in place so the outputs could be recovered
+        try:
+            transfered = scratch.sync(workingDir)
+        except Exception as error:
+            if failure is None:
+                raise
+            self.warning("Cannot synchronize scratch directory {} into {}, the scratch is left in place: {}"
+                         .format(scratch.getDirectory(), workingDir, error))
+        else:
+            self.info("{} files synchronized from scratch directory {} into {}"
+                      .format(len(transfered), scratch.getDirectory(), workingDir))
+            scratch.remove()
+
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+
+    def __recordCommand(self, result):
+        """Log and record into the timing database the resources consumed by a command
+
+        Args:
+            result: a dictionary as return by util.executeCommand
+
+        """
+        binary = result['command'].strip().split(" ")[0]
+        self.info("Command {} completed in {:.1f} seconds, cpu {:.1f} seconds, peak memory {:.1f} MB, exit status {}"
+                  .format(binary, result['wall'], result['user'] + result['system'],
+                          result['maxrss'] / 1024.0, result['returncode']),
+                  command=binary, duration=result['wall'], cpu=result['user'] + result['system'],
+                  maxrss=result['maxrss'], returncode=result['returncode'])
+        try:
+            self.__timing.recordCommand(self.getName(), result)
+        except sqlite3.Error as error:
+            self.warning("Cannot record command into {}: {}".format(self.__timing.getFilename(), error))
+
+
+    def __recordTask(self, start, success):
+        """Record into the timing database the wall time of this task
+
+        Args:
+            start: the time the task started, in seconds since the epoch
+            success: True if the task completed
+
+        """
+        try:
+            self.__timing.recordTask(self.getName(), start, time.time() - start, success)
+        except sqlite3.Error as error:
+            self.warning("Cannot record task into {}: {}".format(self.__timing.getFilename(), error))
 
 
     def implement(self):
@@ -358,10 +538,227 @@ class GenericTask(Logger, Load, Qa):
             else:
                 self.error("Illegal value return by isDirty method for task {}".format(self.getName()))
 
+            if not result:
+                result = self.__isFingerprintChanged()
+
             self.logFooter("isDirty", result)
             return result
 
 
+    def __getManifest(self):
+        """Return the manifest that record the fingerprint of this task
+
+        Returns:
+            a Manifest, None if fingerprint option of the general section is set to none
+        """
+        mode = "content"
+        if self.config.has_option('general', 'fingerprint'):
+            mode = self.config.get('general', 'fingerprint')
+        if mode not in ["content", "stat"]:
+            return None
+        return Manifest(os.path.join(self.workingDir, "{}.manifest".format(self.__moduleName)), mode)
+
+
+    def getFingerprintInputs(self):
+        """Return the list of files this task read during implementation
+
+        By default the images returned by meetRequirement are used.
+        May be overwritten by a subclass that read files not declared into meetRequirement
+
+        Returns:
+            a list of filenames
+        """
+        result = self.meetRequirement()
+        if isinstance(result, Images):
+            return [image for image, description in result if image and os.path.isfile(image)]
+        return []
+
+
+    def getFingerprintSettings(self):
+        """Return the options of the config file that may have an impact on the outputs of this task
+
+        Options that only drive the execution, like ignore, cpu_weight or the grid resources, are excluded.
+        Options written by the task itself during implementation are excluded too, they are derived from the
+        inputs and come back as strings from configRunning.cfg on the next invocation. Values are compared as strings
+
+        Returns:
+            a list of (option, value) tuples
+        """
+        if not self.config.has_section(self.getName()):
+            return []
+        runtimeOptions = self.__getRuntimeOptions()
+        return [(option, str(value)) for option, value in self.config.items(self.getName(), raw=True)
+                if option not in ["ignore", "cpu_weight", "scratch"] and not option.startswith("grid_")
+                and option not in runtimeOptions]
+
+
+    def __getRuntimeOptions(self):
+        """Return the options written by this task during this execution or recorded into it manifest by a previous one
+
+        Returns:
+            a set of option names
+        """
+        recorded = Manifest(os.path.join(self.workingDir, "{}.manifest".format(self.__moduleName))).load()
+        return self.__runtimeOptions | set(recorded.get('runtime', []) if recorded else [])
+
+
+    def __getSoftwareVersions(self):
+        """Return the versions of the softwares used by the current pipeline execution
+
+        Returns:
+            a dictionary of software names and versions
+        """
+        versions = {}
+        if self.config.has_option('arguments', 'software_versions'):
+            for item in self.config.get('arguments', 'software_versions', raw=True).split(";"):
+                if "=" in item:
+                    name, version = item.split("=", 1)
+                    versions[name] = version
+        return versions
+
+
+    def __computeFingerprint(self, manifest):
+        """Compute the current fingerprint of this task
+
+        Args:
+            manifest: the manifest of this task
+
+        Returns:
+            a fingerprint dictionary
+        """
+        return manifest.computeFingerprint(self.getFingerprintInputs(),
+                                           self.getFingerprintSettings(),
+                                           self.__getSoftwareVersions())
+
+
+    def __getCheckpoint(self):
+        """Return the checkpoint that record the completed steps of this task
+
+        Returns:
+            a Checkpoint into the working directory of this task
+        """
+        mode = "content"
+        if self.config.has_option('general', 'fingerprint') and self.config.get('general', 'fingerprint') == "stat":
+            mode = "stat"
+        return Checkpoint(os.path.join(self.workingDir, "{}.checkpoint".format(self.__moduleName)), mode)
+
+
+    def step(self, name, inputs, outputs, function, *args, **kwargs):
+        """Execute a named step of the implementation unless it have been completed by a previous attempt
+
+        A step is skipped if it have been recorded into the checkpoint of this task with the same inputs,
+        the same task settings and if all it outputs are unchanged. Once a step is executed, every
+        following step is executed too.
+
+        Args:
+            name: the name of the step, unique within the task
+            inputs: a list of filenames read by the step
+            outputs: a list of filenames produced by the step
+            function: the callable that implement the step
+            *args, **kwargs: the arguments of the callable
+
+        Returns:
+            the value returned by the callable, or the value recorded when the step completed.
+            the value must be json serializable
+        """
+        checkpoint = self.__getCheckpoint()
+        settings = self.__stepSettings
+        if self.__resuming:
+            recorded = checkpoint.getSettings()
+            if recorded is not None and recorded != settings:
+                self.info("Settings of task {} changed since the last attempt, discarding checkpoint {} and the outputs of it steps"
+                          .format(self.getName(), checkpoint.getFilename()))
+                checkpoint.discard(outputs=True)
+            else:
+                completed = checkpoint.isCompleted(name, inputs, outputs)
+                if completed is not None:
+                    self.info("Step {} of task {} already completed, skipping".format(name, self.getName()))
+                    return completed['result']
+        self.__resuming = False
+
+        self.info("Starting step {} of task {}".format(name, self.getName()))
+        self.setLogContext(step=name)
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            self.setLogContext(step=None)
+        self.info("Step {} of task {} completed".format(name, self.getName()), step=name, duration=time.time() - start)
+        checkpoint.recordStep(name, inputs, outputs, result, settings)
+        return result
+
+
+    def __getResultCache(self):
+        """Return the shared result cache and the key of this task execution
+
+        The cache is enable by the enable option of the cache section. A task is cached only if it declare
+        some inputs into meetRequirement, see getFingerprintInputs, and if the cache option of it own section is not False
+
+        Returns:
+            a (ResultCache, key) tuple, (None, None) if this task should not be cached
+        """
+        if not (self.config.has_option('cache', 'enable') and self.config.getboolean('cache', 'enable')):
+            return None, None
+        if self.config.has_option(self.getName(), 'cache') and not self.config.getboolean(self.getName(), 'cache'):
+            return None, None
+
+        maxSize = None
+        if self.config.has_option('cache', 'max_size'):
+            try:
+                maxSize = float(self.config.get('cache', 'max_size'))
+            except ValueError:
+                self.warning("max_size option of the cache section should be a number of gigabytes")
+
+        cache = ResultCache(os.path.expandvars(self.config.get('cache', 'directory')), maxSize,
+                            self.config.get('cache', 'materialize'))
+        manifest = Manifest(os.path.join(self.workingDir, "{}.manifest".format(self.__moduleName)), "content")
+        key = cache.computeKey(self.getName(), self.__computeFingerprint(manifest))
+        if key is None:
+            self.info("Task {} do not declare any inputs, it outputs will not be cached".format(self.getName()))
+            return None, None
+        return cache, key
+
+
+    def __recordFingerprint(self):
+        """Write the current fingerprint of this task into it manifest
+
+        """
+        manifest = self.__getManifest()
+        if manifest is not None:
+            self.info("Recording fingerprint of task {} into {}".format(self.getName(), manifest.getFilename()))
+            fingerprint = self.__computeFingerprint(manifest)
+            fingerprint['runtime'] = sorted(self.__getRuntimeOptions())
+            manifest.save(fingerprint)
+
+
+    def __isFingerprintChanged(self):
+        """Look if the inputs, the options or the softwares versions changed since the last execution of this task
+
+        If no manifest have been recorded, as for outputs produced by an older version of toad,
+        the current fingerprint is recorded and the task is consider up to date
+
+        Returns:
+            True if the fingerprint changed, False otherwise
+        """
+        manifest = self.__getManifest()
+        if manifest is None:
+            return False
+
+        if not manifest.exists():
+            if self.__isArgumentSet('plan'):
+                self.info("No manifest found for task {}, the current fingerprint will be recorded".format(self.getName()))
+            else:
+                self.info("No manifest found for task {}, recording the current fingerprint".format(self.getName()))
+                manifest.save(self.__computeFingerprint(manifest))
+            return False
+
+        changes = manifest.getChanges(self.__computeFingerprint(manifest))
+        if changes:
+            self.info("Fingerprint of task {} changed: {}".format(self.getName(), ", ".join(changes)))
+            return True
+        return False
+
+
     def isDirty(self, result = False):
         """Validate if this tasks need to be submit for implementation
 
@@ -404,22 +801,60 @@ class GenericTask(Logger, Load, Qa):
             self.info("Cleaning up \"deleting\" {} directory".format(self.workingDir))
             os.chdir(self.subjectDir)
             shutil.rmtree(self.workingDir)
+            util.invalidateImageIndex(self.workingDir)
+
+
+    def __isArgumentSet(self, option):
+        """Look if a boolean option of the arguments section is set
+
+        Args:
+            option: the name of the option
+
+        Returns:
+            True if the option exists and is true, False otherwise
+        """
+        return self.config.has_option('arguments', option) and self.config.getboolean('arguments', option)
+
+
+    def isStopTask(self):
+        """Look if this task is the one set by the user through stop_before_task option
+
+        Returns:
+            True if the pipeline should stop before this task, False otherwise
+        """
+        if self.config.has_option("arguments", "stop_before_task"):
+            stopTaskName = self.config.get("arguments", "stop_before_task")
+            return stopTaskName == self.__name or stopTaskName == self.__moduleName.lower()
+        return False
+
+
+    def getCpuWeight(self):
+        """Return the number of slots this task should hold when tasks are executed concurrently
+
+        The value is read from the cpu_weight option of the task section into config.cfg
+
+        Returns:
+            an integer greater or equal to 1, default is 1
+        """
+        if self.config.has_option(self.getName(), 'cpu_weight'):
+            try:
+                return max(1, int(self.get('cpu_weight')))
+            except ValueError:
+                self.warning("cpu_weight option of task {} is not a valid integer".format(self.getName()))
+        return 1
 
 
     def stopBeforeTask(self):
         """Method to stop the pipeline before the task set by the user through
         stop_before_task option
         """
-        if self.config.has_option("arguments", "stop_before_task"):
+        if self.isStopTask():
             stopTaskName = self.config.get("arguments", "stop_before_task")
-            if (   stopTaskName == self.__name
-                or stopTaskName == self.__moduleName.lower()
-               ):
-                msg = (
-                        "\033[92mReach {} which is the value set by "
-                        "stop_before_task. Stopping the pipeline as user "
-                        "request\033[0m").format(stopTaskName)
-                self.quit(msg)
+            msg = (
+                    "\033[92mReach {} which is the value set by "
+                    "stop_before_task. Stopping the pipeline as user "
+                    "request\033[0m").format(stopTaskName)
+            self.quit(msg)
 
 
     def run(self):
@@ -428,6 +863,9 @@ class GenericTask(Logger, Load, Qa):
         Args:
             tasks: the list of all  qualified task for this pipeline
 
+        Returns:
+            True if the task have been completed, False otherwise
+
         """
         self.stopBeforeTask()
 
@@ -435,6 +873,7 @@ class GenericTask(Logger, Load, Qa):
         attempt = 0
         self.logHeader("implement")
         start = datetime.now()
+        epoch = time.time()
 
         if self.__meetRequirement():
             try:
@@ -443,7 +882,10 @@ class GenericTask(Logger, Load, Qa):
                 nbSubmission = 3
 
             while(attempt < nbSubmission):
-                if self.__cleanupBeforeImplement:
+                if self.__getCheckpoint().exists():
+                    self.info("Checkpoint {} found, resuming task {} at the first incomplete step"
+                              .format(self.__getCheckpoint().getFilename(), self.getName()))
+                elif self.__cleanupBeforeImplement:
                     self.__cleanup()
 
                 try:
@@ -464,9 +906,14 @@ class GenericTask(Logger, Load, Qa):
                     attempt += 1
                 else:
                     finish = datetime.now()
-                    self.info("Time to finish the task = {} seconds".format(str(timedelta(seconds=(finish - start).seconds))))
+                    self.info("Time to finish the task = {} seconds".format(str(timedelta(seconds=(finish - start).seconds))),
+                              duration=time.time() - epoch)
                     self.logFooter("implement")
-                    break
+                    self.__getCheckpoint().discard()
+                    self.__recordTask(epoch, True)
+                    return True
+            self.__recordTask(epoch, False)
+        return False
 
 
     def getName(self):
@@ -520,8 +967,11 @@ class GenericTask(Logger, Load, Qa):
         """
         if len(args) < 3:
             value = self.config.set(self.getName(), args[0], args[1])
+            self.__runtimeOptions.add(self.config.optionxform(args[0]))
         else:
             value = self.config.set(args[0], args[1], args[2])
+            if args[0] == self.getName():
+                self.__runtimeOptions.add(self.config.optionxform(args[1]))
 
         if value in ["True", "true"]:
             return True
@@ -534,6 +984,9 @@ class GenericTask(Logger, Load, Qa):
     def launchCommand(self, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
         """Execute a program in a new process
 
+        The output of the command is streamed into the log of the task while it run,
+        only the last lines are kept in memory
+
         Args:
             command: a string representing a unix command to execute
             stdout: this attribute is a file object that provides output from the child process
@@ -542,7 +995,8 @@ class GenericTask(Logger, Load, Qa):
             nice: run cmd  with  an  adjusted  niceness, which affects process scheduling
 
         Returns
-            return a 3 elements tuples representing the command execute, the standards output and the standard error message
+            a dictionary as return by util.executeCommand: command, returncode, timeout, tail of the output,
+            durations and peak memory
 
         Raises
             OSError:      the function trying to execute a non-existent file.
@@ -556,13 +1010,21 @@ class GenericTask(Logger, Load, Qa):
         self.info("Launch {} command line...".format(binary))
         self.info("Command line submit: {}".format(cmd))
 
-        (executedCmd, output, error)= util.launchCommand(cmd, stdout, stderr, timeout, nice)
-        if not (output is "" or output is "None" or output is None):
-            self.info("Output produce by {}: {} \n".format(binary, output))
-
-        if not (error is '' or error is "None" or error is None):
-            self.info("Error produce by {}: {}\n".format(binary, error))
+        handle = self.openLog()
+        try:
+            result = util.executeCommand(cmd, stdout, stderr, timeout, nice,
+                                         onLine=lambda name, line: self.logOutput(line, handle))
+        finally:
+            if handle is not None:
+                self.closeLog(handle)
+
+        if result['timeout']:
+            self.warning("Command {} killed after a timeout of {} seconds".format(binary, timeout))
+        elif result['returncode'] != 0:
+            self.warning("Command {} exit with status {}, last lines produce:\n{}"
+                         .format(binary, result['returncode'], "".join(result['tail'])))
         self.info("------------------------\n")
+        return result
 
 
     def launchMatlabCommand(self, source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
@@ -577,7 +1039,7 @@ class GenericTask(Logger, Load, Qa):
             timeout: Number of seconds before a process is consider inactive, usefull against deadlock
             nice: run cmd  with  an  adjusted  niceness, which affects process scheduling
         Returns
-            return a 3 elements tuples representing the command execute, the standards output and the standard error message
+            a dictionary as return by launchCommand
 
         """
 
@@ -585,10 +1047,10 @@ class GenericTask(Logger, Load, Qa):
         tags={ 'script': scriptName, 'workingDir': self.workingDir}
         cmd = self.parseTemplate(tags, os.path.join(self.toadDir, "templates", "files", "matlab.tpl"))
         self.info("Launching matlab command: {}".format(cmd))
-        self.launchCommand(cmd, stdout, stderr, timeout, nice)
+        return self.launchCommand(cmd, stdout, stderr, timeout, nice)
 
 
-    def buildName(self, source, postfix, ext=None, absolute = True):
+    def buildName(self, source, postfix, ext=None, absolute = True, publish = False):
         """A simple utility function that return a file name that contain the postfix and the current working directory
 
         The filename is always into the current working  directory
@@ -598,11 +1060,12 @@ class GenericTask(Logger, Load, Qa):
             source: the input file name
             postfix: single element or array of elements which option item specified in config at the postfix section
             ext: the extension of the new target
+            publish: the file is a final output, images are always compressed
 
         Returns:
             a file name that contain the postfix and the current working directory
         """
-        absoluteBuildName = util.buildName(self.config, self.workingDir, source, postfix, ext, absolute)
+        absoluteBuildName = util.buildName(self.config, self.workingDir, source, postfix, ext, absolute, publish)
         return os.path.basename(absoluteBuildName.replace("'",""))
 
 
@@ -623,6 +1086,8 @@ class GenericTask(Logger, Load, Qa):
             shutil.copy(source, self.workingDir)
             target = os.path.join(self.workingDir, os.path.basename(source))
 
+        if not target.endswith(".gz"):
+            return target
         self.info("Uncompress image.".format(target))
         return util.gunzip(target)
 
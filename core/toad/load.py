@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
+import ConfigParser
 import os
 
 __author__ = "Mathieu Desrosiers"
@@ -22,8 +24,9 @@ class Load(object):
         self.__nbThreads = self.__config.get('general', 'nb_threads')
         try:
             self.nbSubjects = int(self.__config.get('general', 'nb_subjects'))
-        except ValueError:
-            self.nbSubjects = 1000
+        except (ValueError, ConfigParser.NoOptionError):
+            #entry points that process a single subject or none, like single task runs or the maintenance commands
+            self.nbSubjects = 1
 
 
     def __getLoad(self):
@@ -35,6 +38,174 @@ class Load(object):
         return os.getloadavg()[0]
 
 
+    def __getCgroupDirectories(self, controller):
+        """Return the directories where the cgroup files of a controller may be found for the current process
+
+        Both cgroup v1 (one hierarchy per controller) and cgroup v2 (unified hierarchy) layouts are supported.
+        Into containers the cgroup of the process is usually mounted as the root of the hierarchy,
+        so the root directory is always returned as a last resort.
+
+        Args:
+            controller: the name of a cgroup v1 controller, like cpu or memory
+
+        Returns:
+            a list of existing directories, most specific first
+        """
+        directories = []
+        try:
+            with open("/proc/self/cgroup", 'r') as f:
+                for line in f:
+                    fields = line.strip().split(":", 2)
+                    if len(fields) != 3:
+                        continue
+                    hierarchy, controllers, path = fields
+                    if hierarchy == "0" and controllers == "":
+                        roots = ["/sys/fs/cgroup"]
+                    elif controller in controllers.split(","):
+                        roots = ["/sys/fs/cgroup/{}".format(controllers), "/sys/fs/cgroup/{}".format(controller)]
+                    else:
+                        continue
+                    for root in roots:
+                        for directory in [os.path.join(root, path.lstrip("/")), root]:
+                            if os.path.isdir(directory) and directory not in directories:
+                                directories.append(directory)
+        except IOError:
+            pass
+        return directories
+
+
+    def __readCgroupValue(self, controller, filenames):
+        """Read the first cgroup file found for a controller
+
+        Args:
+            controller: the name of a cgroup v1 controller, like cpu or memory
+            filenames: candidate filenames into the cgroup directories
+
+        Returns:
+            the content of the file as a list of tokens, None if no file could be read
+        """
+        for directory in self.__getCgroupDirectories(controller):
+            for filename in filenames:
+                try:
+                    with open(os.path.join(directory, filename), 'r') as f:
+                        return f.read().split()
+                except IOError:
+                    pass
+        return None
+
+
+    def __getAffinityCpus(self):
+        """Return the number of cpus the current process is allowed to run on
+
+        Returns:
+            the number of cpus of the affinity mask, the number of cpus of the system if it cannot be determine
+        """
+        try:
+            with open("/proc/self/status", 'r') as f:
+                for line in f:
+                    if line.startswith("Cpus_allowed_list:"):
+                        count = 0
+                        for item in line.split(":", 1)[1].strip().split(","):
+                            if "-" in item:
+                                first, last = item.split("-")
+                                count += int(last) - int(first) + 1
+                            elif item:
+                                count += 1
+                        if count > 0:
+                            return count
+        except (IOError, ValueError):
+            pass
+        return multiprocessing.cpu_count()
+
+
+    def __getCgroupCpus(self):
+        """Return the number of cpus allowed by the cgroup cpu quota of the current process
+
+        Returns:
+            the quota expressed as a number of cpus rounded up, None if no quota is set
+        """
+        #cgroup v2
+        values = self.__readCgroupValue("cpu", ["cpu.max"])
+        if values and len(values) == 2 and values[0] != "max":
+            try:
+                return max(1, -(-int(values[0]) // int(values[1])))
+            except (ValueError, ZeroDivisionError):
+                pass
+
+        #cgroup v1
+        quota = self.__readCgroupValue("cpu", ["cpu.cfs_quota_us"])
+        period = self.__readCgroupValue("cpu", ["cpu.cfs_period_us"])
+        if quota and period:
+            try:
+                if int(quota[0]) > 0:
+                    return max(1, -(-int(quota[0]) // int(period[0])))
+            except (ValueError, ZeroDivisionError):
+                pass
+        return None
+
+
+    def __getSchedulerCpus(self):
+        """Return the number of slots granted by a batch scheduler to the current job
+
+        Returns:
+            the value of NSLOTS (Sun Grid Engine), PBS_NUM_PPN (Torque) or SLURM_CPUS_PER_TASK, None outside a job
+        """
+        for name in ["NSLOTS", "PBS_NUM_PPN", "SLURM_CPUS_PER_TASK"]:
+            try:
+                return max(1, int(os.environ[name]))
+            except (KeyError, ValueError):
+                pass
+        return None
+
+
+    def getUsableCpus(self):
+        """Return the number of cpus this process could use
+
+        The affinity mask, the cgroup quota and the slots granted by a batch scheduler are taken into account
+
+        Returns:
+            the number of usable cpus
+        """
+        cpus = self.__getAffinityCpus()
+        for limit in [self.__getCgroupCpus(), self.__getSchedulerCpus()]:
+            if limit is not None:
+                cpus = min(cpus, limit)
+        return max(1, cpus)
+
+
+    def getAvailableMemory(self):
+        """utility that return the amount of memory available for new processes on the system
+
+        The memory limit of the cgroup of the current process is taken into account
+
+        Returns:
+            the available memory in megabytes, None if it cannot be determine
+        """
+        available = None
+        try:
+            with open("/proc/meminfo", 'r') as f:
+                values = dict(line.split(":", 1) for line in f if ":" in line)
+            if "MemAvailable" in values:
+                available = int(values["MemAvailable"].split()[0]) / 1024
+            else:
+                available = (int(values["MemFree"].split()[0]) + int(values["Cached"].split()[0])) / 1024
+        except (IOError, KeyError, ValueError):
+            pass
+
+        limit = self.__readCgroupValue("memory", ["memory.max", "memory.limit_in_bytes"])
+        usage = self.__readCgroupValue("memory", ["memory.current", "memory.usage_in_bytes"])
+        if limit and limit[0] != "max":
+            try:
+                #cgroup v1 report a huge value when no limit is set
+                remaining = (int(limit[0]) - (int(usage[0]) if usage else 0)) / 1024 ** 2
+                if remaining < 2 ** 40:
+                    available = remaining if available is None else min(available, remaining)
+            except ValueError:
+                pass
+
+        return available
+
+
     def getNTreadsEddy(self):
         """Define the number of thread that should be deploy without stressing the server too much
 
@@ -62,6 +233,18 @@ class Load(object):
         return str(nTreads)
 
 
+    def getNTreadsGzip(self):
+        """Define the number of thread that should be used to compress images, see lib.pgzip
+
+        Returns:
+            the suggested number of threads, as an integer
+        """
+        try:
+            return max(1, int(self.__getNTreads()))
+        except ValueError:
+            return 1
+
+
     def getNTreadsMrtrix(self):
         """Define the number of thread that should be deploy without stressing the server too much
 
@@ -71,52 +254,54 @@ class Load(object):
         return self.__getNTreads()
 
 
+    def __getShare(self):
+        """Return the fraction of the node this process may use
+
+        The node is share between the subjects processed concurrently (nb_subjects) and, when
+        tasks are executed concurrently, between the slots of nb_parallel_tasks according to the cpu weight of the task
+
+        Returns:
+            a float between 0 and 1
+        """
+        share = 1.0 / max(1, self.nbSubjects)
+        if self.__config.has_option('general', 'nb_parallel_tasks'):
+            try:
+                slots = max(1, int(self.__config.get('general', 'nb_parallel_tasks')))
+                weight = self.getCpuWeight() if hasattr(self, 'getCpuWeight') else 1
+                share *= float(min(weight, slots)) / slots
+            except ValueError:
+                pass
+        return share
+
+
     def __getNTreads(self):
         """Define the number of thread that should be deploy without stressing the server too much
 
-            -First compute the number of threads base on the server capacity
+            -First compute the number of threads base on the cpus this process could use
             -Second look if nbThreads have not been overwrite into the config file
             -Third make sure the system is not overworking
-            -Last, if emergency have been call, pray to avoid a crash
+            -Last, if emergency have been call, use every usable cpus
 
         Returns:
             the suggested number of threads that should be deploy
 
         """
+        cpus = self.getUsableCpus()
 
-        serverName = self.__config.get('general', 'server')
-
-        #First compute the number of threads base on the server capacity
-        if 'magma' in serverName:
-            if self.nbSubjects <= 5:
-                value = 4
-            elif self.nbSubjects <= 10:
-                value = 3
-            elif self.nbSubjects <= 15:
-                value = 2
-            else:
-                value = 1
-
-        elif 'stark' in serverName:
-            if self.nbSubjects <= 5:
-                value = 5
-            elif self.nbSubjects <= 10:
-                value = 4
-            elif self.nbSubjects <= 15:
-                value = 3
-            elif self.nbSubjects <= 20:
-                value = 2
-            else:
-                value = 1
-
-        elif 'mammouth' in serverName:
-                value = 24
-        else:
-            value = 1
+        #First compute the number of threads base on the cpus this process could use
+        value = max(1, int(cpus * self.__getShare()))
 
+        if self.__config.has_option('general', 'memory_per_thread'):
+            available = self.getAvailableMemory()
+            try:
+                memoryPerThread = int(self.__config.get('general', 'memory_per_thread'))
+                if available is not None and memoryPerThread > 0:
+                    value = min(value, max(1, available / memoryPerThread))
+            except ValueError:
+                pass
 
         #Second look if nbThreads have not been overwrite into the config file
-        if self.__nbThreads is not "algorithm" or self.__nbThreads is not "unlimited":
+        if self.__nbThreads not in ["algorithm", "unlimited"]:
             try:
                 nbThreads = int(self.__nbThreads)
                 if nbThreads <= value:
@@ -124,32 +309,29 @@ class Load(object):
             except ValueError:
                 pass
 
-
         #Third make sure the system is not overworking
-        if self.isSystemOverloaded(serverName):
-            value = 1
+        if self.isSystemOverloaded():
+            value = max(1, min(value, int(cpus - self.__getLoad() + value)))
 
-        #Last, if emergency have been call, pray to avoid a crash
-        if self.__nbThreads is "unlimited" and self.nbSubjects == 1:
-            value = 100
+        #Last, if emergency have been call, use every usable cpus
+        if self.__nbThreads == "unlimited":
+            value = cpus
 
         return str(value)
 
 
-    def isSystemOverloaded(self, serverName):
+    def isSystemOverloaded(self, serverName=None):
         """ Define a treshold for the load of the server
 
+        The system is consider overload when the load average exceed the number of usable cpus
+
         Args:
-            serverName: the name of the server
+            serverName: obsolete, kept for backward compatibility
 
         Returns:
             A boolean if the system is consider overload or not
         """
-        if serverName == "magma" and self.__getLoad() > 70:
-                return True
-        elif serverName == "stark" and self.__getLoad() > 100:
-                return True
-        return False
+        return self.__getLoad() > self.getUsableCpus()
 
 
     def getNTreads(self):
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
+import threading
+import socket
+import errno
+import json
+import time
 import os
 
 __author__ = "Mathieu Desrosiers"
@@ -8,52 +13,217 @@ __credits__ = ["Mathieu Desrosiers"]
 
 class Lock(object):
 
-    def __init__(self, logDir, name):
+    def __init__(self, logDir, name, heartbeat=60, timeout=600):
         """Simple lock mechanism for the toad pipeline
 
         The purpose of this class is to provide simple mechanism to avoid collusion
         between many concurrent execution of toad pipeline.
 
+        The lock is acquired atomically by linking a unique temporary file to the lock file, which is safe
+        even on NFS. The lock file contains the host and the pid of the owner and a heartbeat refreshed
+        periodically while the lock is held. A lock whose owner died on the same host, or whose heartbeat
+        have not been refreshed since timeout seconds, is stale and reclaimed automatically.
+
         Args:
             log_dir: the directory where the lock file will be store
             name: the name of the subject
+            heartbeat: number of seconds between two refresh of the heartbeat
+            timeout: number of seconds without heartbeat after which a lock is consider stale
 
         """
         self.__name = name
         self.__logDir = logDir
         self.__lockFile = "{}/{}.lock".format(logDir, name)
+        self.__heartbeat = heartbeat
+        self.__timeout = timeout
+        self.__owner = None
+        self.__stopHeartbeat = None
+
+    def __readLock(self, filename=None):
+        """Read the content of a lock file
+
+        Locks created by older version of toad are empty, their modification time is used as heartbeat
+
+        Args:
+            filename: the lock file, the lock of this subject if None
+
+        Returns:
+            a dictionary with host, pid, acquired and heartbeat keys, None if the file do not exists
+        """
+        filename = filename or self.__lockFile
+        try:
+            mtime = os.path.getmtime(filename)
+            with open(filename, 'r') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            owner = json.loads(content)
+            if isinstance(owner, dict) and 'heartbeat' in owner:
+                return owner
+        except ValueError:
+            pass
+        return {'host': None, 'pid': None, 'acquired': mtime, 'heartbeat': mtime}
+
+    def __isStale(self, owner):
+        """Look if the owner of a lock is gone
+
+        Args:
+            owner: the content of a lock file as return by __readLock
+
+        Returns:
+            True if the owner process do not exists anymore on this host or if it heartbeat timed out
+        """
+        if owner['host'] == socket.gethostname() and owner['pid'] is not None:
+            try:
+                os.kill(owner['pid'], 0)
+            except OSError as error:
+                if error.errno == errno.ESRCH:
+                    return True
+        return time.time() - owner['heartbeat'] > self.__timeout
+
+    def __writeTemporary(self, owner):
+        """Write the content of a lock into a file unique to this process
+
+        Args:
+            owner: a dictionary with host, pid, acquired and heartbeat keys
+
+        Returns:
+            the name of the temporary file
+        """
+        temporary = "{}.{}.{}.{}".format(self.__lockFile, owner['host'], owner['pid'], threading.current_thread().ident)
+        with open(temporary, 'w') as f:
+            json.dump(owner, f)
+        return temporary
+
+    def __link(self, temporary):
+        """Atomically create the lock file from a temporary file
+
+        On NFS, link may report a failure even if it succeed, the link count of the temporary file tell the truth
+
+        Args:
+            temporary: the name of the temporary file
+
+        Returns:
+            True if the lock file have been created
+        """
+        try:
+            os.link(temporary, self.__lockFile)
+        except OSError:
+            pass
+        try:
+            return os.stat(temporary).st_nlink == 2
+        finally:
+            os.remove(temporary)
+
+    def __reclaim(self, owner):
+        """Remove a stale lock, unless an other process already replaced it
+
+        The lock file is renamed first so only one process reclaim it. If the renamed lock turn out
+        to be alive, it is put back.
+
+        Args:
+            owner: the content of the stale lock
+
+        """
+        stale = "{}.stale.{}.{}".format(self.__lockFile, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.__lockFile, stale)
+        except OSError:
+            return
+        reclaimed = self.__readLock(stale)
+        if reclaimed is not None and not self.__isStale(reclaimed):
+            try:
+                os.link(stale, self.__lockFile)
+            except OSError:
+                pass
+        os.remove(stale)
 
     def isLock(self):
         """Lock if this subject is currently running into an instance of a toad pipeline
 
+        A stale lock is not consider
+
         Returns:
             a Boolean
 
         """
-        if os.path.exists(self.__lockFile):
-            return True
-        return False
+        owner = self.__readLock()
+        return owner is not None and not self.__isStale(owner)
 
     def lock(self):
         """Create a Lock for the subject that is currently running into this toad pipeline
 
+        A stale lock is reclaimed. Once acquired, a thread refresh the heartbeat of the lock until removeLock
+
         Returns:
-            the lock filename
+            the lock filename, False if the subject is lock by an other process
 
         """
-        if self.isLock():
-            return False
-        open(self.__lockFile, 'a').close()
-        return self.__lockFile
+        for attempt in range(2):
+            now = time.time()
+            owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'acquired': now, 'heartbeat': now}
+            if self.__link(self.__writeTemporary(owner)):
+                self.__owner = owner
+                self.__startHeartbeat()
+                return self.__lockFile
+
+            current = self.__readLock()
+            if current is not None:
+                if not self.__isStale(current):
+                    return False
+                self.__reclaim(current)
+        return False
+
+    def __isOwner(self):
+        """Look if the lock file still belong to this process
+
+        Returns:
+            True if the lock file have been created by this process
+        """
+        current = self.__readLock()
+        return (self.__owner is not None and current is not None and current['host'] == self.__owner['host']
+                and current['pid'] == self.__owner['pid'] and current['acquired'] == self.__owner['acquired'])
+
+    def __startHeartbeat(self):
+        """Start a thread that refresh the heartbeat of the lock periodically
+
+        """
+        self.__stopHeartbeat = threading.Event()
+        thread = threading.Thread(target=self.__beat, args=(self.__stopHeartbeat, self.__owner))
+        thread.daemon = True
+        thread.start()
+
+    def __beat(self, stop, owner):
+        """Refresh the heartbeat of the lock until stop is set or the lock is lost
+
+        Args:
+            stop: a threading Event
+            owner: the content of the lock held by this process
+
+        """
+        while not stop.wait(self.__heartbeat):
+            #processes forked by this one do not own the lock
+            if os.getpid() != owner['pid'] or not self.__isOwner():
+                return
+            owner['heartbeat'] = time.time()
+            temporary = self.__writeTemporary(owner)
+            os.rename(temporary, self.__lockFile)
 
     def removeLock(self):
-        """Remove the subject lock file
+        """Remove the subject lock file if it is held by this process
 
         Returns:
             the status of the operation
 
         """
-        if not self.isLock():
+        if self.__stopHeartbeat is not None:
+            self.__stopHeartbeat.set()
+            self.__stopHeartbeat = None
+        #never remove a lock held by an other process
+        owned = self.__isOwner()
+        self.__owner = None
+        if not owned:
             return False
         os.remove(self.__lockFile)
         return True
@@ -66,4 +236,18 @@ class Lock(object):
         """
         if self.isLock():
             return self.__lockFile
-        return False
\ No newline at end of file
+        return False
+
+    def getLockOwner(self):
+        """Describe the process that hold the lock
+
+        Returns:
+            a human readable description of the owner, None if the subject is not lock
+        """
+        owner = self.__readLock()
+        if owner is None:
+            return None
+        if owner['host'] is None:
+            return "an unknown process, last modified {:.0f} seconds ago".format(time.time() - owner['heartbeat'])
+        return "process {} on {}, last heartbeat {:.0f} seconds ago".format(owner['pid'], owner['host'],
+                                                                            time.time() - owner['heartbeat'])
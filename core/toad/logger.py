@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import datetime
+import time
 import sys
 import os
 
+from core.toad.logwriter import getWriter, flushAll, TextRenderer, JsonRenderer
 from lib import util
 
 __author__ = "Mathieu Desrosiers"
@@ -10,32 +12,47 @@ __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
 
 
+#name of the json lines file where the records are written when structured logging is enable
+STRUCTURED_LOG_NAME = "log.jsonl"
+
+
 class Logger(object):
 
-    def __init__(self, path = None):
+    def __init__(self, path = None, structured = False):
         """Provide a simple, custom, logging capability for the toad pipeline.
 
         The purpose of this class is to provide a simple, custom, logging capability for the toad
         pipeline. Thanks to late nipype who were resetting the configuration before each call.
 
+        Messages are buffered and written periodically, see logwriter. Each message is a record
+        rendered as text into the log file and, if structured is set, as a json line into a stream
+        shared by every logger of the directory.
+
         Args
             path: the folder where the log file should be created
+            structured: also write the records into the json lines file STRUCTURED_LOG_NAME of the folder
 
         """
+        self.__context = {}
+        self.__streams = []
         if path is None:
             self.__logIntoFile = False
         else:
             self.__logIntoFile = True
             self.filename = "{}/{}.log".format(path, self.getName())
             archiveLogName = "{}.archive".format(self.filename)
+            getWriter(self.filename).flush()
             self.__rotateLog(self.filename, archiveLogName)
-            with open(self.filename,'w') as f:
-                f.write("#########################################################################\n")
-                f.write("\n")
-                f.write(" Start logging task {} at {}".format(self.getName(), self.getTimestamp()))
-                f.write("\n")
-                f.write("\n")
-                f.write("#########################################################################\n")
+            getWriter(self.filename).truncate(
+                "#########################################################################\n"
+                "\n"
+                " Start logging task {} at {}"
+                "\n"
+                "\n"
+                "#########################################################################\n".format(self.getName(), self.getTimestamp()))
+            self.__streams.append((self.filename, TextRenderer()))
+            if structured:
+                self.__streams.append((os.path.join(path, STRUCTURED_LOG_NAME), JsonRenderer()))
 
     def getTimestamp(self):
         """Return the current time and date formated as %Y%m%d %Hh%M
@@ -89,12 +106,26 @@ class Logger(object):
             self.info("Finish task {} at {}.".format(self.getName(), self.getTimestamp()))
             self.info("-------------------------------------------------------------------------\n")
 
-    def __log(self, message, level):
+    def setLogContext(self, **fields):
+        """Set fields added to every following records of this logger, like the task or the step
+
+        Args:
+            fields: the fields to set, a field set to None is removed
+
+        """
+        for key, value in fields.items():
+            if value is None:
+                self.__context.pop(key, None)
+            else:
+                self.__context[key] = value
+
+    def __log(self, message, level, fields=None):
         """Write a user friendly message into the console and into the log file
 
         Args:
             message: the message to write
             level:  the level of severity of the message: DEBUG, INFO, WARNING, ERROR etc..
+            fields: a dictionary of additionnal fields for the structured stream, like command or duration
 
         Returns:
             the execution status if the level is unknown
@@ -103,45 +134,58 @@ class Logger(object):
         if level not in ['INFO','WARNING','DEBUG','ERROR']:
             return False
 
+        record = {'time': time.time(), 'level': level}
+        record.update(self.__context)
+        record.update(fields or {})
         if isinstance(message, tuple) and len(message) == 3:
-            message = self.__commandFormatter(message)
-
+            record.update({'message': self.__commandFormatter(message), 'formatted': True})
         else:
-            message = "{}: {}\n".format(level, message)
+            record['message'] = message
 
-        print message
-        if self.__logIntoFile:
-            with open(self.filename,'a') as f:
-                f.write(message)
+        text = TextRenderer().render(record)
+        print text
+        for filename, renderer in self.__streams:
+            getWriter(filename).write(text if isinstance(renderer, TextRenderer) else renderer.render(record))
+        if level == 'ERROR':
+            self.flushLog()
+
+    def flushLog(self):
+        """Write the buffered messages of every loggers into their files
+
+        """
+        flushAll()
 
-    def info(self, message):
+    def info(self, message, **fields):
         """Wrapper for  user friendly message that have info level
 
         Args:
             message: the message to write
+            fields: additionnal fields for the structured stream
 
         """
-        self.__log(message, 'INFO')
+        self.__log(message, 'INFO', fields)
 
-    def debug(self, message, pause = False):
+    def debug(self, message, pause = False, **fields):
         """Wrapper for user friendly message that have debug level
 
         Args:
             message: the message to write
             pause: Stop pipeline and ask user to hit RETURN to continue
+            fields: additionnal fields for the structured stream
         """
-        self.__log(message, 'DEBUG')
+        self.__log(message, 'DEBUG', fields)
         if pause:
             util.rawInput("Press Enter to continue...")
 
-    def warning(self, message, pause = False):
+    def warning(self, message, pause = False, **fields):
         """Wrapper for user friendly message that have warning level
 
         Args:
             message: the message to write
             pause: Stop pipeline and ask user to hit RETURN to continue
+            fields: additionnal fields for the structured stream
         """
-        self.__log(message, 'WARNING')
+        self.__log(message, 'WARNING', fields)
         if pause:
             util.rawInput("Press Enter to continue...")
 
@@ -153,7 +197,7 @@ class Logger(object):
 
         """
         self.__log(message, 'ERROR')
-        sys.exit()
+        sys.exit(1)
 
     def quit(self, message = None):
         """Wrapper for user friendly message that have info level and quit the pipeline silently
@@ -164,6 +208,7 @@ class Logger(object):
         """
         if message is not None:
             self.__log(message, 'INFO')
+        self.flushLog()
         sys.exit()
 
     def getLogger(self):
@@ -184,14 +229,37 @@ class Logger(object):
         """
         return self.filename
 
+    def openLog(self):
+        """Return the buffered writer of the log file, used to stream the output of a command
+
+        Returns:
+            a LogWriter, or None if this logger does not log into a file
+
+        """
+        if self.__logIntoFile:
+            return getWriter(self.filename)
+        return None
+
+    def logOutput(self, line, handle=None):
+        """Write a line produce by a command into the console and into the log file
+
+        Args:
+            line: the line to write
+            handle: a LogWriter return by openLog or None
+
+        """
+        sys.stdout.write(line)
+        if handle is not None:
+            handle.write(line)
+
     def closeLog(self, handle):
-        """Close the handle of the file
+        """Write the output of the command buffered into the log file
 
         Args:
-            handle: the handle of the log file
+            handle: the LogWriter of the log file
 
         """
-        handle.close()
+        handle.flush()
 
     def __rotateLog(self, source, target):
         """Archive the contain of a source file into the beginning of a target file
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import multiprocessing.util
+import threading
+import json
+import time
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#number of seconds between two flush of the buffered log files
+FLUSH_INTERVAL = 2.0
+
+#number of bytes buffered before a log file is flushed immediately
+BUFFER_SIZE = 64 * 1024
+
+
+class LogWriter(object):
+
+    def __init__(self, filename, bufferSize=BUFFER_SIZE):
+        """Buffered writer of a log file
+
+        Lines are kept in memory and appended to the file in a single write, when the buffer is full,
+        when flush is called or periodically by a background thread, see getWriter.
+        A writer inherited by a forked process drop the lines buffered by it parent.
+
+        Args:
+            filename: the name of the log file
+            bufferSize: the number of bytes buffered before the file is written
+
+        """
+        self.__filename = filename
+        self.__bufferSize = bufferSize
+        self.__reset()
+
+
+    def __reset(self):
+        self.__pid = os.getpid()
+        self.__lock = threading.Lock()
+        self.__buffer = []
+        self.__size = 0
+
+
+    def getFilename(self):
+        """Return the name of the log file
+
+        Returns:
+            a filename
+        """
+        return self.__filename
+
+
+    def write(self, text):
+        """Append some text to the buffer
+
+        Args:
+            text: the text to write
+
+        """
+        if self.__pid != os.getpid():
+            self.__reset()
+        with self.__lock:
+            self.__buffer.append(text)
+            self.__size += len(text)
+            full = self.__size >= self.__bufferSize
+        if full:
+            self.flush()
+
+
+    def flush(self):
+        """Write the buffered text into the log file
+
+        """
+        if self.__pid != os.getpid():
+            self.__reset()
+        with self.__lock:
+            if self.__buffer:
+                with open(self.__filename, 'a') as f:
+                    f.write("".join(self.__buffer))
+                self.__buffer = []
+                self.__size = 0
+
+
+    def truncate(self, text=""):
+        """Replace the content of the log file
+
+        Args:
+            text: the new content of the file
+
+        """
+        with self.__lock:
+            self.__buffer = []
+            self.__size = 0
+            with open(self.__filename, 'w') as f:
+                f.write(text)
+
+
+class TextRenderer(object):
+    """Render a record into the human readable format of the toad log files"""
+
+    def render(self, record):
+        """Format a record
+
+        Args:
+            record: a dictionary with at least level and message keys
+
+        Returns:
+            a string
+        """
+        if record.get('formatted'):
+            return record['message']
+        return "{}: {}\n".format(record['level'], record['message'])
+
+
+class JsonRenderer(object):
+    """Render a record as a json document on a single line"""
+
+    def render(self, record):
+        """Format a record
+
+        Args:
+            record: a dictionary of json serializable values
+
+        Returns:
+            a string
+        """
+        return json.dumps(dict((key, value) for key, value in record.items() if key != 'formatted'),
+                          sort_keys=True, default=str) + "\n"
+
+
+__writers = {}
+__lock = threading.Lock()
+__pid = None
+
+
+def __flushPeriodically():
+    """Flush every log writer of this process each FLUSH_INTERVAL seconds
+
+    """
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flushAll()
+
+
+def getWriter(filename):
+    """Return the writer of a log file, shared by every Logger of this process
+
+    The first call in a process start the thread that flush the writers periodically.
+    Loggers should call it for every message so a forked process get it own thread
+
+    Args:
+        filename: the name of the log file
+
+    Returns:
+        a LogWriter
+    """
+    global __lock, __pid
+    if __pid != os.getpid():
+        #a forked process inherit the writers but not the flushing thread. The finalizer is registered into
+        #multiprocessing so the writers are flushed at exit of the main process and of the workers process
+        __lock = threading.Lock()
+        __pid = os.getpid()
+        multiprocessing.util.Finalize(None, flushAll, exitpriority=100)
+        thread = threading.Thread(target=__flushPeriodically)
+        thread.daemon = True
+        thread.start()
+
+    filename = os.path.abspath(filename)
+    with __lock:
+        if filename not in __writers:
+            __writers[filename] = LogWriter(filename)
+        return __writers[filename]
+
+
+def flushAll():
+    """Flush every log writer of this process
+
+    """
+    for writer in list(__writers.values()):
+        try:
+            writer.flush()
+        except IOError:
+            pass
+
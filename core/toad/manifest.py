@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class Manifest(object):
+
+    def __init__(self, filename, mode="content"):
+        """Record the fingerprint of a task alongside it outputs
+
+        A fingerprint is made of the hashes of the task inputs, the options of the task section
+        into the config file and the versions of the softwares used during the execution.
+        Comparing the fingerprint recorded after the last execution with the current one tell
+        if the outputs of a task are still up to date.
+
+        Args:
+            filename: the name of the manifest file, usually into the task working directory
+            mode: how inputs are hashed. valid values are:
+                    content: md5 of the file content, reused as long as the size and modification time do not change
+                    stat: the size and modification time of the file only
+
+        """
+        self.__filename = filename
+        self.__mode = mode
+
+
+    def getFilename(self):
+        """Return the name of the manifest file
+
+        Returns:
+            the name of the manifest file
+        """
+        return self.__filename
+
+
+    def exists(self):
+        """Look if a manifest have been recorded
+
+        Returns:
+            True if the manifest file exists, False otherwise
+        """
+        return os.path.isfile(self.__filename)
+
+
+    def load(self):
+        """Read the fingerprint recorded into the manifest file
+
+        Returns:
+            a fingerprint dictionary, None if the manifest do not exists or is corrupted
+        """
+        if not self.exists():
+            return None
+        try:
+            with open(self.__filename, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+    def save(self, fingerprint):
+        """Write a fingerprint into the manifest file
+
+        The file is written under a temporary name then renamed, so a crash never leave a truncated manifest
+
+        Args:
+            fingerprint: a fingerprint dictionary as return by computeFingerprint
+        """
+        temporary = "{}.tmp".format(self.__filename)
+        with open(temporary, 'w') as f:
+            json.dump(fingerprint, f, indent=2, sort_keys=True)
+        os.rename(temporary, self.__filename)
+
+
+    def computeFingerprint(self, inputs, settings, versions):
+        """Compute the fingerprint of a task
+
+        Args:
+            inputs: a list of input filenames
+            settings: a list of (option, value) tuples from the task section of the config file
+            versions: a dictionary of software names and versions
+
+        Returns:
+            a fingerprint dictionary
+        """
+        previous = self.load()
+        previousInputs = previous.get('inputs', {}) if previous else {}
+
+        #inputs are recorded relative to the subject directory so a study could be moved
+        root = os.path.dirname(os.path.dirname(os.path.abspath(self.__filename)))
+        hashes = {}
+        for source in sorted(set(inputs)):
+            if os.path.isfile(source):
+                name = os.path.relpath(os.path.abspath(source), root)
+                hashes[name] = self.hashFile(os.path.abspath(source), previousInputs.get(name))
+
+        return {'inputs': hashes,
+                'settings': dict(settings),
+                'versions': dict(versions)}
+
+
+    def getChanges(self, fingerprint):
+        """Compare a fingerprint with the one recorded into the manifest
+
+        Args:
+            fingerprint: a fingerprint dictionary as return by computeFingerprint
+
+        Returns:
+            a list of human readable descriptions of what have changed, empty if nothing changed
+        """
+        previous = self.load()
+        if previous is None:
+            return ["no manifest found"]
+
+        changes = []
+        for key, label in [('inputs', 'input'), ('settings', 'option'), ('versions', 'software')]:
+            before = previous.get(key, {})
+            after = fingerprint.get(key, {})
+            for name in sorted(set(before.keys()) | set(after.keys())):
+                if name not in after:
+                    changes.append("{} {} removed".format(label, name))
+                elif name not in before:
+                    changes.append("{} {} added".format(label, name))
+                elif self.__digest(before[name]) != self.__digest(after[name]):
+                    changes.append("{} {} changed".format(label, name))
+        return changes
+
+
+    def __digest(self, value):
+        """Return the part of a record that identify it content
+
+        Args:
+            value: a record of the fingerprint
+
+        Returns:
+            the md5 for hashed inputs, the record itself otherwise
+        """
+        if isinstance(value, dict):
+            if value.get('md5') is not None:
+                return value['md5']
+            return (value.get('size'), value.get('mtime'))
+        return value
+
+
+    def hashFile(self, source, previous=None):
+        """Compute the record of an input file
+
+        The md5 of a file is reused from the previous manifest if it size and modification time did not change
+
+        Args:
+            source: an absolute filename
+            previous: the record of the same input into the previous manifest, None if not recorded
+
+        Returns:
+            a dictionary with size, mtime and md5 keys
+        """
+        stat = os.stat(source)
+        record = {'size': stat.st_size, 'mtime': int(stat.st_mtime), 'md5': None}
+        if self.__mode != "content":
+            return record
+
+        if (previous and previous.get('md5') is not None
+                and previous.get('size') == record['size'] and previous.get('mtime') == record['mtime']):
+            record['md5'] = previous['md5']
+        else:
+            md5 = hashlib.md5()
+            with open(source, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(block)
+            record['md5'] = md5.hexdigest()
+        return record
@@ -2,10 +2,7 @@
 import os
 import shutil
 import xml.dom.minidom as minidom
-from jinja2 import Environment, FileSystemLoader
-from lib import qautil
 from lib import util
-import bibtexparser
 
 __author__ = "Christophe Bedetti"
 __copyright__ = "Copyright (C) 2014, TOAD"
@@ -33,6 +30,8 @@ class Qa(object):
         """
         Wrapper of the class Plot3dVolume of qautil
         """
+        from lib import qautil
+
         target = self.buildName(source, postfix, ext=self.qaImagesFormat)
         qaPlot = qautil.Plot3dVolume(
                 source, fov=fov, colorbar=colorbar, vmax=vmax)
@@ -52,6 +51,8 @@ class Qa(object):
         """
         Wrapper of the class Plot4dVolume of qautil to create animated gif
         """
+        from lib import qautil
+
         target = self.buildName(source, None, ext='gif')
         frameFormat = ".{}".format(self.qaImagesFormat)
         qaPlot = qautil.Plot4dVolume(source, fov=fov, frameFormat=frameFormat)
@@ -62,6 +63,8 @@ class Qa(object):
         """
         Wrapper of the class Plot4dVolume of qautil
         """
+        from lib import qautil
+
         target = self.buildName(source1, 'compare', ext='gif')
         frameFormat = ".{}".format(self.qaImagesFormat)
         qaPlot = qautil.Plot4dVolume(
@@ -73,6 +76,8 @@ class Qa(object):
         """
         Wrapper of the class Plot4dVolume of qautil to create several images
         """
+        from lib import qautil
+
         frameFormat = ".{}".format(self.qaImagesFormat)
         cgm = self.buildName(source, 'cgm', ext=frameFormat)
         scgm = self.buildName(source, 'scgm', ext=frameFormat)
@@ -87,6 +92,8 @@ class Qa(object):
     def plotMovement(self, parametersFile, basename):
         """
         """
+        from lib import qautil
+
         targetTranslations = self.buildName(
                 basename, 'translations', ext=self.qaImagesFormat)
         targetRotations = self.buildName(
@@ -98,6 +105,8 @@ class Qa(object):
     def plotVectors(self, bvecsFile, bvecsCorrected, basename):
         """
         """
+        from lib import qautil
+
         target = self.buildName(basename, 'vectors', ext='gif')
         frameFormat = ".{}".format(self.qaImagesFormat)
         qautil.plotVectors(
@@ -107,6 +116,8 @@ class Qa(object):
     def plotSigma(self, sigma, basename):
         """
         """
+        from lib import qautil
+
         target = self.buildName(basename, 'sigma', ext=self.qaImagesFormat)
         qautil.plotSigma(sigma, target)
         return target
@@ -114,14 +125,39 @@ class Qa(object):
     def noiseAnalysis(self, source, maskNoise, maskCc):
         """
         """
-        targetSnr = self.buildName(source, 'snr', ext=self.qaImagesFormat)
-        targetHist = self.buildName(source, 'hist', ext=self.qaImagesFormat)
-        qautil.noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist)
-        return targetSnr, targetHist
+        return self.noiseAnalyses([source], maskNoise, maskCc)[0]
+
+    def noiseAnalyses(self, sources, maskNoise, maskCc, nbProcesses=1):
+        """Plot the snr and the noise histogram of many diffusion images, the images are analysed concurrently
+
+        The statistics are also written into tab separated files, named after the source with snr and hist postfix
+
+        Args:
+            sources: a list of diffusion weighted images
+            maskNoise: a mask of the background
+            maskCc: a mask of the corpus callosum
+            nbProcesses: the number of images analysed concurrently
+
+        Returns:
+            a list of (snr plot, histogram plot) tuples, one for each source
+        """
+        from lib import qautil
+
+        jobs = []
+        for source in sources:
+            jobs.append((source, maskNoise, maskCc,
+                         self.buildName(source, 'snr', ext=self.qaImagesFormat),
+                         self.buildName(source, 'hist', ext=self.qaImagesFormat),
+                         self.buildName(source, 'snr', ext='tsv'),
+                         self.buildName(source, 'hist', ext='tsv')))
+        qautil.noiseAnalyses(jobs, nbProcesses)
+        return [(targetSnr, targetHist) for source, maskNoise, maskCc, targetSnr, targetHist, table, histTable in jobs]
 
     def plotReconstruction(self, data, mask, cc, model, basename):
         """
         """
+        from lib import qautil
+
         target = self.buildName(basename, model, ext=self.qaImagesFormat)
         qautil.plotReconstruction(data, mask, cc, target, model)
         return target
@@ -129,6 +165,8 @@ class Qa(object):
     def plotTrk(self, source, anatomical, roi, xSlice, ySlice, zSlice, xRot, yRot, zRot):
         """
         """
+        from lib import qautil
+
         target = self.buildName(source, None, ext=self.qaImagesFormat)
         qautil.plotTrk(source, target, anatomical, roi, xSlice, ySlice, zSlice,xRot, yRot, zRot)
         return target
@@ -253,6 +291,8 @@ class Qa(object):
 
 
     def createMethoHtml(self):
+        from jinja2 import Environment, FileSystemLoader
+
         templateDir = os.path.join(self.toadDir, 'templates', 'files')
         jinja2Env = Environment(
                 loader=FileSystemLoader(templateDir), trim_blocks=True)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+import tempfile
+import hashlib
+import shutil
+import errno
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class Scratch(object):
+
+    def __init__(self, root, subjectName, nbThreads=4):
+        """Node local copy of the directories a task read and write
+
+        The scratch directory mirror the layout of the subject directory, so the relative filenames
+        recorded into the checkpoints stay valid whether a task run into the scratch or not.
+
+        Args:
+            root: the directory where the scratch is created, usually $TMPDIR
+            subjectName: the name of the subject
+            nbThreads: the number of files transfered concurrently
+
+        """
+        self.__subjectName = subjectName
+        self.__nbThreads = max(1, nbThreads)
+        self.__directory = tempfile.mkdtemp(prefix="toad.", dir=root)
+        self.__mapping = {}
+        self.__staged = {}
+
+
+    def getDirectory(self):
+        """Return the root directory of this scratch
+
+        Returns:
+            a directory name
+        """
+        return self.__directory
+
+
+    def stage(self, source, inputs=None):
+        """Create the image of a shared directory into the scratch
+
+        When inputs is None every file of the directory is copied, as for the working directory of a task.
+        Otherwise only the files listed into inputs are copied, or hardlinked when the scratch share the
+        filesystem of the source, and the other entries are symlinked to the shared directory.
+
+        Args:
+            source: a directory of the subject
+            inputs: a list of filenames that should be copied into the scratch
+
+        Returns:
+            the name of the directory into the scratch
+        """
+        source = os.path.abspath(source)
+        target = os.path.join(self.__directory, self.__subjectName, os.path.basename(source))
+        self.__mapping[target] = source
+        #relative links of the staged directories may point anywhere into the subject directory
+        self.__mapping[os.path.dirname(target)] = os.path.dirname(source)
+        os.makedirs(target)
+        if not os.path.isdir(source):
+            return target
+
+        copies = []
+        selected = None if inputs is None else set(os.path.abspath(input) for input in inputs if input)
+        self.__mirror(source, target, selected, copies)
+        #the files of a working directory may be modified in place, they must not share the inodes of the originals
+        self.__transfer([(path, destination, inputs is not None) for path, destination in copies], self.__stageFile)
+        return target
+
+
+    def sync(self, target):
+        """Copy back into a shared directory the files created or modified into it scratch image
+
+        Files are transfered concurrently, each of them is written under a temporary name, verified against
+        the md5 of the scratch copy then renamed, so the shared directory never contains a partial file.
+        Files staged into the scratch that have been removed by the task are removed from the shared directory.
+
+        Args:
+            target: a shared directory previously staged
+
+        Returns:
+            the list of the shared filenames that have been transfered
+        """
+        target = os.path.abspath(target)
+        source = [scratch for scratch, shared in self.__mapping.items() if shared == target][0]
+        transfers = []
+        found = set()
+        for root, directories, filenames in os.walk(source):
+            shared = os.path.normpath(os.path.join(target, os.path.relpath(root, source)))
+            if not os.path.exists(shared):
+                os.makedirs(shared)
+            #links to directories are listed into directories and are not followed by os.walk
+            for directory in directories:
+                path = os.path.join(root, directory)
+                if os.path.islink(path):
+                    self.__syncLink(path, os.path.join(shared, directory))
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                destination = os.path.join(shared, filename)
+                found.add(path)
+                if os.path.islink(path):
+                    self.__syncLink(path, destination)
+                elif self.__staged.get(path) != self.__stat(path) or not os.path.exists(destination):
+                    transfers.append((path, destination))
+
+        for path in self.__staged:
+            if path.startswith(source + os.sep) and path not in found:
+                destination = os.path.join(target, os.path.relpath(path, source))
+                if os.path.lexists(destination):
+                    os.remove(destination)
+
+        self.__transfer(transfers, self.__syncFile)
+        return [destination for path, destination in transfers]
+
+
+    def remove(self):
+        """Delete the scratch directory
+
+        """
+        shutil.rmtree(self.__directory, ignore_errors=True)
+
+
+    def __mirror(self, source, target, selected, copies):
+        """Recreate a directory into the scratch
+
+        Args:
+            source: a shared directory
+            target: the image of the directory into the scratch
+            selected: a set of filenames to copy, None to copy every file
+            copies: a list where the (source, target) files to copy are appended
+
+        """
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            destination = os.path.join(target, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), destination)
+            elif os.path.isdir(path):
+                if selected is None or any(input.startswith(path + os.sep) for input in selected):
+                    os.mkdir(destination)
+                    self.__mirror(path, destination, selected, copies)
+                else:
+                    os.symlink(path, destination)
+            elif selected is None or path in selected:
+                copies.append((path, destination))
+            else:
+                os.symlink(path, destination)
+
+
+    def __transfer(self, files, function):
+        """Apply a function on a list of files using a pool of threads
+
+        Args:
+            files: a list of tuples, usually (source, target)
+            function: a callable that take the items of a tuple as arguments
+
+        """
+        if not files:
+            return
+        pool = ThreadPool(min(self.__nbThreads, len(files)))
+        try:
+            pool.map(lambda item: function(*item), files)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def __stageFile(self, source, target, link):
+        """Copy a shared file into the scratch
+
+        Args:
+            source: a shared filename
+            target: a filename into the scratch
+            link: try to hardlink the file first, the copy is used when the filesystems differ
+
+        """
+        linked = False
+        if link:
+            try:
+                os.link(source, target)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copy2(source, target)
+        self.__staged[target] = self.__stat(target)
+
+
+    def __syncFile(self, source, target):
+        """Atomically copy a file of the scratch into a shared directory
+
+        Args:
+            source: a filename into the scratch
+            target: a shared filename
+
+        """
+        temporary = "{}.{}.tmp".format(target, os.getpid())
+        try:
+            digest = self.__copy(source, temporary)
+            if self.__md5(temporary) != digest:
+                raise IOError(errno.EIO, "Checksum mismatch while copying {} into {}".format(source, temporary))
+            shutil.copystat(source, temporary)
+            os.rename(temporary, target)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+    def __syncLink(self, source, target):
+        """Recreate a symbolic link of the scratch into a shared directory
+
+        Links pointing into the scratch are redirected to the shared directories. Relative links are
+        recomputed from the location of the shared link
+
+        Args:
+            source: a symbolic link into the scratch
+            target: a shared filename
+
+        """
+        link = os.readlink(source)
+        destination = os.path.normpath(os.path.join(os.path.dirname(source), link))
+        for scratch, shared in sorted(self.__mapping.items(), key=lambda item: len(item[0]), reverse=True):
+            if destination == scratch or destination.startswith(scratch + os.sep):
+                destination = shared + destination[len(scratch):]
+                break
+        link = destination if os.path.isabs(link) else os.path.relpath(destination, os.path.dirname(target))
+        if os.path.islink(target) and os.readlink(target) == link:
+            return
+        if os.path.lexists(target):
+            os.remove(target)
+        os.symlink(link, target)
+
+
+    def __copy(self, source, target):
+        """Copy the content of a file while computing it md5
+
+        Args:
+            source: the source filename
+            target: the target filename
+
+        Returns:
+            the md5 of the content that have been read
+        """
+        md5 = hashlib.md5()
+        with open(source, 'rb') as s:
+            with open(target, 'wb') as t:
+                for block in iter(lambda: s.read(1024 * 1024), b''):
+                    md5.update(block)
+                    t.write(block)
+                t.flush()
+                os.fsync(t.fileno())
+        return md5.hexdigest()
+
+
+    def __md5(self, source):
+        md5 = hashlib.md5()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+
+    def __stat(self, source):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime
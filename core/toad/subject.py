@@ -34,7 +34,12 @@ class Subject(Logger, Lock, Validation):
         self.__logDir = os.path.join(self.__subjectDir, self.__config.get('dir', 'log'))
         #the subject logger must be call without file information during initialization
         Logger.__init__(self)
-        Lock.__init__(self, self.__logDir, self.__name)
+        #jobs that execute a single task of the subject, see --perTaskJobs, hold their own lock
+        lockName = self.__name
+        if self.__config.has_option('arguments', 'only_task'):
+            lockName = "{}.{}".format(self.__name, self.__config.get('arguments', 'only_task'))
+        Lock.__init__(self, self.__logDir, lockName,
+                      self.__config.getint('general', 'lock_heartbeat'), self.__config.getint('general', 'lock_timeout'))
         Validation.__init__(self, self.__subjectDir, self.__config)
 
     def __repr__(self):
@@ -67,7 +72,9 @@ class Subject(Logger, Lock, Validation):
         if not os.path.exists(self.__logDir):
             self.info("creating log dir {}".format(self.__logDir))
             os.mkdir(self.__logDir)
-        Logger.__init__(self, self.__logDir)
+        Logger.__init__(self, self.__logDir,
+                        self.__config.has_option('general', 'log_json') and self.__config.getboolean('general', 'log_json'))
+        self.setLogContext(subject=self.__name)
 
     def removeLogDir(self):
         """Utility function that delete the subject log directory
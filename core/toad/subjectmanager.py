@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+import multiprocessing
+import collections
+import Queue
 import glob
 import copy
+import json
+import sys
 import os
 
 from core.toad.tasksmanager import TasksManager
+from core.toad.backends import JobStore, getBackend, ACTIVE_STATES, FAILED_STATES
 from subject import Subject
 from logger import Logger
 from config import Config
+from load import Load
 from lib import util
 
 
@@ -42,6 +50,25 @@ class SubjectManager(Logger, Config):
         return self.__class__.__name__.lower()
 
 
+    def __getSoftwareVersions(self):
+        """Flatten the softwares versions into a string that could be store into the config file
+
+        The tasks record those versions into their fingerprint, see GenericTask
+
+        Returns:
+            a string of name=version items separated by semicolons
+        """
+        versions = []
+        if self.softwareVersions is not None:
+            for software in self.softwareVersions.getElementsByTagName("software"):
+                names = software.getElementsByTagName("name")
+                values = software.getElementsByTagName("version")
+                if names and values and names[0].firstChild and values[0].firstChild:
+                    versions.append("{}={}".format(names[0].firstChild.data.strip(),
+                                                   values[0].firstChild.data.strip().replace(";", ",")))
+        return ";".join(versions)
+
+
     def __processLocksSubjects(self, subjects):
         """look if some subjects from a list currently are locked into the pipeline
 
@@ -58,7 +85,7 @@ class SubjectManager(Logger, Config):
         if locks:
             if len(locks) == 1:
                 subject = locks[0]
-                tags = {"name": subject.getName(), "lock":subject.getLock()}
+                tags = {"name": subject.getName(), "lock":subject.getLock(), "owner": subject.getLockOwner()}
                 msg = util.parseTemplate(tags, os.path.join(self.arguments.toadDir, "templates", "files", "lock.tpl"))
 
             else:
@@ -66,7 +93,7 @@ class SubjectManager(Logger, Config):
                 locksFileNames = []
                 for subject in locks:
                     subjectsNames.append(subject.getName())
-                    locksFileNames.append(subject.getLock())
+                    locksFileNames.append("{} held by {}".format(subject.getLock(), subject.getLockOwner()))
                     tags = {"names": ", ".join(subjectsNames) ,"locks":"\t,\n".join(locksFileNames)}
                     msg = util.parseTemplate(tags, os.path.join(self.arguments.toadDir, "templates", "files", "locks.tpl"))
 
@@ -116,16 +143,23 @@ class SubjectManager(Logger, Config):
             subject.removeLogDir()
 
 
-    def __submitLocal(self, subject):
+    def __submitLocal(self, subject, plan=None):
         """Submit execution of the subject locally in a shell
 
         Args:
             config:  a configuration structure containing pipeline options
+            plan: the plan of the subject as return by __planSubject, None if the subject have not been planned
+
+        Returns:
+            True if every runnable task completed, False otherwise
 
         """
         name = subject.getName()
-        self.info("Evaluating which task subject {} should process".format(name))
-        tasksmanager = TasksManager(subject)
+        if plan is not None and plan['error'] is None:
+            tasksmanager = TasksManager(subject, plan['runnable'])
+        else:
+            self.info("Evaluating which task subject {} should process".format(name))
+            tasksmanager = TasksManager(subject)
 
         if tasksmanager.getNumberOfRunnableTasks():
             message = "Tasks : "
@@ -133,54 +167,466 @@ class SubjectManager(Logger, Config):
                 message += "{}, ".format(task.getName())
             self.info("{}will be submitted into the pipeline".format(message))
 
-            if not subject.isLock():
+            #acquire the lock atomically, another toad process may be evaluating the same subject
+            if subject.lock():
                 try:
                     self.info("Starting subject {} at task {}".format(name, tasksmanager.getFirstRunnableTasks().getName()))
-                    subject.lock()
 
                     #log versions that will be use for the pipeline execution
                     subject.createXmlSoftwareVersionConfig(self.softwareVersions)
-                    tasksmanager.run()
+                    return tasksmanager.run()
 
                 finally:
                     subject.removeLock()
                     self.info("Pipeline finish at {}, have a nice day!".format(self.getTimestamp()))
             else:
-                self.__processLocksSubjects(subject)
+                self.warning("Subject {} is lock by {}, it will not be submitted".format(name, subject.getLockOwner()))
+                return False
         else:
             self.info("Subject {} already completed, it will not be submitted!".format(name))
+        return True
+
+
+    def __getNumberOfLocalWorkers(self, nbSubjects):
+        """Determine how many subjects could be process concurrently on the local machine
+
+        The value of nb_parallel_subjects from the general section is restricted by the number of subjects
+        and, if memory_per_subject is specified, by the memory available on the system
+
+        Args:
+            nbSubjects: the number of subjects to process
+
+        Returns:
+            the number of subjects that could be process concurrently
+        """
+        workers = 1
+        if self.config.has_option('general', 'nb_parallel_subjects'):
+            try:
+                workers = max(1, int(self.config.get('general', 'nb_parallel_subjects')))
+            except ValueError:
+                self.warning("nb_parallel_subjects should be an integer, subjects will be process one after another")
 
+        if self.config.has_option('general', 'memory_per_subject'):
+            availableMemory = Load(self.config).getAvailableMemory()
+            try:
+                memoryPerSubject = int(float(self.config.get('general', 'memory_per_subject')) * 1024)
+                if availableMemory is not None and memoryPerSubject > 0:
+                    workers = min(workers, max(1, availableMemory / memoryPerSubject))
+            except ValueError:
+                self.warning("memory_per_subject should be a number of gigabytes, value will be ignored")
 
-    def __submitGridEngine(self, subject):
-        """Submit execution of the subject into the grid engine
-           this function will wrap a toad call with proper parameters for submission into a Sun or Torque Grid Engine
+        return min(workers, max(1, nbSubjects))
+
+
+    def __runLocalWorker(self, subject, queue, plan=None):
+        """Process a subject into a child process and report it status to the parent process
 
         Args:
-            subject:  a subject
+            subject: a subject
+            queue: a multiprocessing Queue where the name of the subject and it status are reported
+            plan: the plan of the subject as return by __planSubject
+
+        """
+        success = False
+        try:
+            success = self.__submitLocal(subject, plan) is not False
+        except SystemExit:
+            pass
+        finally:
+            queue.put((subject.getName(), success))
+
+
+    def __submitLocalPool(self, subjects, nbWorkers, plans=None):
+        """Process many subjects concurrently on the local machine
+
+        Each subject is process into it own forked process with it own TasksManager.
+        Subjects are submitted in the order they have been found as soon as a worker is available.
+        The subject lock prevent another toad invocation to process the same subject
+
+        Args:
+            subjects: a list of subjects
+            nbWorkers: the number of subjects that could be process concurrently
+            plans: a dictionary of plans keyed on the subjects names, see __planSubjects
+
+        Returns:
+            True if every subject completed, False otherwise
 
         """
+        plans = plans or {}
+        pending = list(subjects)
+        running = {}
+        failures = []
+        completed = 0
+        start = datetime.now()
+        queue = multiprocessing.Queue()
+
+        self.info("Processing {} subjects with {} local workers".format(len(subjects), nbWorkers))
+        while pending or running:
+            while pending and len(running) < nbWorkers:
+                subject = pending.pop(0)
+                #lines buffered by this process must reach the log files before the worker append to them
+                self.flushLog()
+                process = multiprocessing.Process(target=self.__runLocalWorker, name=subject.getName(),
+                                                  args=(subject, queue, plans.get(subject.getName())))
+                process.start()
+                running[subject.getName()] = process
+                self.info("Subject {} started, {} running, {} waiting".format(subject.getName(), len(running), len(pending)))
+
+            messages = []
+            try:
+                messages.append(queue.get(timeout=60))
+            except Queue.Empty:
+                #a worker may have exited right after reporting it status, read every status posted before
+                #considering that a dead worker have been killed
+                try:
+                    while True:
+                        messages.append(queue.get_nowait())
+                except Queue.Empty:
+                    pass
+                reported = set(name for name, success in messages)
+                for name, process in running.items():
+                    if not process.is_alive() and name not in reported:
+                        process.join()
+                        del running[name]
+                        failures.append(name)
+
+            for name, success in messages:
+                running.pop(name).join()
+                completed += 1
+                if not success:
+                    failures.append(name)
+                self.info("Subject {} {} after {}, {} of {} subjects done".format(name, "completed" if success else "failed",
+                          str(datetime.now() - start).split(".")[0], completed, len(subjects)))
+
+        if failures:
+            self.warning("Subject(s) {} did not complete successfully".format(", ".join(failures)))
+        return not failures
+
+
+    def __planSubject(self, subject):
+        """Determine which tasks a subject would submit into the pipeline
+
+        Must be call into a child process: the glob lookups are memoized and the tasks do not
+        write into their log files, see GenericTask
+
+        Args:
+            subject: a subject
+
+        Returns:
+            a dictionary with the name and the directory of the subject, the lock file if the subject is lock,
+            the lists of runnable, completed and ignored tasks names, and the error message if the planning failed
+        """
+        util.enableGlobCache(True)
+        subject.setConfigItem('arguments', 'planning', 'True')
+        tasksmanager = TasksManager(subject)
+        runnable = [task.getName() for task in tasksmanager.getRunnableTasks()]
+        ignored = [task.getName() for task in sorted(tasksmanager.getTasks()) if task.isIgnore()]
+        completed = [task.getName() for task in sorted(tasksmanager.getTasks())
+                     if task.getName() not in runnable and task.getName() not in ignored]
+        return {'subject': subject.getName(),
+                'directory': subject.getDir(),
+                'lock': subject.getLock() if subject.isLock() else None,
+                'runnable': runnable,
+                'completed': completed,
+                'ignored': ignored,
+                'error': None}
+
+
+    def __runPlanWorker(self, subject, queue):
+        """Plan a subject into a child process and report the plan to the parent process
+
+        Args:
+            subject: a subject
+            queue: a multiprocessing Queue where the plan of the subject is reported
+
+        """
+        if self.config.getboolean('arguments', 'plan') and not self.config.getboolean('arguments', 'debug'):
+            #messages of the tasks would be interleaved between subjects, a summary is reported instead
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            plan = self.__planSubject(subject)
+        except (Exception, SystemExit) as error:
+            plan = {'subject': subject.getName(), 'directory': subject.getDir(), 'lock': None,
+                    'runnable': [], 'completed': [], 'ignored': [], 'error': str(error) or "planning failed"}
+        queue.put(plan)
+
+
+    def __planSubjects(self, subjects):
+        """Plan many subjects concurrently, one child process per subject
+
+        Args:
+            subjects: a list of subjects
+
+        Returns:
+            a dictionary of plans keyed on the subjects names, see __planSubject
+        """
+        pending = list(subjects)
+        running = {}
+        plans = {}
+        queue = multiprocessing.Queue()
+        nbWorkers = min(Load(self.config).getUsableCpus(), max(1, len(subjects)))
+
+        self.info("Planning {} subjects with {} local workers".format(len(subjects), nbWorkers))
+        while pending or running:
+            while pending and len(running) < nbWorkers:
+                subject = pending.pop(0)
+                process = multiprocessing.Process(target=self.__runPlanWorker, args=(subject, queue), name=subject.getName())
+                process.start()
+                running[subject.getName()] = process
+
+            received = []
+            try:
+                received.append(queue.get(timeout=60))
+            except Queue.Empty:
+                #a worker may have exited right after reporting it plan, read every plan posted before
+                #considering that a dead worker have been killed
+                try:
+                    while True:
+                        received.append(queue.get_nowait())
+                except Queue.Empty:
+                    pass
+                reported = set(plan['subject'] for plan in received)
+                for name, process in running.items():
+                    if not process.is_alive() and name not in reported:
+                        process.join()
+                        del running[name]
+
+            for plan in received:
+                running.pop(plan['subject']).join()
+                plans[plan['subject']] = plan
+        return plans
+
+
+    def __reportPlans(self, subjects, plans):
+        """Display the plan of every subject and export them if a plan file have been specified
+
+        Args:
+            subjects: a list of subjects
+            plans: a dictionary of plans keyed on the subjects names, see __planSubjects
+
+        """
+        for subject in subjects:
+            plan = plans.get(subject.getName())
+            if plan is None:
+                self.warning("Subject {} could not be planned".format(subject.getName()))
+            elif plan['error'] is not None:
+                self.warning("Subject {} could not be planned: {}".format(subject.getName(), plan['error']))
+            elif plan['runnable']:
+                self.info("Subject {} would submit {} task(s): {}{}".format(subject.getName(), len(plan['runnable']),
+                          ", ".join(plan['runnable']), ", lock by {}".format(plan['lock']) if plan['lock'] else ""))
+            else:
+                self.info("Subject {} already completed".format(subject.getName()))
+
+        if self.config.has_option('arguments', 'plan_file'):
+            filename = self.config.get('arguments', 'plan_file')
+            with open(filename, 'w') as f:
+                json.dump({'date': self.getTimestamp(),
+                           'subjects': [plans[subject.getName()] for subject in subjects if subject.getName() in plans]},
+                          f, indent=2, sort_keys=True)
+            self.info("Plan exported into {}".format(filename))
 
-        gridFlags = " -q {}".format(subject.getConfig().get('general', 'sge_queue'))
-        if subject.getConfig().get('general', 'server') in ['magma', 'stark']:
-            gridFlags += " -notify "
 
-        if subject.getConfig().get('general', 'server') in ['mammouth']:
-            gridFlags += " -l walltime=48:00:00 "
+    def __getToadFlags(self, config):
+        """Return the toad flags of a job submitted to an execution backend
 
+        Args:
+            config: the configuration of a subject
+
+        Returns:
+            a string of toad command line arguments
+        """
         toadFlags = " -l -p "
-        if subject.getConfig().has_option('arguments', 'stop_before_task'):
-            toadFlags += " --stopBeforeTask {} ".format(subject.getConfig().get('arguments', 'stop_before_task'))
+        if config.has_option('arguments', 'stop_before_task'):
+            toadFlags += " --stopBeforeTask {} ".format(config.get('arguments', 'stop_before_task'))
 
-        if not subject.getConfig().getboolean('arguments', 'tractography'):
+        if not config.getboolean('arguments', 'tractography'):
             toadFlags += " --noTractography "
+        return toadFlags
+
+
+    def __getTaskResources(self, task):
+        """Return the resources a job should request to execute a task
+
+        grid_slots, grid_walltime and grid_memory are read from the task section, then from the general section.
+        grid_slots default to the cpu weight of the task
+
+        Args:
+            task: a runnable task
+
+        Returns:
+            a tuple (slots, walltime, memory), walltime and memory are None if not specified
+        """
+        config = task.config
+        resources = []
+        for option in ['grid_slots', 'grid_walltime', 'grid_memory']:
+            value = None
+            for section in [task.getName(), 'general']:
+                if config.has_option(section, option):
+                    value = config.get(section, option)
+                    break
+            resources.append(value)
+
+        try:
+            slots = max(1, int(resources[0]))
+        except (TypeError, ValueError):
+            slots = task.getCpuWeight()
+        return slots, resources[1], resources[2]
+
+
+    def __createUnit(self, subject, taskName=None, resources=(1, None, None)):
+        """Describe a unit of work submitted to an execution backend
+
+        Args:
+            subject: a subject
+            taskName: the name of the task executed alone by the unit, None for the whole pipeline of the subject
+            resources: a tuple (slots, walltime, memory)
+
+        Returns:
+            a unit dictionary, see Backend.submit
+        """
+        flags = self.__getToadFlags(subject.getConfig())
+        if taskName is not None:
+            flags += "--onlyTask {}".format(taskName)
+        return {'subject': subject.getDir(),
+                'name': subject.getName(),
+                'unit': taskName if taskName is not None else "pipeline",
+                'task': taskName,
+                'logDir': subject.getLogDir(),
+                'flags': flags,
+                'resources': resources}
+
+
+    def __submitSubjects(self, backend, subjects):
+        """Submit the whole pipeline of each subject as a single unit
+
+        Args:
+            backend: an execution backend
+            subjects: a list of subjects
+
+        """
+        units = [self.__createUnit(subject) for subject in subjects]
+        for subject, unit, jobId in zip(subjects, units, backend.submit(units, [[] for unit in units])):
+            JobStore(subject.getLogDir()).record(unit['unit'], backend.getName(), jobId, [], unit['resources'])
+            if jobId is None:
+                self.warning("Submission of subject {} failed".format(subject.getName()))
+
+
+    def __submitTasks(self, backend, subjects, runnable, holds=None):
+        """Submit every runnable task of the subjects as its own unit
+
+        Each unit execute a single task (--onlyTask), request the resources of that task and wait
+        for the units of the tasks it depend on. Subjects that share the same runnable tasks, resources
+        and holds are submitted together, so backends that support it submit them as array jobs.
+
+        Args:
+            backend: an execution backend
+            subjects: a list of subjects
+            runnable: a dictionary of subject names and names of the tasks to submit
+            holds: a dictionary of subject names and {task name: job identifier} of the units still active
+                   that the submitted tasks must wait for
+
+        """
+        holds = holds or {}
+        groups = collections.OrderedDict()
+        for subject in subjects:
+            names = runnable.get(subject.getName())
+            if not names:
+                continue
+            active = holds.get(subject.getName(), {})
+            jobs = []
+            for task in TasksManager(subject, names).getRunnableTasks():
+                dependencies = sorted(name for name in task.getDependencies() if name in names)
+                external = sorted(active[name] for name in task.getDependencies() if name in active and name not in names)
+                jobs.append((task.getName(), tuple(dependencies), tuple(external), self.__getTaskResources(task)))
+            groups.setdefault(tuple(jobs), []).append(subject)
+
+        for jobs, group in groups.items():
+            jobIds = dict((subject.getName(), {}) for subject in group)
+            for name, dependencies, external, resources in jobs:
+                units = []
+                unitHolds = []
+                for subject in group:
+                    missing = [dependency for dependency in dependencies if dependency not in jobIds[subject.getName()]]
+                    if missing:
+                        self.warning("Task {} of {} will not be submitted, the submission of {} failed"
+                                     .format(name, subject.getName(), ", ".join(missing)))
+                        continue
+                    units.append(self.__createUnit(subject, name, resources))
+                    unitHolds.append([jobIds[subject.getName()][dependency] for dependency in dependencies] + list(external))
+                if not units:
+                    continue
+
+                for unit, hold, jobId in zip(units, unitHolds, backend.submit(units, unitHolds)):
+                    JobStore(unit['logDir']).record(unit['unit'], backend.getName(), jobId, hold, resources)
+                    if jobId is None:
+                        self.warning("Submission of task {} of {} failed".format(name, unit['name']))
+                    else:
+                        jobIds[unit['name']][name] = jobId
 
-        cmd = "echo {0}/bin/toad {1} {2} | qsub -V -N {3} -o {4} -e {4} {5}".format(self.config.get('arguments', 'toad_dir'),
-              subject.getDir(), toadFlags , subject.getName(), subject.getLogDir(), gridFlags)
-        self.info("Command launch: {}".format(cmd))
 
-        import subprocess
-        process = subprocess.Popen(cmd, stdout=None, stderr=None, shell=True)
-        process.wait()
+    def __submitBackend(self, subjects, plans):
+        """Submit the subjects to the execution backend set by the backend option of the general section
+
+        Args:
+            subjects: a list of subjects
+            plans: a dictionary of plans as return by __planSubjects, used by --perTaskJobs
+
+        """
+        backend = getBackend(self.config)
+        self.info("Submitting {} subjects to the {} backend".format(len(subjects), backend.getName()))
+        if self.config.getboolean('arguments', 'per_task_jobs'):
+            runnable = {}
+            for subject in subjects:
+                plan = plans.get(subject.getName())
+                if plan is None or plan['error'] is not None:
+                    self.warning("Subject {} could not be planned, it will be submitted as a single unit".format(subject.getName()))
+                    self.__submitSubjects(backend, [subject])
+                elif not plan['runnable']:
+                    self.info("Subject {} already completed, it will not be submitted!".format(subject.getName()))
+                else:
+                    runnable[subject.getName()] = plan['runnable']
+            self.__submitTasks(backend, subjects, runnable)
+        else:
+            self.__submitSubjects(backend, subjects)
+        backend.wait()
+
+
+    def __resubmitFailed(self, subjects):
+        """Submit again the units of the subjects that failed or have been lost by their backend
+
+        Units still active are left untouched, resubmitted tasks wait for those they depend on
+
+        Args:
+            subjects: a list of subjects
+
+        """
+        backend = getBackend(self.config)
+        backends = {backend.getName(): backend}
+        runnable, holds, wholes = {}, {}, []
+        for subject in subjects:
+            store = JobStore(subject.getLogDir())
+            for name in set(record['backend'] for record in store.load().values()):
+                if name not in backends:
+                    backends[name] = getBackend(self.config, name)
+            records = store.refresh(backends)
+            failed = sorted(unit for unit, record in records.items() if record['state'] in FAILED_STATES)
+            if not failed:
+                continue
+            self.info("Subject {}: resubmitting {}".format(subject.getName(), ", ".join(failed)))
+            if "pipeline" in failed:
+                wholes.append(subject)
+            else:
+                runnable[subject.getName()] = failed
+                holds[subject.getName()] = dict((unit, record['job']) for unit, record in records.items()
+                                                if record['state'] in ACTIVE_STATES and record['backend'] == backend.getName())
+
+        if not wholes and not runnable:
+            self.info("No failed unit found, nothing to resubmit")
+            return
+        if wholes:
+            self.__submitSubjects(backend, wholes)
+        self.__submitTasks(backend, subjects, runnable, holds)
+        backend.wait()
 
 
     def __copyConfig(self, directory):
@@ -248,7 +694,8 @@ class SubjectManager(Logger, Config):
         for directory in directories:
             subject = Subject(self.__copyConfig(directory))
             if subject.isAToadSubject():
-                subject.activateLogDir()
+                if not self.config.getboolean('arguments', 'plan'):
+                    subject.activateLogDir()
                 self.info("{} seem\'s a valid toad subject entry".format(directory))
                 if self.config.getboolean('arguments', 'validation'):
                     if subject.isValidForPipeline():
@@ -273,23 +720,57 @@ class SubjectManager(Logger, Config):
 
     def run(self):
         """Launch the pipeline
+
+        Returns:
+            False if a subject processed locally did not complete
         """
 
         #create and validate subjects
         subjects = self.__subjectsFactory(self.__expandDirectories())
 
+        #a plan only report what would be submit, locks are left untouched
+        if self.config.getboolean('arguments', 'plan'):
+            for subject in subjects:
+                subject.setConfigItem("arguments", "software_versions", self.__getSoftwareVersions())
+            self.__reportPlans(subjects, self.__planSubjects(subjects))
+            return
+
         #determine if subject some subjects are currently process
         subjects = self.__processLocksSubjects(subjects)
 
         #configure how many subjects will be submit. This information is sensitive for load balancing the grid
         for subject in subjects:
             subject.setConfigItem("general", "nb_subjects", str(len(subjects)))
+            subject.setConfigItem("arguments", "software_versions", self.__getSoftwareVersions())
+
+        if self.config.getboolean('arguments', 'resubmit_failed'):
+            self.__resubmitFailed(subjects)
+            return
+
+        #the runnable tasks of every subject are determined concurrently before the submission
+        plans = {}
+        if self.config.has_option('arguments', 'only_task'):
+            for subject in subjects:
+                plans[subject.getName()] = {'runnable': [self.config.get('arguments', 'only_task')], 'error': None}
+        elif ((self.config.getboolean('arguments', 'local') or self.config.getboolean('arguments', 'per_task_jobs'))
+                and not self.config.getboolean('arguments', 'reinitialize')):
+            plans = self.__planSubjects(subjects)
 
         if self.config.getboolean('arguments', 'reinitialize'):
             self.__reinitialize(subjects)
+        elif not self.config.getboolean('arguments', 'local'):
+            self.__submitBackend(subjects, plans)
+        elif self.__getNumberOfLocalWorkers(len(subjects)) > 1:
+            nbWorkers = self.__getNumberOfLocalWorkers(len(subjects))
+            #threads are share between subjects running concurrently, see Load
+            for subject in subjects:
+                subject.setConfigItem("general", "nb_subjects", str(nbWorkers))
+            return self.__submitLocalPool(subjects, nbWorkers, plans)
         else:
+            success = True
             for subject in subjects:
-                    if self.config.getboolean('arguments', 'local'):
-                        self.__submitLocal(subject)
-                    else:
-                        self.__submitGridEngine(subject)
+                #subjects are processed one after another, each one may use the whole node
+                subject.setConfigItem("general", "nb_subjects", "1")
+                if self.__submitLocal(subject, plans.get(subject.getName())) is False:
+                    success = False
+            return success
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import functools
 import importlib
 import inspect
+import Queue
 import glob
 import sys
 import os
 
+from core.toad import logwriter
+
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
@@ -13,10 +17,18 @@ __credits__ = ["Mathieu Desrosiers"]
 
 class TasksManager(object):
 
-    def __init__(self, subject):
+    def __init__(self, subject, plan=None):
+        """Instanciate every task of a subject and determine which one should be submit
+
+        Args:
+            subject: a subject
+            plan: the names of the runnable tasks as computed previously by the planner, see SubjectManager.
+                  If None, the tasks are asked if they are dirty
+
+        """
         self.__subject = subject
         self.__tasks = self.__initialize()
-        self.__runnableTasks = self.__initializeRunnableTasks(self.__tasks)
+        self.__runnableTasks = self.__initializeRunnableTasks(self.__tasks, plan)
 
 
     def getSubjectName(self):
@@ -88,9 +100,133 @@ class TasksManager(object):
     def run(self):
         """Execute the run() methods of every runnable tasks
 
+        If nb_parallel_tasks from the general section of the config file is greater than 1,
+        every task whose dependencies are satisfied is launched concurrently. See __runParallel
+
+        Returns:
+            True if every runnable task completed, False otherwise
+
         """
-        for task in self.__runnableTasks:
-            task.run()
+        if self.__getNumberOfSlots() > 1:
+            return self.__runParallel()
+        else:
+            success = True
+            for task in self.__runnableTasks:
+                if task.run() is False:
+                    success = False
+            return success
+
+
+    def __getNumberOfSlots(self):
+        """Return the number of slots available for concurrent execution of the tasks
+
+        Returns:
+            the value of nb_parallel_tasks from the general section, 1 if the value is not valid
+        """
+        config = self.__subject.getConfig()
+        if config.has_option('general', 'nb_parallel_tasks'):
+            try:
+                return max(1, int(config.get('general', 'nb_parallel_tasks')))
+            except ValueError:
+                pass
+        return 1
+
+
+    def __isReady(self, task, pendingNames):
+        """Look if every dependencies of a task have been completed
+
+        Args:
+            task: a runnable task
+            pendingNames: the names of the runnable tasks that are not completed yet
+
+        Returns:
+            True if none of the task dependencies remain to be executed, False otherwise
+        """
+        for dependency in task.getDependencies():
+            if dependency in pendingNames:
+                return False
+        return True
+
+
+    def __runParallel(self):
+        """Execute the runnable tasks into separate processes following the dependencies graph
+
+        A task is launched as soon as all of it dependencies are completed and enough slots are available.
+        Each task hold a number of slots equal to it cpu weight, see GenericTask.getCpuWeight().
+        A task heavier than the number of slots is launched alone.
+        If a task fail, no other task is launched and the pipeline exit once running tasks are completed.
+        Like the sequential execution, every task ordered before the stop task is executed, then the pipeline stop
+
+        Returns:
+            True if every task launched completed, False otherwise
+
+        """
+        slots = self.__getNumberOfSlots()
+        pending = list(self.__runnableTasks)
+        stopTask = None
+        for index, task in enumerate(pending):
+            if task.isStopTask():
+                stopTask = task
+                pending = pending[:index]
+                break
+        pendingNames = set(task.getName() for task in self.__runnableTasks)
+        running = {}
+        failures = []
+        queue = multiprocessing.Queue()
+
+        while True:
+            if not failures:
+                for task in pending[:]:
+                    if not self.__isReady(task, pendingNames):
+                        continue
+                    weight = min(task.getCpuWeight(), slots)
+                    used = sum(weight for process, weight in running.values())
+                    if running and used + weight > slots:
+                        continue
+                    task.info("Launching task {} using {} of {} slots".format(task.getName(), weight, slots))
+                    #lines buffered by this process must reach the log files before the worker append to them
+                    logwriter.flushAll()
+                    process = multiprocessing.Process(target=_runTask, args=(task, queue), name=task.getName())
+                    process.start()
+                    running[task] = (process, weight)
+                    pending.remove(task)
+
+            if not running:
+                break
+
+            messages = []
+            try:
+                messages.append(queue.get(timeout=30))
+            except Queue.Empty:
+                #a process may have exited right after reporting it status, read every status posted before
+                #considering that a dead process have been killed
+                try:
+                    while True:
+                        messages.append(queue.get_nowait())
+                except Queue.Empty:
+                    pass
+                reported = set(name for name, success in messages)
+                for task, (process, weight) in running.items():
+                    if not process.is_alive() and task.getName() not in reported:
+                        process.join()
+                        del running[task]
+                        failures.append(task)
+
+            for name, success in messages:
+                for task in running.keys():
+                    if task.getName() == name:
+                        running.pop(task)[0].join()
+                        if success:
+                            pendingNames.discard(name)
+                        else:
+                            failures.append(task)
+
+        if failures:
+            failures[0].warning("Task(s) {} failed, exiting the pipeline".format(", ".join(task.getName() for task in failures)))
+            return False
+        if stopTask is not None:
+            stopTask.stopBeforeTask()
+        return True
 
 
     def __initialize(self):
@@ -165,7 +301,7 @@ class TasksManager(object):
         return None
 
 
-    def __initializeRunnableTasks(self, tasks):
+    def __initializeRunnableTasks(self, tasks, plan=None):
         """List all tasks that should be submit into the pipeline for that subject
 
         First determine which tasks a given subject should execute. Then
@@ -173,6 +309,7 @@ class TasksManager(object):
 
         Args:
             tasks:  a list of available tasks
+            plan: the names of the runnable tasks if they are already known, None otherwise
 
         Returns
             A list of instances that need to be execute
@@ -197,9 +334,12 @@ class TasksManager(object):
             task.setOrder(index)
             orderedTasksList[index] = task
 
-        #determine all impacts the dirty tasks could have
-        for dirtyTask in self.__getDirtyTasks(orderedTasksList):
-            workflow += self.__getWorkflow(dirtyTask, orderedTasksList)
+        if plan is not None:
+            workflow = [task for task in orderedTasksList if task.getName() in plan]
+        else:
+            #determine all impacts the dirty tasks could have
+            for dirtyTask in self.__getDirtyTasks(orderedTasksList):
+                workflow += self.__getWorkflow(dirtyTask, orderedTasksList)
 
         tasks = sorted(set(workflow))
 
@@ -345,3 +485,20 @@ class TasksManager(object):
             tasksGraph.append(aSet)
 
         return tasksGraph
+
+
+def _runTask(task, queue):
+    """Execute a task into a child process and report it status to the parent process
+
+    Args:
+        task: the task to execute
+        queue: a multiprocessing Queue where the name of the task and it status are reported
+
+    """
+    success = False
+    try:
+        success = task.run()
+    except SystemExit:
+        pass
+    finally:
+        queue.put((task.getName(), bool(success)))
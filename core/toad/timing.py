@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import glob
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class Timing(object):
+
+    def __init__(self, logDir, subjectName):
+        """Per subject database of the resources consumed by the tasks and the commands they launch
+
+        The database is a SQLite file into the log directory of the subject. It contains two tables:
+            commands: one row per external command: wall time, user and system cpu times, peak memory and exit status
+            tasks: one row per task execution: wall time and status
+
+        Args:
+            logDir: the log directory of the subject
+            subjectName: the name of the subject
+
+        """
+        self.__filename = os.path.join(logDir, "timing.sqlite")
+        self.__subjectName = subjectName
+
+
+    def getFilename(self):
+        """Return the filename of the database
+
+        Returns:
+            the filename of the database
+        """
+        return self.__filename
+
+
+    def __connect(self):
+        """Open the database and create the tables if needed
+
+        Concurrent tasks of the same subject write into the same file, the timeout let them wait for each other
+
+        Returns:
+            a sqlite3 connection
+        """
+        connection = sqlite3.connect(self.__filename, timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS commands ("
+                           "subject TEXT, task TEXT, binary TEXT, command TEXT, start REAL, wall REAL, "
+                           "user REAL, system REAL, maxrss INTEGER, returncode INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                           "subject TEXT, task TEXT, start REAL, wall REAL, success INTEGER)")
+        return connection
+
+
+    def recordCommand(self, taskName, result):
+        """Insert the resources consumed by a command
+
+        Args:
+            taskName: the name of the task that launch the command
+            result: a dictionary as return by util.executeCommand
+
+        """
+        binary = result['command'].strip().split(" ")[0]
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (self.__subjectName, taskName, binary, result['command'], result['start'],
+                                    result['wall'], result['user'], result['system'], result['maxrss'],
+                                    result['returncode']))
+        finally:
+            connection.close()
+
+
+    def recordTask(self, taskName, start, wall, success):
+        """Insert the wall time of a task execution
+
+        Args:
+            taskName: the name of the task
+            start: the time the task started, in seconds since the epoch
+            wall: the duration of the task in seconds
+            success: True if the task completed
+
+        """
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO tasks VALUES (?, ?, ?, ?, ?)",
+                                   (self.__subjectName, taskName, start, wall, 1 if success else 0))
+        finally:
+            connection.close()
+
+
+def findDatabases(directories, logDirName):
+    """Find the timing databases of every subject of some study directories
+
+    Args:
+        directories: a list of study or subject directories
+        logDirName: the name of the log directory of a subject, see the dir section of the config file
+
+    Returns:
+        a list of database filenames
+    """
+    databases = []
+    for directory in directories:
+        for pattern in ["{}/{}/timing.sqlite", "{}/*/{}/timing.sqlite"]:
+            databases.extend(glob.glob(pattern.format(os.path.abspath(directory), logDirName)))
+    return sorted(set(databases))
+
+
+def summarize(databases, limit=10):
+    """Aggregate the content of many timing databases
+
+    Args:
+        databases: a list of database filenames
+        limit: the number of rows to report in each section
+
+    Returns:
+        a dictionary with the keys:
+            binaries: (binary, calls, total wall, mean wall, total cpu, max rss) ordered by total wall time
+            commands: (subject, task, wall, cpu, maxrss, returncode, command) the slowest single commands
+            tasks: (task, executions, mean wall, max wall, failures) ordered by mean wall time
+    """
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE commands (subject TEXT, task TEXT, binary TEXT, command TEXT, start REAL, "
+                       "wall REAL, user REAL, system REAL, maxrss INTEGER, returncode INTEGER)")
+    connection.execute("CREATE TABLE tasks (subject TEXT, task TEXT, start REAL, wall REAL, success INTEGER)")
+    for database in databases:
+        source = sqlite3.connect(database, timeout=60)
+        try:
+            for table, size in [("commands", 10), ("tasks", 5)]:
+                try:
+                    rows = source.execute("SELECT * FROM {}".format(table)).fetchall()
+                except sqlite3.OperationalError:
+                    continue
+                connection.executemany("INSERT INTO {} VALUES ({})".format(table, ", ".join(["?"] * size)), rows)
+        finally:
+            source.close()
+
+    summary = {}
+    summary['binaries'] = connection.execute(
+            "SELECT binary, COUNT(*), SUM(wall), AVG(wall), SUM(user + system), MAX(maxrss) FROM commands "
+            "GROUP BY binary ORDER BY SUM(wall) DESC LIMIT ?", (limit,)).fetchall()
+    summary['commands'] = connection.execute(
+            "SELECT subject, task, wall, user + system, maxrss, returncode, command FROM commands "
+            "ORDER BY wall DESC LIMIT ?", (limit,)).fetchall()
+    summary['tasks'] = connection.execute(
+            "SELECT task, COUNT(*), AVG(wall), MAX(wall), SUM(1 - success) FROM tasks "
+            "GROUP BY task ORDER BY AVG(wall) DESC LIMIT ?", (limit,)).fetchall()
+    connection.close()
+    return summary
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import numpy
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#largest range of labels indexed directly by a lookup table, sparser label maps are indexed on their distinct values
+MAX_TABLE_SIZE = 2 ** 24
+
+
+def __index(data):
+    """Index the voxels of a label map into the list of the labels it may contain
+
+    Integer label maps with a reasonable range are indexed by offsetting their values, which only
+    need a single pass. The other label maps are indexed on their distinct values.
+
+    Args:
+        data: a numpy array of labels
+
+    Returns:
+        a tuple (keys, indices) where keys is a sorted numpy array of labels and indices an array
+        of the shape of data such as keys[indices] == data
+    """
+    data = numpy.asarray(data)
+    if data.dtype.kind in "iub" and data.size:
+        low, high = int(data.min()), int(data.max())
+        if high - low < MAX_TABLE_SIZE:
+            keys = numpy.arange(low, high + 1)
+            indices = data if low == 0 and data.dtype.kind != "b" else data.astype(numpy.int64) - low
+            return keys, indices
+    keys, indices = numpy.unique(data, return_inverse=True)
+    return keys, indices.reshape(data.shape)
+
+
+def __find(keys, labels):
+    """Return the positions of the labels into keys, labels absent from keys are ignored"""
+    labels = numpy.atleast_1d(numpy.asarray(labels))
+    positions = numpy.searchsorted(keys, labels).clip(0, max(0, len(keys) - 1))
+    found = keys[positions] == labels if len(keys) else numpy.zeros(labels.shape, dtype=bool)
+    return positions[found], found
+
+
+def remap(data, mapping):
+    """Replace labels by others in a single pass, the labels absent of mapping are kept
+
+    Args:
+        data: a numpy array of labels
+        mapping: a dictionary of label: new label
+
+    Returns:
+        a new numpy array, of a datatype able to contain the new labels
+    """
+    keys, indices = __index(data)
+    sources = numpy.asarray(list(mapping.keys()))
+    targets = numpy.asarray(list(mapping.values()))
+    dtype = numpy.asarray(data).dtype
+    for value in [targets.min().item(), targets.max().item()] if len(targets) else []:
+        if not numpy.can_cast(value, dtype):
+            dtype = numpy.promote_types(dtype, numpy.min_scalar_type(value))
+    table = keys.astype(dtype)
+    positions, found = __find(keys, sources)
+    table[positions] = targets[found]
+    return table[indices]
+
+
+def isin(data, labels):
+    """Create a binary mask of the voxels that belong to any of the labels, in a single pass
+
+    Args:
+        data: a numpy array of labels
+        labels: a list of labels
+
+    Returns:
+        a boolean numpy array
+    """
+    keys, indices = __index(data)
+    table = numpy.zeros(len(keys), dtype=bool)
+    table[__find(keys, labels)[0]] = True
+    return table[indices]
+
+
+def split(data, groups):
+    """Create the binary masks of many groups of labels, the labels are looked up in a single pass
+
+    Args:
+        data: a numpy array of labels
+        groups: a list of lists of labels, a label may belong to many groups
+
+    Returns:
+        a list of boolean numpy arrays, one for each group
+    """
+    keys, indices = __index(data)
+    masks = []
+    #each group own a bit of the table, 64 groups are looked up at a time
+    for start in range(0, len(groups), 64):
+        table = numpy.zeros(len(keys), dtype=numpy.uint64)
+        for bit, labels in enumerate(groups[start:start + 64]):
+            table[__find(keys, labels)[0]] |= numpy.uint64(1 << bit)
+        flags = table[indices]
+        for bit in range(len(groups[start:start + 64])):
+            masks.append((flags & numpy.uint64(1 << bit)) != 0)
+    return masks
+
+
+def overlay(data, other):
+    """Replace in place the voxels of a label map by the non zero labels of an other one
+
+    Args:
+        data: a numpy array of labels, modified in place
+        other: a numpy array of labels of the same shape
+
+    Returns:
+        data
+    """
+    numpy.copyto(data, other, casting='unsafe', where=numpy.asarray(other) != 0)
+    return data
+
+
+def statistics(data, background=0):
+    """Compute the number of voxels and the bounding box of every label
+
+    Args:
+        data: a numpy array of labels
+        background: the label that is ignored
+
+    Returns:
+        an ordered dictionary of label: (number of voxels, list of (first, last) voxel along each axis)
+    """
+    import scipy.ndimage
+
+    keys, indices = __index(data)
+    counts = numpy.bincount(indices.ravel(), minlength=len(keys))
+    present = numpy.flatnonzero(counts)
+    present = present[keys[present] != background]
+
+    #renumber the labels present from 1 so find_objects do not allocate a slot for each absent label
+    table = numpy.zeros(len(keys), dtype=numpy.int32)
+    table[present] = numpy.arange(1, len(present) + 1)
+    boxes = scipy.ndimage.find_objects(table[indices])
+
+    result = OrderedDict()
+    for position, box in zip(present, boxes):
+        label = keys[position].item()
+        result[label] = (int(counts[position]), [(int(axis.start), int(axis.stop) - 1) for axis in box])
+    return result
+
+
+def writeStatistics(statistics, target):
+    """Write the statistics of the labels into a tab separated file
+
+    Args:
+        statistics: a dictionary as return by statistics
+        target: the name of the file to write
+
+    Returns:
+        the name of the file
+    """
+    dimensions = max([len(box) for count, box in statistics.values()] + [3])
+    axes = ["x", "y", "z", "t"][:dimensions] + ["d{}".format(axis) for axis in range(4, dimensions)]
+    header = ["label", "voxels"] + ["{}{}".format(axis, bound) for axis in axes for bound in ["min", "max"]]
+    with open(target, 'w') as f:
+        f.write("\t".join(header) + "\n")
+        for label, (count, box) in statistics.items():
+            f.write("\t".join(str(value) for value in [label, count] + [bound for axis in box for bound in axis]) + "\n")
+    return target
@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
-import nibabel
 import random
-import scipy
-import numpy
+import nifti
 import util
 import os
 from shutil import rmtree
@@ -13,9 +11,35 @@ __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
 
 
+def voxelwise(outputs):
+    """Evaluate voxelwise expressions in process, in a single pass over their images, see voxelmath
+
+    Args:
+        outputs: a list of (voxelmath.Expression, target) tuples
+
+    Returns:
+        A tuple of 3 elements like launchCommand, the description of the expressions, an empty stdout and stderr
+
+    """
+    import voxelmath
+    voxelmath.evaluate(outputs)
+    return voxelmath.describe(outputs), "", ""
+
+
+def __getVoxelOperand(value):
+    """Return a number, or an image expression if value is not a number"""
+    import voxelmath
+    try:
+        return float(value)
+    except ValueError:
+        return voxelmath.image(value)
+
+
 def fslmaths(source1, target, operator="bin", source2=None):
     """Perform a mathematical operations using a second image or a numeric value
 
+    The operators bin, Tmean, add, sub, mul and div are evaluated in process, the others launch fslmaths
+
     Args:
         source1: he input image
         target:  Name of the resulting output image
@@ -26,6 +50,15 @@ def fslmaths(source1, target, operator="bin", source2=None):
         A tuple of 3 elements representing (the command launch, the stdout and stderr of the execution)
 
     """
+    import voxelmath
+    image = voxelmath.image(source1)
+    if source2 is None and operator in ["bin", "Tmean"]:
+        return voxelwise([(image.bin() if operator == "bin" else image.tmean(), target)])
+    if source2 is not None and operator in ["add", "sub", "mul", "div"]:
+        operand = __getVoxelOperand(source2)
+        expressions = {"add": image + operand, "sub": image - operand, "mul": image * operand, "div": image / operand}
+        return voxelwise([(expressions[operator], target)])
+
     if source2 is None:
         cmd = "fslmaths {} -{} {} ".format(source1, operator, target)
     else:
@@ -101,6 +134,7 @@ def extractSubVolume(source, target, extractAtAxis, extractAtCoordinate, nthread
     return util.launchCommand(cmd)
 
 
+@util.memoizeProbe
 def mrinfo(source):
     """display or extract specific information from the source header.
 
@@ -118,6 +152,7 @@ def mrinfo(source):
     (executedCmd, stdout, stderr) = util.launchCommand(cmd)
     return stdout.splitlines()
 
+@util.memoizeProbe
 def getBValues(source, grad):
     """Use mrinfo to get BValues
 
@@ -137,11 +172,19 @@ def getBValues(source, grad):
 
 
 def mrcalc(source, value, target):
+    """Create a binary image of the voxels equal to a value, as mrcalc -eq
+
+    Args:
+        source: the input image
+        value: a number
+        target: the name of the binary image
+
+    Returns:
+        A tuple of 3 elements like launchCommand
+
     """
-    #@TODO comment the purpose of this function
-    """
-    cmd = "mrcalc {} {} -eq {} -quiet".format(source, value, target)
-    return util.launchCommand(cmd)
+    import voxelmath
+    return voxelwise([(voxelmath.image(source).eq(float(value)), target)])
 
 
 def invertMatrix(source, target):
@@ -206,6 +249,8 @@ def __getMrinfoFieldValues(text, field, delimiter=""):
 def getMriDimensions(source):
     """get the image dimension along each axis of the source image
 
+    NIfTI headers are read in process, other formats are probed with mrinfo
+
     Args:
         source: A mri image
 
@@ -213,12 +258,18 @@ def getMriDimensions(source):
         the image dimension along each axis
 
     """
+    if nifti.isNifti(source):
+        dimensions = nifti.getDimensions(source)
+        if dimensions is not None:
+            return [str(dimension) for dimension in dimensions]
     return __getMrinfoFieldValues(mrinfo(source), "Dimensions:", "x")
 
 
 def getMriVoxelSize(source):
     """get the voxel size of the source image
 
+    NIfTI headers are read in process, other formats are probed with mrinfo
+
     Args:
         source: A mri image
 
@@ -226,6 +277,10 @@ def getMriVoxelSize(source):
         the voxel size of the source image
 
     """
+    if nifti.isNifti(source):
+        sizes = nifti.getVoxelSize(source)
+        if sizes is not None:
+            return [nifti.formatValue(size) for size in sizes]
     return __getMrinfoFieldValues(mrinfo(source), "Voxel size:", "x")
 
 
@@ -257,6 +312,10 @@ def getDataStridesOrientation(source):
         An array of string elements representing the layout of the image
 
     """
+    if nifti.isNifti(source):
+        strides = nifti.getStrides(source)
+        if strides is not None:
+            return ",".join(str(stride) for stride in strides)
     return ",".join(__getMrinfoFieldValues(mrinfo(source), "Data strides:").strip("[]").split())
 
 
@@ -309,6 +368,8 @@ def applyGradientCorrection(bFilename, eddyFilename, target):
         the resulting gradient encoding file
 
     """
+    import numpy
+
     f = open(eddyFilename, 'r')
     g = open(bFilename, 'r')
     eddys = f.readlines()
@@ -385,19 +446,56 @@ def extractStructure(values, source, target):
     returns:
         a new image that contain areas specified by values
     """
+    if not os.path.exists(target):
+        extractStructures(source, [(values, target)])
+    return target
+
+
+def extractStructures(source, structures, statistics=None):
+    """Extract many structures from a label map in a single pass over the image, see labels
+
+    Args:
+        source: An mri label map
+        structures: A list of (values, target) tuples, values being a list of labels to extract into target
+        statistics: An optional tab separated file where the number of voxels and the bounding box of each label are written
+
+    returns:
+        the list of the binary images created
+    """
+    import nibabel
+    import numpy
+    import labels
+
     image = nibabel.load(source)
     data = image.get_data()
-    c = []
-    for value in values:
-        c.append(numpy.where(data==value))
+    masks = labels.split(data, [values for values, target in structures])
+    for mask, (values, target) in zip(masks, structures):
+        saveImage(nibabel.Nifti1Image(mask.astype(numpy.uint8), image.get_affine()), target)
+    if statistics is not None:
+        labels.writeStatistics(labels.statistics(data), statistics)
+    return [target for values, target in structures]
 
-    data.fill(0)
-    for i in range(len(values)):
-        data[c[i]] = 1
 
-    if not os.path.exists(target):
-        nibabel.save(nibabel.Nifti1Image(data, image.get_affine()), target)
-        return target
+def saveImage(image, target):
+    """Write a nibabel image, a .nii.gz target is compressed by many threads, see pgzip
+
+    Args:
+        image: a nibabel image
+        target: the name of the image to write
+
+    Returns:
+        the name of the image
+
+    """
+    import nibabel
+    import pgzip
+
+    if target.endswith(".gz"):
+        with pgzip.open(target, 'wb') as f:
+            image.to_file_map({'image': nibabel.FileHolder(filename=target, fileobj=f)})
+    else:
+        nibabel.save(image, target)
+    return target
 
 
 def plotConnectome(source, target,  lutFile=None, title=None, label=None, skiprows=0, usecols=None, useGrid=False):
@@ -412,6 +510,8 @@ def plotConnectome(source, target,  lutFile=None, title=None, label=None, skipro
     """
     #ADD figsize
 
+    import numpy
+
     def __getDataIndexsAndLabels(lutFile):
         """ This need to be implemented
 
@@ -488,85 +588,31 @@ def read_mrtrix_tracks(in_file, as_generator=True):
 
 
 def read_mrtrix_header(in_file):
-    fileobj = open(in_file,'r')
-    header = {}
-    for line in fileobj:
-        if line == 'END\n':
-            break
-        elif ': ' in line:
-            line = line.replace('\n','')
-            line = line.replace("'","")
-            key  = line.split(': ')[0]
-            value = line.split(': ')[1]
-            header[key] = value
-    fileobj.close()
-    header['count'] = int(header['count'].replace('\n',''))
-    header['offset'] = int(header['file'].replace('.',''))
-    return header
+    import tck
+    return tck.readHeader(in_file)
 
 
 def read_mrtrix_streamlines(in_file, header, as_generator=True):
-    offset = header['offset']
-    stream_count = header['count']
-    fileobj = open(in_file,'r')
-    fileobj.seek(offset)
-    endianness = nibabel.volumeutils.native_code
-    f4dt = numpy.dtype(endianness + 'f4')
-    pt_cols = 3
-    bytesize = pt_cols*4
-    def points_per_track(offset):
-        track_points = []
-        all_str = fileobj.read()
-        num_triplets = len(all_str)/bytesize
-        pts = numpy.ndarray(shape=(num_triplets,pt_cols), dtype='f4',buffer=all_str)
-        nonfinite_list = numpy.where(numpy.isfinite(pts[:,2]) == False)
-        nonfinite_list = list(nonfinite_list[0])[0:-1]
-        for idx, value in enumerate(nonfinite_list):
-            if idx == 0:
-                track_points.append(nonfinite_list[idx])
-            else:
-                track_points.append(nonfinite_list[idx]-nonfinite_list[idx-1]-1)
-        return track_points, nonfinite_list
-
-    def track_gen(track_points):
-        n_streams = 0
-        while True:
-            try:
-                n_pts = track_points[n_streams]
-            except IndexError:
-                break
-            pts_str = fileobj.read(n_pts * bytesize)
-            nan_str = fileobj.read(bytesize)
-            if len(pts_str) < (n_pts * bytesize):
-                if not n_streams == stream_count:
-                    raise StandardError
-                break
-            pts = numpy.ndarray(
-                shape = (n_pts, pt_cols),
-                dtype = f4dt,
-                buffer = pts_str)
-            nan_pt = numpy.ndarray(
-                shape = (1, pt_cols),
-                dtype = f4dt,
-                buffer = nan_str)
-            if numpy.isfinite(nan_pt[0][0]):
-                raise ValueError
-                break
-            xyz = pts[:,:3]
-            yield xyz
-            n_streams += 1
-            if n_streams == stream_count:
-                raise StopIteration
-
-    track_points, nonfinite_list = points_per_track(offset)
-    fileobj.seek(offset)
-    streamlines = track_gen(track_points)
+    """Read the streamlines of a tractogram, see tck.TckFile
+
+    Args:
+        in_file: a .tck filename
+        header: the header of the tractogram, as return by read_mrtrix_header
+        as_generator: return a generator instead of a list
+
+    Returns:
+        the streamlines, as read only views on the memory mapped points of the tractogram
+    """
+    import tck
+    streamlines = iter(tck.TckFile(in_file))
     if not as_generator:
         streamlines = list(streamlines)
     return streamlines
 
 
 def get_data_dims(volume):
+    import nibabel
+
     if isinstance(volume, list):
         volume = volume[0]
     nii = nibabel.load(volume)
@@ -576,6 +622,8 @@ def get_data_dims(volume):
 
 
 def get_vox_dims(volume):
+    import nibabel
+
     if isinstance(volume, list):
         volume = volume[0]
     nii = nibabel.load(volume)
@@ -595,6 +643,10 @@ def tck2trk(tractogram, anatomy ,target):
 
     """
 
+    import nibabel
+    import numpy
+    import tck
+
     nii = nibabel.load(anatomy)
 
     header = {}
@@ -603,8 +655,10 @@ def tck2trk(tractogram, anatomy ,target):
     header[nibabel.streamlines.Field.DIMENSIONS] = nii.shape[:3]
     header[nibabel.streamlines.Field.VOXEL_ORDER] = "".join(nibabel.orientations.aff2axcodes(nii.affine))
 
-    tck = nibabel.streamlines.load(tractogram)
-    nibabel.streamlines.save(tck.tractogram, target, header=header)
+    #the streamlines are streamed from the memory mapped tractogram to the trk file
+    tckFile = tck.TckFile(tractogram)
+    streamlines = nibabel.streamlines.LazyTractogram(lambda: iter(tckFile), affine_to_rasmm=numpy.eye(4))
+    nibabel.streamlines.save(streamlines, target, header=header)
 
     return target
 
@@ -714,14 +768,33 @@ def getlmax(dwi):
 
     return order
 
-def computeNoiseMask(source, target):
+def computeNoiseMask(source, target, margin=25):
+    """Create a mask of the background far from the brain, in the upper half of the image
+
+    The brain is dilated by margin voxels using a taxicab distance transform, which give the
+    same result as as many iterations of a binary dilation in a single pass
+
+    Args:
+        source: a brain mask
+        target: the name of the noise mask
+        margin: the distance in voxels between the brain and the noise
+
+    Returns:
+        the name of the noise mask
+    """
+    import nibabel
+    import numpy
+    import scipy.ndimage
+
     brainImage = nibabel.load(source)
-    brainData = brainImage.get_data()
-    brainData[brainData>0] = 1
-    maskNoise = scipy.ndimage.morphology.binary_dilation(brainData, iterations=25)
+    brainData = brainImage.get_data() > 0
+    if brainData.any():
+        maskNoise = scipy.ndimage.distance_transform_cdt(~brainData, metric='taxicab') <= margin
+    else:
+        maskNoise = numpy.zeros(brainData.shape, dtype=bool)
     maskNoise[..., :maskNoise.shape[-1]//2] = 1
     maskNoise = ~maskNoise
-    nibabel.save(nibabel.Nifti1Image(maskNoise.astype(numpy.uint8), brainImage.get_affine()), target)
+    saveImage(nibabel.Nifti1Image(maskNoise.astype(numpy.uint8), brainImage.get_affine()), target)
     return target
 
 
@@ -739,12 +812,12 @@ def convertAndRestride(source, target, orientation):
     return target
 
 def applyResampleFsl(source, reference, matrix, target, nearest = False):
-    """Register an image with symmetric normalization and mutual information metric
+    """Resample an image into the grid of a reference through a flirt matrix with flirt -applyxfm
 
     Args:
-        source:
+        source: the image to resample
         reference: use this image as reference
-        matrix:
+        matrix: a flirt matrix from the source to the reference
         target: the output file name
         nearest: A boolean, process nearest neighbour interpolation
 
@@ -758,10 +831,50 @@ def applyResampleFsl(source, reference, matrix, target, nearest = False):
     return target
 
 
+def applyResamplesFsl(images, reference, matrix, nbProcesses=1):
+    """Resample many images through the same flirt matrix, nbProcesses flirt commands run at the same time
+
+    Args:
+        images: a list of (source, target, nearest) tuples, nearest neighbour interpolation is used for label maps
+        reference: use this image as reference
+        matrix: a flirt matrix from the sources to the reference
+        nbProcesses: the number of flirt commands launched concurrently
+
+    Returns:
+        the list of the resulting images
+    """
+    from multiprocessing.pool import ThreadPool
+    if not images:
+        return []
+    pool = ThreadPool(max(1, min(int(nbProcesses), len(images))))
+    try:
+        return pool.map(lambda image: applyResampleFsl(image[0], reference, matrix, image[1], image[2]), images)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def applyRegistrationMrtrix(source , matrix, target):
-    cmd = "mrtransform  {} -linear {} {} -quiet".format(source, matrix, target)
-    util.launchCommand(cmd)
-    return target
+    return applyRegistrationsMrtrix([(source, target)], matrix)[0]
+
+
+def applyRegistrationsMrtrix(images, matrix):
+    """Apply a mrtrix linear transformation to many images with mrtrix mrtransform -linear
+
+    mrtransform use the reverse convention, the transformation map the template space to the moving
+    space, even when no template is supplied
+
+    Args:
+        images: a list of (source, target) tuples
+        matrix: a mrtrix transformation
+
+    Returns:
+        the list of the resulting images
+    """
+    for source, target in images:
+        cmd = "mrtransform  {} -linear {} {} -quiet".format(source, matrix, target)
+        util.launchCommand(cmd)
+    return [target for source, target in images]
 
 
 def setWorkingDirTractometry(workingDir, sourceBundles=None, sourceMetrics=None):
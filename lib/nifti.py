@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import struct
+import math
+import gzip
+import util
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#size of a NIfTI-1 header, the only fields read from the image
+HEADER_SIZE = 348
+
+
+def isNifti(source):
+    """Look if a filename have the extension of a NIfTI-1 image
+
+    Args:
+        source: a filename
+
+    Returns:
+        True if the extension is .nii or .nii.gz
+    """
+    return isinstance(source, basestring) and (source.endswith(".nii") or source.endswith(".nii.gz"))
+
+
+@util.memoizeProbe
+def readHeader(source):
+    """Read the header of a NIfTI-1 image without loading the data
+
+    Only the first HEADER_SIZE bytes of a compressed image are decompressed.
+    The result is memoized on the filename, the size and the modification time of the image
+
+    Args:
+        source: a .nii or .nii.gz image
+
+    Returns:
+        a dictionary with the dim, pixdim, datatype, qform_code, sform_code and affine of the image,
+        None if the file is not a readable NIfTI-1 image
+    """
+    try:
+        if source.endswith(".gz"):
+            with gzip.open(source, 'rb') as f:
+                data = f.read(HEADER_SIZE)
+        else:
+            with open(source, 'rb') as f:
+                data = f.read(HEADER_SIZE)
+    except IOError:
+        return None
+    if len(data) < HEADER_SIZE or data[344:347] not in ["n+1", "ni1"]:
+        return None
+
+    for endian in ["<", ">"]:
+        if struct.unpack(endian + "i", data[0:4])[0] == HEADER_SIZE:
+            break
+    else:
+        return None
+
+    def unpack(format, offset):
+        return list(struct.unpack(endian + format, data[offset:offset + struct.calcsize(endian + format)]))
+
+    header = {'dim': unpack("8h", 40),
+              'datatype': unpack("h", 70)[0],
+              'pixdim': unpack("8f", 76),
+              'qform_code': unpack("h", 252)[0],
+              'sform_code': unpack("h", 254)[0],
+              'quatern': unpack("6f", 256),
+              'srow': [unpack("4f", 280), unpack("4f", 296), unpack("4f", 312)]}
+    header['affine'] = __getAffine(header)
+    return header
+
+
+def __getAffine(header):
+    """Compute the voxel to scanner transformation of an image
+
+    Like mrtrix3 with its default configuration (NIfTIUseSform), the sform is preferred over the qform when both are set
+
+    Args:
+        header: a dictionary as return by readHeader
+
+    Returns:
+        the 3 first rows of the affine, a list of 3 lists of 4 floats
+    """
+    pixdim = header['pixdim']
+    if header['sform_code'] > 0:
+        return header['srow']
+    if header['qform_code'] > 0:
+        b, c, d, x, y, z = header['quatern']
+        a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+        rotation = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                    [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                    [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        scales = [pixdim[1], pixdim[2], qfac * pixdim[3]]
+        return [[rotation[row][column] * scales[column] for column in range(3)] + [[x, y, z][row]]
+                for row in range(3)]
+    return [[pixdim[1], 0.0, 0.0, 0.0], [0.0, pixdim[2], 0.0, 0.0], [0.0, 0.0, pixdim[3], 0.0]]
+
+
+def __getShuffle(header):
+    """Compute how the axes of an image are reordered to be the closest to RAS, as mrtrix display them
+
+    Args:
+        header: a dictionary as return by readHeader
+
+    Returns:
+        a list of (index of the axis on disk, flipped) tuples, one for each of the 3 spatial axes
+    """
+    affine = header['affine']
+    shuffle = []
+    for row in range(3):
+        magnitudes = [abs(value) for value in affine[row][:3]]
+        axis = magnitudes.index(max(magnitudes))
+        #degenerated transformations may point two scanner axes to the same image axis
+        if axis in [index for index, flip in shuffle]:
+            axis = [index for index in range(3) if index not in [used for used, flip in shuffle]][0]
+        shuffle.append((axis, affine[row][axis] < 0))
+    return shuffle
+
+
+def __getNumberOfDimensions(header):
+    return max(1, min(7, header['dim'][0]))
+
+
+def getDimensions(source):
+    """get the image dimension along each axis of a NIfTI image
+
+    Args:
+        source: a .nii or .nii.gz image
+
+    Returns:
+        a list of integers, None if the header cannot be read
+    """
+    header = readHeader(source)
+    if header is None:
+        return None
+    dims = header['dim'][1:__getNumberOfDimensions(header) + 1]
+    if len(dims) >= 3:
+        dims[:3] = [dims[axis] for axis, flip in __getShuffle(header)]
+    return dims
+
+
+def getVoxelSize(source):
+    """get the voxel size of a NIfTI image, as the pixdim fields reordered along the displayed axes
+
+    Args:
+        source: a .nii or .nii.gz image
+
+    Returns:
+        a list of floats, None if the header cannot be read
+    """
+    header = readHeader(source)
+    if header is None:
+        return None
+    sizes = [abs(value) for value in header['pixdim'][1:__getNumberOfDimensions(header) + 1]]
+    if len(sizes) >= 3:
+        sizes[:3] = [sizes[axis] for axis, flip in __getShuffle(header)]
+    return sizes
+
+
+def getStrides(source):
+    """get the data strides of a NIfTI image, as mrinfo display them
+
+    The data of a NIfTI image is stored along it axes in order, the strides tell which displayed
+    axis is stored first and if it is reversed, like -1,2,3 for an image stored in LAS order
+
+    Args:
+        source: a .nii or .nii.gz image
+
+    Returns:
+        a list of integers, None if the header cannot be read
+    """
+    header = readHeader(source)
+    if header is None:
+        return None
+    strides = range(1, __getNumberOfDimensions(header) + 1)
+    if len(strides) >= 3:
+        strides[:3] = [-(axis + 1) if flip else axis + 1 for axis, flip in __getShuffle(header)]
+    return strides
+
+
+def formatValue(value):
+    """Format a number the way mrinfo display it
+
+    Args:
+        value: a number
+
+    Returns:
+        a string
+    """
+    return "{:g}".format(value)
+
+
+def iterVolumes(source):
+    """Read the volumes of a NIfTI image one at a time
+
+    The volumes of a NIfTI image are stored one after the other, so they are read sequentially and
+    a compressed image is decompressed only once, in the background, see pgzip. Only one volume is
+    kept in memory at a time.
+
+    Args:
+        source: a .nii or .nii.gz image
+
+    Returns:
+        a generator of 3D numpy arrays, scaled by the slope and the intercept of the header
+    """
+    import nibabel
+    import numpy
+    import pgzip
+
+    #nibabel move the scaling of the header into the proxy of the data
+    proxy = nibabel.load(source).dataobj
+    shape = proxy.shape
+    dtype = proxy.dtype
+    slope, inter = proxy.slope, proxy.inter
+    volumeShape = tuple(shape[:3]) + (1,) * (3 - len(shape[:3]))
+    nbVolumes = int(numpy.prod(shape[3:]))
+    size = int(numpy.prod(volumeShape)) * dtype.itemsize
+
+    with (pgzip.GzipReader(source) if source.endswith(".gz") else open(source, 'rb')) as f:
+        f.seek(int(proxy.offset))
+        for index in range(nbVolumes):
+            data = f.read(size)
+            if len(data) != size:
+                raise IOError("{} is truncated at volume {}".format(source, index))
+            volume = numpy.frombuffer(data, dtype).reshape(volumeShape, order='F')
+            if slope != 1 or inter != 0:
+                volume = volume * slope + inter
+            yield volume
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+import threading
+import __builtin__
+import struct
+import shutil
+import Queue
+import zlib
+import time
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#number of uncompressed bytes compressed by a thread at a time, like pigz
+BLOCK_SIZE = 128 * 1024
+
+#number of blocks submitted to the threads at a time
+BLOCKS_PER_BATCH = 64
+
+#number of threads used when none is specified, see setDefaultThreads
+__defaultThreads = 1
+
+
+def setDefaultThreads(threads):
+    """Set the number of threads used when none is specified, like the budget of the current task
+
+    Args:
+        threads: a number of threads
+
+    """
+    global __defaultThreads
+    __defaultThreads = max(1, int(threads))
+
+
+def getDefaultThreads():
+    """Return the number of threads used when none is specified
+
+    Returns:
+        a number of threads
+    """
+    return __defaultThreads
+
+
+class GzipWriter(object):
+
+    def __init__(self, filename, threads=None, level=6, blockSize=BLOCK_SIZE):
+        """Write a gzip file whose blocks are compressed by many threads, like pigz
+
+        The file is a single standard gzip member. Each block is deflated independently and ended with a
+        sync flush, so the blocks are simply concatenated. The crc of the blocks are combined in order.
+
+        Args:
+            filename: the name of the compressed file
+            threads: the number of threads, see setDefaultThreads
+            level: the compression level
+            blockSize: the number of uncompressed bytes of a block
+
+        """
+        self.name = filename
+        self.mode = 'wb'
+        self.__threads = threads or getDefaultThreads()
+        self.__level = level
+        self.__blockSize = blockSize
+        self.__shift = self.__getShiftOperator(blockSize)
+        self.__pool = ThreadPool(self.__threads) if self.__threads > 1 else None
+        self.__pending = []
+        self.__buffer = []
+        self.__buffered = 0
+        self.__crc = 0
+        self.__size = 0
+        self.__file = __builtin__.open(filename, 'wb')
+        #magic, deflate, no flags, modification time, no extra flags, unix
+        self.__file.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), 0, 3))
+
+    def __multiply(self, matrix, vector):
+        """Multiply a vector by a matrix over GF(2), both represented as 32 bits integers"""
+        result = 0
+        index = 0
+        while vector:
+            if vector & 1:
+                result ^= matrix[index]
+            vector >>= 1
+            index += 1
+        return result
+
+    def __getShiftOperator(self, length):
+        """Return the operator that append length zeros to the message of a crc32, as zlib crc32_combine
+
+        Args:
+            length: a number of bytes
+
+        Returns:
+            a matrix usable with __multiply
+        """
+        #operator for one zero bit, squared three times for one zero byte
+        operator = [0xedb88320] + [1 << row for row in range(31)]
+        for times in range(3):
+            operator = [self.__multiply(operator, row) for row in operator]
+        result = [1 << row for row in range(32)]
+        while length:
+            if length & 1:
+                result = [self.__multiply(operator, row) for row in result]
+            length >>= 1
+            if length:
+                operator = [self.__multiply(operator, row) for row in operator]
+        return result
+
+    def __compress(self, block, last):
+        compressor = zlib.compressobj(self.__level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+        data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return data, zlib.crc32(block) & 0xffffffff, len(block)
+
+    def __drain(self, last=False):
+        """Compress the pending blocks and write them in order
+
+        Args:
+            last: the last pending block end the deflate stream
+
+        """
+        blocks = self.__pending
+        self.__pending = []
+        lasts = [last and index == len(blocks) - 1 for index in range(len(blocks))]
+        if self.__pool is not None and len(blocks) > 1:
+            results = self.__pool.map(lambda item: self.__compress(*item), zip(blocks, lasts))
+        else:
+            results = [self.__compress(block, flag) for block, flag in zip(blocks, lasts)]
+        for data, crc, length in results:
+            self.__file.write(data)
+            shift = self.__shift if length == self.__blockSize else self.__getShiftOperator(length)
+            self.__crc = self.__multiply(shift, self.__crc) ^ crc
+            self.__size += length
+
+    def write(self, data):
+        """Write uncompressed data
+
+        Args:
+            data: a string
+
+        """
+        if self.__file is None:
+            raise ValueError("I/O operation on closed file")
+        self.__buffer.append(data)
+        self.__buffered += len(data)
+        if self.__buffered >= self.__blockSize:
+            content = "".join(self.__buffer)
+            end = len(content) - len(content) % self.__blockSize
+            self.__pending.extend(content[start:start + self.__blockSize] for start in range(0, end, self.__blockSize))
+            self.__buffer = [content[end:]]
+            self.__buffered = len(content) - end
+            if len(self.__pending) >= BLOCKS_PER_BATCH:
+                self.__drain()
+
+    def read(self, size=-1):
+        raise IOError("File not open for reading")
+
+    def tell(self):
+        """Return the number of uncompressed bytes written"""
+        return self.__size + sum(len(block) for block in self.__pending) + self.__buffered
+
+    def seek(self, offset, whence=0):
+        """Only the current position is reachable, as for any compressed stream being written"""
+        position = {0: offset, 1: self.tell() + offset}.get(whence)
+        if position != self.tell():
+            raise IOError("Cannot seek into a compressed file being written")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Compress the remaining data and write the gzip trailer
+
+        """
+        if self.__file is None:
+            return
+        self.__pending.append("".join(self.__buffer))
+        self.__buffer = []
+        self.__buffered = 0
+        try:
+            self.__drain(last=True)
+            self.__file.write(struct.pack("<II", self.__crc, self.__size & 0xffffffff))
+        finally:
+            self.__file.close()
+            self.__file = None
+            if self.__pool is not None:
+                self.__pool.close()
+                self.__pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class GzipReader(object):
+
+    def __init__(self, filename, chunkSize=1024 * 1024, depth=8):
+        """Read a gzip file, the decompression is done by a background thread
+
+        The inflate of a gzip stream cannot be split between threads, but it run concurrently with the
+        consumer of the data since zlib release the interpreter lock. Concatenated members are supported
+        and the crc of each member is verified by zlib.
+
+        Args:
+            filename: the name of the compressed file
+            chunkSize: the number of compressed bytes read at a time
+            depth: the number of decompressed chunks kept ahead of the consumer
+
+        """
+        self.name = filename
+        self.mode = 'rb'
+        self.__queue = Queue.Queue(depth)
+        self.__data = ""
+        self.__offset = 0
+        self.__position = 0
+        self.__eof = False
+        self.__closed = False
+        self.__thread = threading.Thread(target=self.__inflate, args=(filename, chunkSize))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __inflate(self, filename, chunkSize):
+        try:
+            with __builtin__.open(filename, 'rb') as f:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                for chunk in iter(lambda: f.read(chunkSize), b''):
+                    while chunk:
+                        data = decompressor.decompress(chunk)
+                        if data:
+                            self.__put(data)
+                        chunk = decompressor.unused_data
+                        if chunk:
+                            self.__put(decompressor.flush())
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.__put(decompressor.flush())
+            self.__put(None)
+        except Exception as exception:
+            self.__put(exception)
+
+    def __put(self, item):
+        while not self.__closed:
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def __next(self):
+        """Return the next decompressed chunk, an empty string at the end of the file"""
+        while not self.__eof:
+            item = self.__queue.get()
+            if item is None:
+                self.__eof = True
+            elif isinstance(item, Exception):
+                self.__eof = True
+                raise IOError("Cannot decompress {}: {}".format(self.name, item))
+            elif item:
+                return item
+        return ""
+
+    def read(self, size=-1):
+        """Read uncompressed data
+
+        Args:
+            size: the number of bytes to read, everything if negative
+
+        Returns:
+            a string, shorter than size only at the end of the file
+        """
+        parts = [self.__data[self.__offset:]]
+        length = len(parts[0])
+        while size < 0 or length < size:
+            chunk = self.__next()
+            if not chunk:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        content = "".join(parts)
+        if size < 0 or size >= len(content):
+            self.__data, self.__offset = "", 0
+        else:
+            self.__data, self.__offset = content, size
+            content = content[:size]
+        self.__position += len(content)
+        return content
+
+    def write(self, data):
+        raise IOError("File not open for writing")
+
+    def tell(self):
+        """Return the number of uncompressed bytes read"""
+        return self.__position
+
+    def seek(self, offset, whence=0):
+        """Seek forward by reading, a compressed stream cannot go backward"""
+        position = {0: offset, 1: self.__position + offset}.get(whence)
+        if position is None or position < self.__position:
+            raise IOError("Cannot seek backward into a compressed file")
+        while self.__position < position:
+            if not self.read(min(position - self.__position, 1024 * 1024)):
+                break
+
+    def close(self):
+        self.__closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def open(filename, mode='rb', threads=None, level=6):
+    """Open a gzip file for reading or writing
+
+    Args:
+        filename: the name of the compressed file
+        mode: 'rb' or 'wb'
+        threads: the number of compression threads, see setDefaultThreads
+        level: the compression level
+
+    Returns:
+        a GzipReader or a GzipWriter
+    """
+    if 'w' in mode:
+        return GzipWriter(filename, threads, level)
+    return GzipReader(filename)
+
+
+def compressFile(source, target, threads=None, level=6):
+    """Compress a file
+
+    Args:
+        source: the name of the file to compress
+        target: the name of the compressed file
+        threads: the number of compression threads, see setDefaultThreads
+        level: the compression level
+
+    """
+    with __builtin__.open(source, 'rb') as s:
+        with GzipWriter(target, threads, level) as t:
+            shutil.copyfileobj(s, t, 4 * 1024 * 1024)
+    shutil.copystat(source, target)
+
+
+def decompressFile(source, target):
+    """Decompress a file
+
+    Args:
+        source: the name of the compressed file
+        target: the name of the decompressed file
+
+    """
+    with GzipReader(source) as s:
+        with __builtin__.open(target, 'wb') as t:
+            shutil.copyfileobj(s, t, 4 * 1024 * 1024)
+    shutil.copystat(source, target)
@@ -4,16 +4,9 @@ import functools
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot
-import mpl_toolkits.mplot3d
 import nibabel
 import numpy
 import tempfile
-import dipy.data
-import dipy.reconst.dti
-import dipy.segment.mask
-import dipy.viz.colormap
-import dipy.viz.fvtk 
-from dipy.viz import actor, window
 from lib import util
 
 __author__ = "Christophe Bedetti"
@@ -36,6 +29,8 @@ def imageSlicer(image3dData, minNbrSlices, fov=None):
     Return:
         tuple of lenght 3 with slices along the 3 axis (x, y, z)
     """
+    import dipy.segment.mask
+
     # Computing image width size knowing minimum number of slices
     widthSize = max(image3dData.shape) * minNbrSlices
 
@@ -405,6 +400,8 @@ def plotMovement(parametersFile, targetTranslations, targetRotations):
 def plotVectors(bvecsFile, bvecsCorrected, target, frameFormat='.jpg'):
     """
     """
+    import mpl_toolkits.mplot3d
+
     fig = matplotlib.pyplot.figure(figsize=(4,4))
     ax = mpl_toolkits.mplot3d.Axes3D(fig)
     matplotlib.pyplot.subplots_adjust(
@@ -460,62 +457,105 @@ def plotSigma(sigma, target):
     matplotlib.rcdefaults()
 
 
-def noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist):
+def __loadMask(source, shape):
+    """Load a 3D mask as booleans, padded with empty slices up to the shape of the diffusion volumes"""
+    maskData = nibabel.load(source).get_data() != 0
+    if maskData.shape[2] < shape[2]:
+        padding = numpy.zeros(shape[:2] + (shape[2] - maskData.shape[2],), dtype=bool)
+        maskData = numpy.concatenate((maskData, padding), axis=2)
+    return maskData
+
+
+def noiseStatistics(source, maskNoise, maskCc, bins=40, histRange=(0, 150)):
+    """Compute the signal, the noise and the snr of each volume of a diffusion image
+
+    The volumes are read one at a time, so the memory used is about the size of a single volume
+
+    Args:
+        source: a diffusion weighted image
+        maskNoise: a mask of the background
+        maskCc: a mask of the corpus callosum
+        bins: the number of bins of the noise histogram
+        histRange: the range of the noise histogram
+
+    Returns:
+        a dictionary with the per volume lists signal, signalVoxels, noise, noiseVoxels and snr, and the
+        histogram and edges of the noise of every volume but the first
+    """
+    from lib import nifti
+
+    statistics = {'signal': [], 'signalVoxels': [], 'noise': [], 'noiseVoxels': [], 'snr': []}
+    histogram = numpy.zeros(bins, dtype=numpy.int64)
+    edges = numpy.linspace(histRange[0], histRange[1], bins + 1)
+    masks = None
+    for index, volume in enumerate(nifti.iterVolumes(source)):
+        if masks is None:
+            masks = __loadMask(maskCc, volume.shape), __loadMask(maskNoise, volume.shape)
+        signal = volume[masks[0]].astype(numpy.float64)
+        noise = volume[masks[1]].astype(numpy.float64)
+        statistics['signal'].append(signal.mean() if signal.size else numpy.nan)
+        statistics['signalVoxels'].append(signal.size)
+        statistics['noise'].append(noise.std() if noise.size else numpy.nan)
+        statistics['noiseVoxels'].append(noise.size)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            statistics['snr'].append(statistics['signal'][-1] / statistics['noise'][-1])
+        if index > 0:
+            histogram += numpy.histogram(noise, bins=edges)[0]
+    statistics['histogram'] = histogram
+    statistics['edges'] = edges
+    return statistics
+
+
+def writeNoiseStatistics(statistics, targetTable, targetHistTable):
+    """Write the statistics of noiseStatistics into tab separated files
+
+    Args:
+        statistics: a dictionary as return by noiseStatistics
+        targetTable: the name of the per volume statistics file
+        targetHistTable: the name of the noise histogram file
+
     """
+    with open(targetTable, 'w') as f:
+        f.write("volume\tsignal_mean\tsignal_voxels\tnoise_std\tnoise_voxels\tsnr\n")
+        for index, values in enumerate(zip(statistics['signal'], statistics['signalVoxels'], statistics['noise'],
+                                           statistics['noiseVoxels'], statistics['snr'])):
+            f.write("{}\t{:.6g}\t{}\t{:.6g}\t{}\t{:.6g}\n".format(index, *values))
+    with open(targetHistTable, 'w') as f:
+        f.write("bin_start\tbin_end\tvoxels\n")
+        edges = statistics['edges']
+        for start, end, count in zip(edges[:-1], edges[1:], statistics['histogram']):
+            f.write("{:g}\t{:g}\t{}\n".format(start, end, count))
+
+
+def noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist, targetTable=None, targetHistTable=None):
+    """Plot the snr of each volume of a diffusion image and the histogram of it noise
+
+    Args:
+        source: a diffusion weighted image
+        maskNoise: a mask of the background
+        maskCc: a mask of the corpus callosum
+        targetSnr: the name of the snr plot
+        targetHist: the name of the histogram plot
+        targetTable: an optional tab separated file for the per volume statistics
+        targetHistTable: an optional tab separated file for the noise histogram
+
     """
-    dwiImage = nibabel.load(source)
-    maskNoiseImage = nibabel.load(maskNoise)
-    maskCcImage = nibabel.load(maskCc)
-
-    dwiData = dwiImage.get_data()
-    maskNoiseData = maskNoiseImage.get_data()
-    maskCcData = maskCcImage.get_data()
-
-    volumeNumber = dwiData.shape[3]
-
-    if dwiData.shape[2] != maskNoiseData.shape[2]:
-        zSliceShape = dwiData.shape[:2] + (1,)
-        zMaskNoise = numpy.zeros(zSliceShape, dtype=maskNoiseData.dtype)
-        zCc = numpy.zeros(zSliceShape, dtype=maskCcData.dtype)
-        maskNoiseData = numpy.concatenate((maskNoiseData, zMaskNoise), axis=2)
-        maskCcData = numpy.concatenate((maskCcData, zCc), axis=2)
-
-    #Corpus Callossum masking
-    dwiDataMaskCc = numpy.empty(dwiData.shape)
-    maskCcData4d = numpy.tile(maskCcData,(volumeNumber,1,1,1))
-    maskCcData4d = numpy.rollaxis(maskCcData4d, 0, start=4)
-    dwiDataMaskCc = numpy.ma.masked_where(maskCcData4d == 0, dwiData)
-
-    #Noise masking
-    dwiDataMaskNoise = numpy.empty(dwiData.shape)
-    maskNoise4d = numpy.tile(maskNoiseData,(volumeNumber,1,1,1))
-    maskNoise4d = numpy.rollaxis(maskNoise4d, 0, start=4)
-    dwiDataMaskNoise = numpy.ma.masked_where(maskNoise4d == 0, dwiData)
-
-    #SNR
-    volumeSize = numpy.prod(dwiData.shape[:3])
-    mean_signal = numpy.reshape(dwiDataMaskCc, [volumeSize, volumeNumber])
-    mean_signal = numpy.mean(mean_signal, axis=0)
-    noise_std = numpy.reshape(dwiDataMaskNoise, [volumeSize, volumeNumber])
-    noise_std = numpy.std(noise_std, axis=0)
-
-    SNR = mean_signal / noise_std
-    matplotlib.pyplot.plot(SNR)
+    statistics = noiseStatistics(source, maskNoise, maskCc)
+    if targetTable is not None and targetHistTable is not None:
+        writeNoiseStatistics(statistics, targetTable, targetHistTable)
+
+    matplotlib.pyplot.plot(statistics['snr'])
     matplotlib.pyplot.xlabel('Volumes')
     matplotlib.pyplot.ylabel('SNR')
     matplotlib.pyplot.savefig(targetSnr)
     matplotlib.pyplot.close()
     matplotlib.rcdefaults()
 
-    #Hist plot
-    noiseHistData = dwiDataMaskNoise[:,:,:,1:]
-    noiseHistData = numpy.reshape(
-            noiseHistData, numpy.prod(noiseHistData.shape))
-    num_bins = 40
-    #xlim = numpy.percentile(noiseHistData, 98)
+    #Hist plot, from the histogram accumulated volume by volume
+    edges = statistics['edges']
     matplotlib.pyplot.hist(
-            noiseHistData, num_bins,
-            histtype='stepfilled', facecolor='g', range=[0, 150])
+            edges[:-1], edges, weights=statistics['histogram'],
+            histtype='stepfilled', facecolor='g')
     matplotlib.pyplot.xlabel('Intensity')
     matplotlib.pyplot.ylabel('Voxels number')
     matplotlib.pyplot.savefig(targetHist)
@@ -523,9 +563,41 @@ def noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist):
     matplotlib.rcdefaults()
 
 
+def __noiseAnalysisJob(arguments):
+    noiseAnalysis(*arguments)
+    return arguments[3:]
+
+
+def noiseAnalyses(jobs, nbProcesses=1):
+    """Run many noiseAnalysis concurrently, each of them into it own process
+
+    Args:
+        jobs: a list of tuples of the arguments of noiseAnalysis
+        nbProcesses: the number of analysis run concurrently
+
+    Returns:
+        the list of the targets of each analysis
+    """
+    import multiprocessing
+
+    if nbProcesses > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nbProcesses, len(jobs)))
+        try:
+            return pool.map(__noiseAnalysisJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return [__noiseAnalysisJob(job) for job in jobs]
+
+
 def plotReconstruction(data, mask, cc, target, model):
     """
     """
+    import dipy.data
+    import dipy.reconst.dti
+    import dipy.segment.mask
+    import dipy.viz.fvtk
+
     #Showbox
     maskImage = nibabel.load(mask)
     maskData = maskImage.get_data()
@@ -585,6 +657,9 @@ def plotTrk(trkFile, target, anatFile, roi=None,
         xSlice=None, ySlice=None, zSlice=None,
         xRot=None, yRot=None, zRot=None):
 
+    import dipy.viz.colormap
+    from dipy.viz import actor, window
+
     anatImage = nibabel.load(anatFile)
     trkImage = [s[0] for s in nibabel.trackvis.read(trkFile, points_space='rasmm')[0]]
 
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import numpy
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#number of points scanned at a time while the index of the streamlines is built
+SCAN_SIZE = 16 * 1024 * 1024
+
+#extension appended to the name of a tractogram for the cached index of it streamlines
+INDEX_EXTENSION = ".index.npz"
+
+#numpy datatype of each datatype of the header
+DATATYPES = {'Float32LE': '<f4', 'Float32BE': '>f4', 'Float64LE': '<f8', 'Float64BE': '>f8'}
+
+
+def readHeader(source):
+    """Read the header of a mrtrix .tck tractogram
+
+    Args:
+        source: a .tck filename
+
+    Returns:
+        a dictionary of the fields of the header, count and offset are integers
+    """
+    header = {}
+    with open(source, 'rb') as f:
+        if f.readline().strip() != "mrtrix tracks":
+            raise IOError("{} is not a mrtrix tracks file".format(source))
+        for line in f:
+            line = line.strip()
+            if line == "END":
+                break
+            if ': ' in line:
+                key, value = line.split(': ', 1)
+                header[key] = value.replace("'", "")
+    header['count'] = int(header.get('count', 0))
+    header['offset'] = int(header['file'].replace('.', ''))
+    return header
+
+
+class TckFile(object):
+
+    def __init__(self, source, cache=True):
+        """Read the streamlines of a mrtrix .tck tractogram without loading them
+
+        The points of the tractogram are memory mapped. The offset and the length of each streamline are found in a
+        single vectorized scan over the points, then kept in a compact index that is cached next to the tractogram,
+        so later readers can access any streamline directly. Streamlines are returned as read only views on the
+        points, no data is copied.
+
+        Args:
+            source: a .tck filename
+            cache: read and write the index of the streamlines next to the tractogram, see INDEX_EXTENSION
+
+        """
+        self.__source = source
+        self.__header = readHeader(source)
+        dtype = numpy.dtype(DATATYPES.get(self.__header.get('datatype', 'Float32LE'), '<f4'))
+        nbPoints = (os.path.getsize(source) - self.__header['offset']) // (3 * dtype.itemsize)
+        if nbPoints > 0:
+            self.__points = numpy.memmap(source, dtype=dtype, mode='r', offset=self.__header['offset'], shape=(nbPoints, 3))
+        else:
+            self.__points = numpy.zeros((0, 3), dtype=dtype)
+
+        index = self.__readIndex() if cache else None
+        if index is None:
+            index = self.__buildIndex()
+            if cache:
+                self.__writeIndex(index)
+        self.__offsets, self.__lengths = index
+
+
+    def getHeader(self):
+        """Return the header of the tractogram
+
+        Returns:
+            a dictionary
+        """
+        return self.__header
+
+
+    def getOffsets(self):
+        """Return the index of the first point of each streamline
+
+        Returns:
+            a numpy array of integers
+        """
+        return self.__offsets
+
+
+    def getLengths(self):
+        """Return the number of points of each streamline
+
+        Returns:
+            a numpy array of integers
+        """
+        return self.__lengths
+
+
+    def __len__(self):
+        return len(self.__offsets)
+
+
+    def __getitem__(self, index):
+        offset = self.__offsets[index]
+        return self.__points[offset:offset + self.__lengths[index]]
+
+
+    def __iter__(self):
+        for offset, length in zip(self.__offsets, self.__lengths):
+            yield self.__points[offset:offset + length]
+
+
+    def iterChunks(self, size=100000):
+        """Read the streamlines by batches
+
+        Args:
+            size: the number of streamlines of a batch
+
+        Returns:
+            a generator of (points, offsets, lengths) tuples, points is a view on the points of the batch,
+            including the delimiters, and offsets are relative to it
+        """
+        for start in range(0, len(self), size):
+            offsets = self.__offsets[start:start + size]
+            lengths = self.__lengths[start:start + size]
+            first = offsets[0]
+            yield self.__points[first:offsets[-1] + lengths[-1]], offsets - first, lengths
+
+
+    def __buildIndex(self):
+        """Find the delimiters of the streamlines
+
+        A streamline is terminated by a point of NaN, the tractogram by a point of infinity. A tractogram that is
+        still being written may end with an incomplete streamline, which is ignored.
+
+        Returns:
+            a tuple (offsets, lengths) of numpy arrays
+        """
+        delimiters = []
+        for start in range(0, len(self.__points), SCAN_SIZE):
+            column = numpy.asarray(self.__points[start:start + SCAN_SIZE, 0])
+            found = numpy.flatnonzero(~numpy.isfinite(column))
+            delimiters.append(found + start)
+            ends = numpy.flatnonzero(numpy.isinf(column))
+            if len(ends):
+                delimiters[-1] = delimiters[-1][delimiters[-1] < ends[0] + start]
+                break
+        delimiters = numpy.concatenate(delimiters) if delimiters else numpy.zeros(0, dtype=numpy.int64)
+        offsets = numpy.empty(len(delimiters), dtype=numpy.int64)
+        offsets[:1] = 0
+        offsets[1:] = delimiters[:-1] + 1
+        return offsets, (delimiters - offsets).astype(numpy.int32)
+
+
+    def __getIndexFilename(self):
+        return self.__source + INDEX_EXTENSION
+
+
+    def __getSignature(self):
+        stat = os.stat(self.__source)
+        return numpy.array([stat.st_size, stat.st_mtime])
+
+
+    def __readIndex(self):
+        """Read the cached index, if it is still valid for the tractogram
+
+        Returns:
+            a tuple (offsets, lengths) of numpy arrays, None if there is no valid index
+        """
+        try:
+            with numpy.load(self.__getIndexFilename()) as index:
+                if numpy.array_equal(index['signature'], self.__getSignature()):
+                    return index['offsets'], index['lengths']
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        return None
+
+
+    def __writeIndex(self, index):
+        """Write the index next to the tractogram, atomically. The index is not written into read only directories
+
+        Args:
+            index: a tuple (offsets, lengths) of numpy arrays
+
+        """
+        filename = self.__getIndexFilename()
+        temporary = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                numpy.savez(f, offsets=index[0], lengths=index[1], signature=self.__getSignature())
+            os.rename(temporary, filename)
+        except (IOError, OSError):
+            if os.path.exists(temporary):
+                os.remove(temporary)
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import subprocess
+import collections
+import threading
+import functools
 import datetime
 import termios
 import signal
+import fnmatch
+import errno
 import shutil
 import time
 import glob
@@ -45,20 +50,9 @@ def symlink(source, targetDir, targetName=None):
     if os.path.exists(target):  # Delete target if exist
         os.remove(target)
 
-    targetSplit = target.split(os.path.sep)  # Split with os.path.sep
-    sourceSplit = source.split(os.path.sep)  # Split with os.path.sep
-
-    # Get common Path
-    commonPath = os.path.sep + os.path.join(*os.path.commonprefix((sourceSplit, targetSplit))) + os.path.sep
-
-    source = source.replace(commonPath, '')  # Get ride of the commonPath
-    target = target.replace(os.getcwd() + os.path.sep, '') # Get ride of the commonPath
-
-    deep = target.count(os.path.sep) + 1  # Number of sub_folders
-
-    substring = '..'+os.path.sep  # Substring ../
-
-    source = substring*deep + source  # Relative link
+    # Relative link from the directory of the link, valid whatever the current directory
+    # and even when the link and the source do not share the same parent, as into a scratch directory
+    source = os.path.relpath(source, os.path.dirname(target))
 
     os.symlink(source, target)
     return source
@@ -78,8 +72,45 @@ def copy(source, destination, name):
         shutil.copy(source, os.path.join(destination, name))
 
 
+def getImageExtension(config, publish=False):
+    """Return the extension of the images produced by the tasks
+
+    Intermediate images are stored uncompressed when the intermediate_format option of the general
+    section is nii, so they are read without decompression and memory mapped by nibabel.
+    Published images are always compressed.
+
+    Args:
+        config: A configParser that contain config.cfg information
+        publish: the image is a final output
+
+    Returns:
+        .nii or .nii.gz
+    """
+    if not publish and config.has_option('general', 'intermediate_format') \
+            and config.get('general', 'intermediate_format').strip(".") == "nii":
+        return ".nii"
+    return ".nii.gz"
+
+
+def publishImage(source, target):
+    """Copy an image into it final destination, compressing it if the target is a .gz file
+
+    Args:
+        source: the name of the source image
+        target: the name of the published image
+
+    """
+    if not source:
+        return
+    if target.endswith(".gz") and not source.endswith(".gz"):
+        import pgzip
+        pgzip.compressFile(source, target)
+    else:
+        shutil.copy(source, target)
+
+
 def gunzip(source):
-    """Uncompress a file
+    """Uncompress a file, the compressed file is removed like gunzip do
 
     Args:
         source:  a filename to uncompress
@@ -88,13 +119,16 @@ def gunzip(source):
         the filename resulting from the compression
 
     """
-    cmd = "gunzip {}".format(source)
-    launchCommand(cmd)
-    return source.replace(".gz","")
+    import pgzip
+    target = source.replace(".gz","")
+    pgzip.decompressFile(source, target)
+    os.remove(source)
+    return target
 
 
 def gzip(source):
-    """Compress a file
+    """Compress a file using the threads of the current task, see pgzip.
+    The source file is removed like gzip do
 
     Args:
         source:  a filename to compress
@@ -103,9 +137,351 @@ def gzip(source):
         the filename resulting from the compression
 
     """
-    cmd = "gzip {}".format(source)
-    launchCommand(cmd)
-    return "{}.gz".format(source)
+    import pgzip
+    target = "{}.gz".format(source)
+    pgzip.compressFile(source, target)
+    os.remove(source)
+    return target
+
+
+#callable notified with the result of every command launched, see setCommandObserver
+__commandObserver = None
+
+
+def setCommandObserver(observer):
+    """Register a callable that will be notified with the result of every command launched
+
+    Args:
+        observer: a callable that accept the dictionary return by executeCommand, None to unregister
+
+    Returns:
+        the observer previously registered
+
+    """
+    global __commandObserver
+    previous = __commandObserver
+    __commandObserver = observer
+    return previous
+
+
+#results of the header probes, keyed on the arguments and the size and modification time of the files, see memoizeProbe
+__probes = {}
+
+#sorted content of the directories searched by getImages, keyed on the directory, see __listDirectory
+__directories = {}
+
+#the index is trusted without looking at the directories while the filesystem is not expected to change, see enableGlobCache
+__frozenIndex = False
+
+#number of seconds a directory must be left untouched before it content is indexed. The modification time
+#of a directory have a resolution of a second on many filesystems and is cached by the nfs clients
+INDEX_SETTLE_TIME = 2.0
+
+
+def memoizeProbe(function):
+    """Decorator that memoize a function whose result only depend on the content of the files it receive
+
+    Existing filenames found into the arguments are identified by their size and modification time,
+    so a file rewritten by a task is probed again
+
+    Args:
+        function: a function that accept only hashable arguments
+
+    Returns:
+        the memoized function
+    """
+    @functools.wraps(function)
+    def wrapper(*args):
+        key = [function.__module__, function.__name__]
+        for arg in args:
+            key.append(arg)
+            if isinstance(arg, basestring) and os.path.isfile(arg):
+                stat = os.stat(arg)
+                key.append((stat.st_size, stat.st_mtime))
+        key = tuple(key)
+        if key not in __probes:
+            __probes[key] = function(*args)
+        #callers are free to modify the list they receive
+        result = __probes[key]
+        return list(result) if isinstance(result, list) else result
+    return wrapper
+
+
+def enableGlobCache(enable=True):
+    """Trust the directories index of getImages without looking at the modification time of the directories
+
+    Should only be enable while no files are created, like during the planning of the runnable tasks
+
+    Args:
+        enable: True to reset the index and trust it, False to validate the index on every lookup again
+
+    """
+    global __frozenIndex
+    if enable:
+        __directories.clear()
+    __frozenIndex = enable
+
+
+def invalidateImageIndex(directory=None):
+    """Forget the indexed content of a directory, like when a task completed into it working directory
+
+    Args:
+        directory: the directory to forget, None to forget every directory
+
+    """
+    if directory is None:
+        __directories.clear()
+    else:
+        __directories.pop(os.path.abspath(directory), None)
+
+
+def __listDirectory(directory):
+    """Return the sorted content of a directory using the index
+
+    An indexed directory is listed again when it modification time changed. A directory modified
+    less than INDEX_SETTLE_TIME seconds ago is not indexed since it could change within the same second
+
+    Args:
+        directory: a directory name
+
+    Returns:
+        a sorted list of names, empty if the directory does not exists
+    """
+    key = os.path.abspath(directory)
+    if __frozenIndex and key in __directories:
+        return __directories[key][1]
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return []
+    if key in __directories and __directories[key][0] == mtime:
+        return __directories[key][1]
+    names = sorted(os.listdir(directory))
+    if __frozenIndex or time.time() - mtime > INDEX_SETTLE_TIME:
+        __directories[key] = (mtime, names)
+    return names
+
+
+def __glob(pattern):
+    """glob.glob restricted to patterns on the filename, resolved from the directories index
+
+    Args:
+        pattern: a glob expression whose wildcards are only into the filename
+
+    Returns:
+        a new sorted list of filenames
+    """
+    directory, expression = os.path.split(pattern)
+    if glob.has_magic(directory):
+        return sorted(glob.glob(pattern))
+    #like glob, hidden files only match an expression that start with a dot
+    prefix = "{}/".format(directory) if directory else ""
+    return [prefix + name for name in fnmatch.filter(__listDirectory(directory or os.curdir), expression)
+            if not name.startswith(".") or expression.startswith(".")]
+
+
+#number of lines of output kept by executeCommand when the output is streamed
+TAIL_LENGTH = 200
+
+#seconds a command interrupted with toad is given to exit after SIGTERM, before the SIGKILL
+KILL_GRACE_TIME = 10
+
+
+def __readLines(stream, name, lines, lock, onLine, tail):
+    """Read a stream of a child process line by line until it is closed
+
+    Args:
+        stream: the stdout or stderr pipe of the child process
+        name: 'output' or 'error'
+        lines: a list that receive every line, or a deque bounded to the lines to keep
+        lock: a lock shared by the readers of the same process
+        onLine: a callable notified with (name, line) or None
+        tail: a bounded deque that receive the last lines of both streams, in order of arrival
+
+    """
+    for line in iter(stream.readline, ''):
+        with lock:
+            lines.append(line)
+            tail.append(line)
+            if onLine is not None:
+                onLine(name, line)
+
+
+def __killProcessGroup(pgid, timedOut):
+    """Kill every process of a process group, used when a command timeout
+
+    Args:
+        pgid: the identifier of the process group
+        timedOut: a list where True is appended once the group is killed
+
+    """
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+        timedOut.append(True)
+    except OSError as error:
+        if error.errno != errno.ESRCH:
+            raise
+
+
+def __terminateProcessGroup(pid):
+    """Terminate every process of the process group of a command then reap the command, used when the
+    parent is interrupted while waiting for it
+
+    The group receive SIGTERM, then SIGKILL once KILL_GRACE_TIME seconds have elapsed
+
+    Args:
+        pid: the process identifier of the command, also the identifier of it process group
+
+    """
+    def __signal(signum):
+        try:
+            os.killpg(pid, signum)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    __signal(signal.SIGTERM)
+    deadline = time.time() + KILL_GRACE_TIME
+    reaped = False
+    while not reaped and time.time() < deadline:
+        try:
+            reaped = os.waitpid(pid, os.WNOHANG)[0] != 0
+        except OSError as error:
+            if error.errno == errno.ECHILD:
+                reaped = True
+            elif error.errno != errno.EINTR:
+                raise
+        if not reaped:
+            time.sleep(0.1)
+    #processes spawned by the command may survive it
+    __signal(signal.SIGKILL)
+    while not reaped:
+        try:
+            os.waitpid(pid, 0)
+            reaped = True
+        except OSError as error:
+            if error.errno == errno.ECHILD:
+                reaped = True
+            elif error.errno != errno.EINTR:
+                raise
+
+
+def __startChild(nice):
+    """Executed into the child before the command: move it into its own process group and adjust its niceness
+
+    Args:
+        nice: the increment of niceness
+
+    """
+    os.setpgrp()
+    os.nice(nice)
+
+
+def executeCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0, onLine=None,
+                   tailLength=TAIL_LENGTH):
+    """Execute a program in a new process and measure the resources it consumed
+
+    The command is run into its own process group, so a timeout kill every process it spawned,
+    not only the shell. The child is reaped with wait4 so the cpu times and the peak resident
+    memory reported are those of the command itself, including the processes it waited for.
+
+    When onLine is provided, the output is streamed to it line by line and only the last
+    tailLength lines of each stream are kept in memory.
+
+    Args:
+        command: a string representing a unix command to execute
+        stdout: this attribute is a file object that provides output from the child process
+        stderr: this attribute is a file object that provides error from the child process
+        timeout: Number of seconds before a process is consider inactive, usefull against deadlock
+        nice: run cmd  with  an  adjusted  niceness, which affects process scheduling
+        onLine: a callable notified with ('output' or 'error', line) for every line produced by the command
+        tailLength: the number of lines kept into tail, and into output and error when onLine is provided
+
+    Returns
+        a dictionary with the keys:
+            command, output, error, returncode, timeout,
+            tail (the last lines of both streams, in order of arrival),
+            start (epoch), wall, user, system (seconds) and maxrss (kilobytes)
+
+    Raises
+        OSError:      the function trying to execute a non-existent file.
+        ValueError :  the command line is called with invalid arguments
+
+    """
+    start = time.time()
+    process = subprocess.Popen(cmd, preexec_fn=lambda: __startChild(nice), stdout=stdout, stderr=stderr,
+                               shell=True, bufsize=1)
+
+    lock = threading.Lock()
+    tail = collections.deque(maxlen=tailLength)
+    outputs = {}
+    readers = []
+    for name, stream in [('output', process.stdout), ('error', process.stderr)]:
+        if stream is not None:
+            outputs[name] = collections.deque(maxlen=tailLength) if onLine is not None else []
+            reader = threading.Thread(target=__readLines, args=(stream, name, outputs[name], lock, onLine, tail))
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+
+    timedOut = []
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, __killProcessGroup, args=(process.pid, timedOut))
+        timer.daemon = True
+        timer.start()
+
+    try:
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError as error:
+                if error.errno != errno.EINTR:
+                    raise
+    except BaseException:
+        #the command do not receive the terminal signals sent to toad, it must not survive it
+        __terminateProcessGroup(process.pid)
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    #processes left in the group may still hold the pipes, do not wait forever for them after a timeout
+    for reader in readers:
+        reader.join(5 if timedOut else None)
+    for stream in [process.stdout, process.stderr]:
+        if stream is not None:
+            stream.close()
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+    with lock:
+        output = "".join(outputs['output']) if 'output' in outputs else None
+        error = "".join(outputs['error']) if 'error' in outputs else None
+        tail = list(tail)
+
+    if timedOut:
+        error = "{}Error, a timeout for this process occurred".format(error or "")
+
+    result = {'command': cmd,
+              'output': output,
+              'error': error,
+              'tail': tail,
+              'returncode': process.returncode,
+              'timeout': bool(timedOut),
+              'start': start,
+              'wall': time.time() - start,
+              'user': rusage.ru_utime,
+              'system': rusage.ru_stime,
+              'maxrss': rusage.ru_maxrss}
+
+    if __commandObserver is not None:
+        __commandObserver(result)
+    return result
 
 
 def launchCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
@@ -127,23 +503,8 @@ def launchCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=N
         ValueError :  the command line is called with invalid arguments
 
     """
-
-    start = datetime.datetime.now()
-    process = subprocess.Popen(cmd, preexec_fn=lambda: os.nice(nice), stdout=stdout, stderr=stderr, shell=True)
-
-    if timeout is None:
-        process.wait()
-    else:
-        while process.poll() is None:
-            time.sleep(0.2)
-            now = datetime.datetime.now()
-            if (now - start).seconds > timeout:
-                os.kill(process.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                return None, "Error, a timeout for this process occurred"
-    output = list(process.communicate())
-    output.insert(0,cmd)
-    return tuple(output)
+    result = executeCommand(cmd, stdout, stderr, timeout, nice)
+    return result['command'], result['output'], result['error']
 
 
 def createScript(source, text):
@@ -270,8 +631,15 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
     if extension.find('.') == 0:
         extension=extension.replace(".", "", 1)
 
+    #intermediate images may be stored uncompressed, the lookups of compressed images also match them
+    extensions = [extension]
+    if extension == "nii.gz" and getImageExtension(config) == ".nii":
+        extensions.append("nii")
+
     if postfix is None:
-        images = glob.glob("{}/{}*.{}".format(dir, config.get('prefix', prefix), extension))
+        images = []
+        for ext in extensions:
+            images.extend(__glob("{}/{}*.{}".format(dir, config.get('prefix', prefix), ext)))
     else:
         pfixs = ""
         if isinstance(postfix, str):
@@ -285,11 +653,13 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
                     pfixs = pfixs + config.get('postfix', element)
                 else:
                     pfixs = pfixs + "_{}".format(element)
-        criterias = "{}/{}*{}.{}".format(dir, config.get('prefix',prefix), pfixs, extension)
-        images = glob.glob(criterias)
+        images = []
+        for ext in extensions:
+            criterias = "{}/{}*{}.{}".format(dir, config.get('prefix',prefix), pfixs, ext)
+            images.extend(__glob(criterias))
 
     if len(images) > 0: # Found at least one image
-        return images
+        return sorted(images)
 
     return False
 
@@ -312,16 +682,18 @@ def getImage(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None)
 
     images = getImages(config, dir, prefix, postfix, extension, subdir)
     if images:
-        return images.pop()
+        #images are sorted so the result does not depend on the order of the directory entries
+        return images[0]
 
     return False
 
 
-def buildName(config, target, source, postfix=None, extension=None, absolute=True):
+def buildName(config, target, source, postfix=None, extension=None, absolute=True, publish=False):
     """A simple utility function that return a file name that contain the postfix and the current working directory
 
     The path of the filename contain the current directory
     The extension name will be the same as source unless specify by argument
+    A .nii.gz image is named after the intermediate_format of the config, see getImageExtension
 
     Args:
         config: A configParser that contain config.cfg information
@@ -330,6 +702,7 @@ def buildName(config, target, source, postfix=None, extension=None, absolute=Tru
         postfix: An item or a list of items specified in config at the postfix section
         extension: the Extension of the new target
         absolute: a boolean if the full path must be absolute
+        publish: the file is a final output, images are always compressed
 
     Returns:
         a file name that contain the postfix and the current working directory
@@ -375,6 +748,9 @@ def buildName(config, target, source, postfix=None, extension=None, absolute=Tru
         if extension.find('.') != 0:
             extension = ".{}".format(extension)
 
+    if extension == ".nii.gz" or (publish and extension == ".nii"):
+        extension = getImageExtension(config, publish)
+
     if extension.strip() != ".":
         targetName += extension
 
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+#number of voxels of the largest input evaluated at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Expression(object):
+
+    def __init__(self, operator, operands):
+        """A node of a voxelwise expression over images
+
+        Expressions are built with the usual python operators and the methods of this class, then
+        evaluated by evaluate. A 3D operand is broadcasted along the volumes of a 4D operand like
+        fslmaths do. The computations are done in float, the result keep the datatype of the first image
+        of the expression like fslmaths do, except the comparisons that produce binary images stored as
+        unsigned char like mrcalc do.
+
+        Args:
+            operator: the name of the operation, see OPERATORS
+            operands: a list of Expression or numbers, a filename for an image
+
+        """
+        self.operator = operator
+        self.operands = operands
+
+    def __add__(self, other):
+        return Expression('add', [self, other])
+
+    def __radd__(self, other):
+        return Expression('add', [other, self])
+
+    def __sub__(self, other):
+        return Expression('sub', [self, other])
+
+    def __rsub__(self, other):
+        return Expression('sub', [other, self])
+
+    def __mul__(self, other):
+        return Expression('mul', [self, other])
+
+    def __rmul__(self, other):
+        return Expression('mul', [other, self])
+
+    def __div__(self, other):
+        return Expression('div', [self, other])
+
+    def __rdiv__(self, other):
+        return Expression('div', [other, self])
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+    def eq(self, other):
+        return Expression('eq', [self, other])
+
+    def gt(self, other):
+        return Expression('gt', [self, other])
+
+    def lt(self, other):
+        return Expression('lt', [self, other])
+
+    def bin(self):
+        """Binarise, every non zero voxel become 1, as fslmaths -bin"""
+        return Expression('ne', [self, 0])
+
+    def tmean(self):
+        """Mean along the volumes of a 4D image, as fslmaths -Tmean"""
+        return Expression('tmean', [self])
+
+    def astype(self, dtype):
+        """Store the result with another datatype, as fslmaths -odt
+
+        Args:
+            dtype: the name of a numpy datatype, like float32
+
+        Returns:
+            an Expression
+        """
+        return Expression('astype', [self, dtype])
+
+    def isBinary(self):
+        """Look if this expression produce a binary image
+
+        Returns:
+            True if the expression is a comparison
+        """
+        return self.operator in ['eq', 'ne', 'gt', 'lt']
+
+    def getDataType(self, reference):
+        """Return the datatype of the image produced by this expression
+
+        Args:
+            reference: the datatype of the first image of the expression
+
+        Returns:
+            the name of a numpy datatype
+        """
+        if self.operator == 'astype':
+            return self.operands[1]
+        if self.operator in ['eq', 'gt', 'lt']:
+            return 'uint8'
+        return str(reference)
+
+    def __str__(self):
+        if self.operator == 'image':
+            return self.operands[0]
+        if self.operator == 'astype':
+            return "{}({})".format(self.operands[1], self.operands[0])
+        if self.operator == 'tmean':
+            return "tmean({})".format(self.operands[0])
+        symbols = {'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'eq': '==', 'ne': '!=', 'gt': '>', 'lt': '<'}
+        return "({} {} {})".format(self.operands[0], symbols[self.operator], self.operands[1])
+
+
+def image(filename):
+    """Create an expression that read an image
+
+    Args:
+        filename: the name of a nifti image
+
+    Returns:
+        an Expression
+    """
+    return Expression('image', [filename])
+
+
+def mean(*expressions):
+    """Create the voxelwise mean of many images, as mrmath mean, stored as float
+
+    Args:
+        expressions: Expression or filenames
+
+    Returns:
+        an Expression
+    """
+    operands = [image(expression) if isinstance(expression, basestring) else expression for expression in expressions]
+    return (reduce(lambda total, operand: total + operand, operands) / float(len(operands))).astype('float32')
+
+
+#name of the numpy function of each binary operator
+OPERATORS = {'add': 'add',
+             'sub': 'subtract',
+             'mul': 'multiply',
+             'div': 'divide',
+             'eq': 'equal',
+             'ne': 'not_equal',
+             'gt': 'greater',
+             'lt': 'less'}
+
+
+class __Evaluator(object):
+
+    def __init__(self, outputs, chunkSize):
+        """Evaluate the expressions of evaluate one chunk of slices at a time
+
+        Args:
+            outputs: a list of (Expression, target) tuples
+            chunkSize: the number of voxels evaluated at a time
+
+        """
+        import numpy
+        self.outputs = outputs
+        self.images = {}
+        self.data = {}
+        self.references = {}
+        for expression, target in outputs:
+            self.__collect(expression)
+        shapes = set(image.shape[:3] for image in self.images.values())
+        if len(shapes) != 1:
+            raise ValueError("Images {} do not share the same dimensions".format(", ".join(sorted(self.images))))
+        self.shape = shapes.pop()
+        largest = max(int(numpy.prod(image.shape)) for image in self.images.values())
+        self.step = max(1, chunkSize * self.shape[2] // largest)
+
+    def __collect(self, expression):
+        """Open the images of an expression and count how many times each node is used
+
+        Images are opened once. Uncompressed images are memory mapped by nibabel and read one chunk at
+        a time, compressed images are decompressed once since a gzip stream cannot be read randomly
+        """
+        import nibabel
+        self.references[id(expression)] = self.references.get(id(expression), 0) + 1
+        if self.references[id(expression)] > 1:
+            return
+        if expression.operator == 'image':
+            filename = expression.operands[0]
+            if filename not in self.images:
+                self.images[filename] = nibabel.load(filename)
+                if filename.endswith(".gz"):
+                    self.data[filename] = self.images[filename].get_data()
+                else:
+                    self.data[filename] = self.images[filename].dataobj
+            return
+        for operand in expression.operands:
+            if isinstance(operand, Expression):
+                self.__collect(operand)
+
+    def getReference(self, expression):
+        """Return the first image read by an expression, it header is used for the output"""
+        if expression.operator == 'image':
+            return self.images[expression.operands[0]]
+        for operand in expression.operands:
+            if isinstance(operand, Expression):
+                return self.getReference(operand)
+        raise ValueError("Expression {} do not read any image".format(expression))
+
+    def chunks(self):
+        for start in range(0, self.shape[2], self.step):
+            yield start, min(start + self.step, self.shape[2])
+
+    def evaluate(self, expression, start, stop, cache):
+        """Evaluate an expression over the slices start to stop
+
+        Intermediate results used only once are overwritten in place by the next operation,
+        so a chain of operations allocate a single temporary array per chunk
+
+        Args:
+            expression: an Expression
+            start: the first slice
+            stop: the slice after the last one
+            cache: a dictionary of (result, owned) already computed for this chunk
+
+        Returns:
+            a tuple (numpy array or number, True if the array may be overwritten)
+        """
+        import numpy
+        if not isinstance(expression, Expression):
+            return expression, False
+        if id(expression) in cache:
+            return cache[id(expression)]
+
+        if expression.operator == 'image':
+            data = self.data[expression.operands[0]][:, :, start:stop]
+            value = numpy.array(data, dtype=numpy.float32, copy=False)
+            #a view on the data of a compressed image must never be overwritten
+            owned = not (isinstance(data, numpy.ndarray) and numpy.may_share_memory(value, data))
+            result = value, owned and self.references[id(expression)] == 1
+        elif expression.operator == 'tmean':
+            value, owned = self.evaluate(expression.operands[0], start, stop, cache)
+            if value.ndim > 3:
+                value, owned = value.mean(axis=3, dtype=numpy.float32), True
+            result = value, owned and self.references[id(expression)] == 1
+        elif expression.operator == 'astype':
+            value, owned = self.evaluate(expression.operands[0], start, stop, cache)
+            result = value, owned and self.references[id(expression)] == 1
+        else:
+            (left, leftOwned), (right, rightOwned) = [self.evaluate(operand, start, stop, cache)
+                                                    for operand in expression.operands]
+            left, right = self.__align(left, right)
+            shape = numpy.broadcast(left, right).shape
+            out = None
+            if not expression.isBinary():
+                for value, owned in [(left, leftOwned), (right, rightOwned)]:
+                    if owned and value.shape == shape and value.dtype == numpy.float32:
+                        out = value
+                        break
+            if expression.operator == 'div':
+                value = self.__divide(left, right, out)
+            else:
+                value = getattr(numpy, OPERATORS[expression.operator])(left, right, out=out)
+            result = value, self.references[id(expression)] == 1
+
+        cache[id(expression)] = result
+        return result
+
+    def __divide(self, numerator, denominator, out):
+        """Divide, the voxels divided by zero are set to zero like fslmaths do"""
+        import numpy
+        zeros = numpy.asarray(denominator) == 0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = numpy.divide(numerator, denominator, out=out)
+        result[numpy.broadcast_to(zeros, result.shape)] = 0
+        return result
+
+    def __align(self, left, right):
+        """Append axes to the operand of lower dimension, so a 3D image apply to every volume of a 4D image"""
+        import numpy
+        leftDims, rightDims = numpy.ndim(left), numpy.ndim(right)
+        if 0 < leftDims < rightDims:
+            left = left.reshape(left.shape + (1,) * (rightDims - leftDims))
+        elif 0 < rightDims < leftDims:
+            right = right.reshape(right.shape + (1,) * (leftDims - rightDims))
+        return left, right
+
+
+def __cast(value, dtype):
+    """Convert a float result to the datatype of the output, integers are rounded and clipped to their range"""
+    import numpy
+    if numpy.issubdtype(dtype, numpy.integer) and numpy.issubdtype(numpy.asarray(value).dtype, numpy.floating):
+        limits = numpy.iinfo(dtype)
+        value = numpy.clip(numpy.rint(value), limits.min, limits.max)
+    return value
+
+
+def evaluate(outputs, chunkSize=CHUNK_SIZE):
+    """Evaluate many voxelwise expressions in a single pass over their images
+
+    The images are read once, a chunk of slices at a time, every expression is evaluated on the chunk
+    then the results are written together once every chunk is computed. The outputs keep the
+    header and the datatype of the first image of their expression, see Expression.getDataType.
+
+    Args:
+        outputs: a list of (Expression, target) tuples
+        chunkSize: the number of voxels evaluated at a time
+
+    Returns:
+        the list of the targets written
+    """
+    import nibabel
+    import numpy
+    import mriutil
+
+    evaluator = __Evaluator(outputs, chunkSize)
+    results = [None] * len(outputs)
+    for start, stop in evaluator.chunks():
+        cache = {}
+        for index, (expression, target) in enumerate(outputs):
+            value = evaluator.evaluate(expression, start, stop, cache)[0]
+            if results[index] is None:
+                dtype = numpy.dtype(expression.getDataType(evaluator.getReference(expression).get_data_dtype()))
+                results[index] = numpy.empty(value.shape[:2] + (evaluator.shape[2],) + value.shape[3:], dtype)
+            results[index][:, :, start:stop] = __cast(value, results[index].dtype)
+
+    for (expression, target), data in zip(outputs, results):
+        reference = evaluator.getReference(expression)
+        header = reference.header.copy()
+        header.set_data_dtype(data.dtype)
+        mriutil.saveImage(nibabel.Nifti1Image(data, reference.affine, header), target)
+    return [target for expression, target in outputs]
+
+
+def describe(outputs):
+    """Describe expressions the way a command line would be logged
+
+    Args:
+        outputs: a list of (Expression, target) tuples
+
+    Returns:
+        a string
+    """
+    return "; ".join("{} = {}".format(target, expression) for expression, target in outputs)
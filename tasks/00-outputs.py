@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib import util
@@ -23,7 +25,7 @@ class Outputs(GenericTask):
                     'mask': self.getRegistrationImage('mask', 'resample')}
 
         for postfix, image in structs.iteritems():
-           util.copy(image, self.workingDir,  self.buildName(self.subject.getName(), postfix, 'nii.gz'))
+           util.publishImage(image, os.path.join(self.workingDir, self.buildName(self.subject.getName(), postfix, 'nii.gz', publish=True)))
 
         for extension in ['bvals', 'bvecs', 'benc']:
             util.copy(self.getUpsamplingImage('grad', None, extension),
@@ -41,8 +43,8 @@ class Outputs(GenericTask):
         for software in softwares:
             for postfix in postfixs:
                 source = getattr(self, "get{}{}Image".format(method, software))("dwi", postfix)
-                target = self.buildName(self.subject.getName(), [software, postfix], 'nii.gz')
-                util.copy(source, self.workingDir, target)
+                target = self.buildName(self.subject.getName(), [software, postfix], 'nii.gz', publish=True)
+                util.publishImage(source, os.path.join(self.workingDir, target))
 
 
     def meetRequirement(self):
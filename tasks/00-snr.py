@@ -1,8 +1,4 @@
 # -*- coding: utf-8 -*-
-import numpy
-import nibabel
-import scipy.ndimage.morphology
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib import mriutil
@@ -38,20 +34,6 @@ class Snr(GenericTask):
         self.launchCommand(cmd)
 
 
-    def __noiseAnalysis(self, dwi, noiseMask, ccMask, qaImages, description):
-        """
-
-        """
-        snrPng = self.buildName(dwi, 'snr', 'png')
-        histPng = self.buildName(dwi, 'hist', 'png')
-        self.noiseAnalysis(dwi, noiseMask, ccMask, snrPng, histPng)
-        qaImages.extend(Images(
-            (snrPng, '{} DWI image: SNR for each volume'.format(description)),
-            (histPng, '{} DWI image: noise histogram'.format(description)),
-            ))
-        return qaImages
-
-
     def isIgnore(self):
         return True#self.get("ignore")
 
@@ -94,9 +76,14 @@ class Snr(GenericTask):
             (dwiDenoised, 'denoised'),
             (dwiCorrected, 'Corrected'),
             )
-        for dwi, description in tags:
-            if dwi:
-                qaImages = self.__noiseAnalysis(dwi, noiseMask, ccMask, qaImages, description)
+        tags = [(dwi, description) for dwi, description in tags if dwi]
+        #the three diffusion images are analysed concurrently, each of them volume by volume
+        targets = self.noiseAnalyses([dwi for dwi, description in tags], noiseMask, ccMask, int(self.getNTreads()))
+        for (dwi, description), (snrPng, histPng) in zip(tags, targets):
+            qaImages.extend(Images(
+                (snrPng, '{} DWI image: SNR for each volume'.format(description)),
+                (histPng, '{} DWI image: noise histogram'.format(description)),
+                ))
 
         #Build qa masks images
         tags = (
@@ -2,11 +2,6 @@
 import os
 import random
 
-import numpy
-import scipy
-import scipy.ndimage
-import nibabel
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib import util, mriutil
@@ -49,6 +44,9 @@ class Parcellation(GenericTask):
 
     def __mergeParcellation(self, wmparcFile, aparcFile, brainstemFile, lhHippFile, rhHippFile):
 
+        import nibabel
+        from lib import labels
+
         wmparc = nibabel.load(wmparcFile)
         aparc = nibabel.load(aparcFile)
         brainstem = nibabel.load(brainstemFile)
@@ -62,58 +60,41 @@ class Parcellation(GenericTask):
         rhHippData = rhHipp.get_data()
 
 
-        # Replace Left-Hipp (17) and Right-Hipp (53) to WM
-        for leftValue in [17]:
-            aparcData[aparcData == leftValue] = 2
-            wmparcData[wmparcData == leftValue] = 5001
-        for rightValue in [53]:
-            aparcData[aparcData == rightValue] = 41
-            wmparcData[wmparcData == rightValue] = 5002
-
-        # Remove brainstem(16)
-        for brainstemValue in [16]:
-            aparcData[aparcData == brainstemValue] = 0
-            wmparcData[wmparcData == brainstemValue] = 0
-
-        aparcData[brainstemData != 0] =  brainstemData[brainstemData != 0]
-        wmparcData[brainstemData != 0] =  brainstemData[brainstemData != 0]
-
-        lhHippData[lhHippData == 204] = 554 # presubiculum
-        rhHippData[rhHippData == 204] = 504 # presubiculum
-        lhHippData[lhHippData == 205] = 557 # subiculum
-        rhHippData[rhHippData == 205] = 507 # subiculum
-        lhHippData[lhHippData == 206] = 552 # CA1
-        rhHippData[rhHippData == 206] = 502 # CA1
-        lhHippData[lhHippData == 208] = 550 # CA3
-        rhHippData[rhHippData == 208] = 500 # CA3
-        lhHippData[lhHippData == 209] = 556 # CA4
-        rhHippData[rhHippData == 209] = 506 # CA4
-        lhHippData[lhHippData == 212] = 553 # fimbria
-        rhHippData[rhHippData == 212] = 503 # fimbria
-        lhHippData[lhHippData == 215] = 555 # Hipp Fissure
-        rhHippData[rhHippData == 215] = 505 # Hipp Fissure
-
-        # Invented
-        lhHippData[lhHippData == 203] = 559 # Parasubiculum
-        rhHippData[rhHippData == 203] = 509 # Parasubiculum
-        lhHippData[lhHippData == 210] = 560 # GC-DC
-        rhHippData[rhHippData == 210] = 510 # GC-DC
-        lhHippData[lhHippData == 211] = 561 # HATA
-        rhHippData[rhHippData == 211] = 511 # HATA
-        lhHippData[lhHippData == 214] = 562 # Molecular Layer
-        rhHippData[rhHippData == 214] = 512 # Molecular Layer
-        lhHippData[lhHippData == 226] = 563 # Hipp Tail
-        rhHippData[rhHippData == 226] = 513 # Hipp Tail
-
-        aparcData[rhHippData != 0] =  rhHippData[rhHippData != 0]
-        aparcData[lhHippData != 0] =  lhHippData[lhHippData != 0]
-        wmparcData[rhHippData != 0] =  rhHippData[rhHippData != 0]
-        wmparcData[lhHippData != 0] =  lhHippData[lhHippData != 0]
-
-        nibabel.Nifti1Image(lhHippData, lhHipp.affine, lhHipp.header).to_filename(lhHippFile)
-        nibabel.Nifti1Image(rhHippData, rhHipp.affine, rhHipp.header).to_filename(rhHippFile)
-        nibabel.Nifti1Image(wmparcData, wmparc.affine, wmparc.header).to_filename(wmparcFile)
-        nibabel.Nifti1Image(aparcData, aparc.affine, aparc.header).to_filename(aparcFile)
+        # Replace Left-Hipp (17) and Right-Hipp (53) to WM and remove brainstem(16)
+        aparcData = labels.remap(aparcData, {17: 2, 53: 41, 16: 0})
+        wmparcData = labels.remap(wmparcData, {17: 5001, 53: 5002, 16: 0})
+
+        labels.overlay(aparcData, brainstemData)
+        labels.overlay(wmparcData, brainstemData)
+
+        hippocampalSubfields = {204: 554, # presubiculum
+                                205: 557, # subiculum
+                                206: 552, # CA1
+                                208: 550, # CA3
+                                209: 556, # CA4
+                                212: 553, # fimbria
+                                215: 555, # Hipp Fissure
+                                # Invented
+                                203: 559, # Parasubiculum
+                                210: 560, # GC-DC
+                                211: 561, # HATA
+                                214: 562, # Molecular Layer
+                                226: 563} # Hipp Tail
+        # the right hemisphere labels are those of the left minus 50
+        lhHippData = labels.remap(lhHippData, hippocampalSubfields)
+        rhHippData = labels.remap(rhHippData, dict((key, value - 50) for key, value in hippocampalSubfields.items()))
+
+        for hippData in [rhHippData, lhHippData]:
+            labels.overlay(aparcData, hippData)
+            labels.overlay(wmparcData, hippData)
+
+        #remap may have promoted the datatype so the new labels fit, the headers must declare it
+        for hipp, hippData, hippFile in [(lhHipp, lhHippData, lhHippFile), (rhHipp, rhHippData, rhHippFile)]:
+            header = hipp.header.copy()
+            header.set_data_dtype(hippData.dtype)
+            mriutil.saveImage(nibabel.Nifti1Image(hippData, hipp.affine, header), hippFile)
+        mriutil.saveImage(nibabel.Nifti1Image(wmparcData, wmparc.affine, wmparc.header), wmparcFile)
+        mriutil.saveImage(nibabel.Nifti1Image(aparcData, aparc.affine, aparc.header), aparcFile)
 
 
     def __findAndLinkFreesurferStructure(self):
@@ -197,6 +178,11 @@ class Parcellation(GenericTask):
         :return:
         """
 
+        import nibabel
+        import numpy
+        import scipy.ndimage
+        from lib import labels
+
         subjectDir = os.path.join(self.workingDir, self.id)
         aparcAseg = self.__findImageInDirectory("aparc+aseg.mgz", subjectDir)
         lhHippFile = self.__findImageInDirectory("lh.hippo", subjectDir)
@@ -305,10 +291,7 @@ class Parcellation(GenericTask):
             return pve
 
         def group_rois(rois_ids):
-            m = numpy.zeros(parc.shape, dtype=numpy.bool)
-            for i in rois_ids:
-                numpy.logical_or(parc_data == i, m, m)
-            return m
+            return labels.isin(parc_data, rois_ids)
 
         parc = nibabel.load(aparcAseg)
         parc_data = parc.get_data()
@@ -461,7 +444,7 @@ class Parcellation(GenericTask):
         tt5 /= tt5.sum(-1)[..., numpy.newaxis]
         tt5[numpy.isnan(tt5)] = 0
 
-        nibabel.save(nibabel.Nifti1Image(tt5.astype(numpy.float32), parc.get_affine()), target)
+        mriutil.saveImage(nibabel.Nifti1Image(tt5.astype(numpy.float32), parc.get_affine()), target)
         return target
 
     def __findImageInDirectory(self, image, freesurferDirectory):
@@ -488,11 +471,15 @@ class Parcellation(GenericTask):
             target: The name of the resulting output file name
         """
 
+        import nibabel
+        import numpy
+        import scipy.ndimage
+
         nii = nibabel.load(source)
         op = ((numpy.mgrid[:5, :5, :5]-2.0)**2).sum(0) <= 4
         mask = scipy.ndimage.binary_closing(nii.get_data() > 0, op, iterations=2)
         scipy.ndimage.binary_fill_holes(mask, output=mask)
-        nibabel.save(nibabel.Nifti1Image(mask.astype(numpy.uint8), nii.get_affine()), target)
+        mriutil.saveImage(nibabel.Nifti1Image(mask.astype(numpy.uint8), nii.get_affine()), target)
         del nii, mask, op
         return target
 
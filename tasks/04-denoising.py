@@ -1,11 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
 
-import numpy
-import nibabel
-import dipy.denoise.nlmeans
-import dipy.denoise.noise_estimate
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib import util, mriutil
@@ -29,6 +24,10 @@ class Denoising(GenericTask):
     def implement(self):
 
 
+        import nibabel
+        import numpy
+        import dipy.denoise.nlmeans
+
         dwi = self.getPreparationImage("dwi")
         bVals = self.getPreparationImage('grad',  None, 'bvals')
         norm=   self.getParcellationImage('norm')
@@ -62,8 +61,7 @@ class Denoising(GenericTask):
             residuals = self.buildName(dwi, "residuals")
             noise = self.getImage("dwi","noise")
 
-            cmd = "mrcalc {} {} -subtract {} -nthreads {} -quiet".format(dwi, noise, residuals, self.getNTreadsMrtrix())
-            self.launchCommand(cmd)
+            self.info(mriutil.fslmaths(dwi, residuals, 'sub', noise))
 
         elif self.get("algorithm") == "nlmeans":
 
@@ -85,7 +83,7 @@ class Denoising(GenericTask):
                 #denoisingData = dipy.denoise.nlmeans.nlmeans(dwiData, sigma)
                 #nibabel.save(nibabel.Nifti1Image(piesnoNoiseMask.astype(numpy.float32),dwiImage.get_affine()), self.buildName(target, "piesno_noise_mask"))
 
-            nibabel.save(nibabel.Nifti1Image(denoisingData.astype(numpy.float32), dwiImage.get_affine()), target)
+            mriutil.saveImage(nibabel.Nifti1Image(denoisingData.astype(numpy.float32), dwiImage.get_affine()), target)
 
         elif self.get('general', 'matlab_available'):
             dwiUncompress = self.uncompressImage(dwi)
@@ -147,6 +145,9 @@ class Denoising(GenericTask):
             and a mask identyfing all the pure noise voxel that were found.
         """
 
+        import numpy
+        import dipy.denoise.noise_estimate
+
         try:
             numberArrayCoil = int(self.get("number_array_coil"))
         except ValueError:
@@ -2,18 +2,14 @@
 import os
 import math
 
-import matplotlib
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
-from lib import util, mriutil
+from lib import util, mriutil, voxelmath
 
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers", "Basile Pinsard"]
 
-matplotlib.use('Agg')
-
 
 class Correction(GenericTask):
     def __init__(self, subject):
@@ -105,7 +101,12 @@ class Correction(GenericTask):
             acqpTopup = self.__createAcquisitionParameterFile('topup')
 
             # Run topup on concatenate B0 image
-            [topupBaseName, topupImage] = self.__topup(concatenateB0Image, acqpTopup, topupConfigFile)
+            topupOutputs = [os.path.join(self.workingDir, self.__getTopupImageName()),
+                            os.path.join(self.workingDir, "{}_fieldcoef{}".format(self.get('topup_results_base_name'),
+                                                                                 util.getImageExtension(self.config))),
+                            os.path.join(self.workingDir, "{}_movpar.txt".format(self.get('topup_results_base_name')))]
+            [topupBaseName, topupImage] = self.step("topup", [concatenateB0Image, acqpTopup, topupConfigFile], topupOutputs,
+                                                    self.__topup, concatenateB0Image, acqpTopup, topupConfigFile)
             b0Image = self.__fslmathsTmean(os.path.join(self.workingDir, topupImage))
             self.set('method', 'topup')
 
@@ -127,7 +128,11 @@ class Correction(GenericTask):
         # Create an index file
         indexFile = self.__createIndexFile(mriutil.getNbDirectionsFromDWI(dwi))
 
-        outputImage = self.__correctionEddy(dwi, mask, topupBaseName, indexFile, acqpEddy, bVecs, bVals, bEnc)
+        eddyInputs = [dwi, mask, indexFile, acqpEddy, bVecs, bVals, bEnc]
+        if topupBaseName is not None:
+            eddyInputs.extend(topupOutputs)
+        outputImage = self.step("eddy", eddyInputs, [self.buildName(dwi, "eddy")],
+                                self.__correctionEddy, dwi, mask, topupBaseName, indexFile, acqpEddy, bVecs, bVals, bEnc)
 
         eddyParameterFiles = self.getImage('dwi', None, 'eddy_parameters')
 
@@ -321,13 +326,17 @@ class Correction(GenericTask):
 
         self.info("Launch topup from fsl.\n")
         baseName = os.path.join(self.workingDir, self.get('topup_results_base_name'))
-        output = os.path.join(self.workingDir, self.get('topup_results_output'))
+        output = os.path.join(self.workingDir, self.__getTopupImageName())
 
         cmd = "topup --imain={} --datain={} --config={} --out={}  --iout={}" \
             .format(source, acqp, b02b0File, baseName, output)
         self.launchCommand(cmd)
         return [baseName, output]
 
+    def __getTopupImageName(self):
+        # topup write it images in the format of the intermediate images, whatever the extension it receive
+        return self.get('topup_results_output').replace(".nii.gz", util.getImageExtension(self.config))
+
     def __fslmathsTmean(self, source):
 
         target = source.replace(".nii", "_tmean.nii")
@@ -477,8 +486,7 @@ class Correction(GenericTask):
         except ValueError:
             deltaTE = 0.00246
 
-        cmd = "fslmaths {} -mul {} -div {} {} -odt float".format(source, math.pi, 4096 * deltaTE, target)
-        self.launchCommand(cmd)
+        self.info(mriutil.voxelwise([(voxelmath.image(source) * math.pi / (4096 * deltaTE), target)]))
 
         return target
 
@@ -517,8 +525,7 @@ class Correction(GenericTask):
     def __computeMap(self, source, mask, prefix):
 
         target = self.buildName(source, prefix)
-        cmd = "fslmaths {} -mul {} {}".format(source, mask, target)
-        self.launchCommand(cmd)
+        self.info(mriutil.fslmaths(source, target, 'mul', mask))
         return target
 
     def __computeForwardDistorsion(self, source, lossyImage, mask):
@@ -32,28 +32,16 @@ class Registration(GenericTask):
             extraArgs += " -usesqform "
 
         freesurferToDWIMatrix = self.__freesurferToDWITransformation(b0, norm, extraArgs)
-        mriutil.applyResampleFsl(anat, b0, freesurferToDWIMatrix, self.buildName(anat, "resample"))
         mrtrixMatrix = self.__transformFslToMrtrixMatrix(anat, b0, freesurferToDWIMatrix)
 
-        """ Grey matter parcellation """
-        mriutil.applyRegistrationMrtrix(aparcAsegFile, mrtrixMatrix, self.buildName(aparcAsegFile, "register"))
-        mriutil.applyResampleFsl(aparcAsegFile, b0, freesurferToDWIMatrix, self.buildName(aparcAsegFile, "resample"), True)
+        """ Grey matter parcellation, white matter parcellation and the other freesurfer images """
+        images = [aparcAsegFile, wmparcFile, lhRibbon, rhRibbon, tt5, mask, norm]
+        mriutil.applyRegistrationsMrtrix([(image, self.buildName(image, "register")) for image in images], mrtrixMatrix)
 
-        """ White matter parcellation """
-        mriutil.applyRegistrationMrtrix(wmparcFile, mrtrixMatrix, self.buildName(wmparcFile, "register"))
-        mriutil.applyResampleFsl(wmparcFile, b0, freesurferToDWIMatrix, self.buildName(wmparcFile, "resample"), True)
-
-        lhRibbonRegister = mriutil.applyRegistrationMrtrix(lhRibbon, mrtrixMatrix, self.buildName(lhRibbon, "register"))
-        rhRibbonRegister = mriutil.applyRegistrationMrtrix(rhRibbon, mrtrixMatrix, self.buildName(rhRibbon, "register"))
-        tt5Register = mriutil.applyRegistrationMrtrix(tt5, mrtrixMatrix, self.buildName(tt5, "register"))
-        maskRegister = mriutil.applyRegistrationMrtrix(mask, mrtrixMatrix, self.buildName(mask, "register"))
-        normRegister = mriutil.applyRegistrationMrtrix(norm, mrtrixMatrix, self.buildName(norm, "register"))
-
-        mriutil.applyResampleFsl(lhRibbon, b0, freesurferToDWIMatrix, self.buildName(lhRibbon, "resample"),True)
-        mriutil.applyResampleFsl(rhRibbon, b0, freesurferToDWIMatrix, self.buildName(rhRibbon, "resample"),True)
-        mriutil.applyResampleFsl(tt5, b0, freesurferToDWIMatrix, self.buildName(tt5, "resample"),True)
-        mriutil.applyResampleFsl(mask, b0, freesurferToDWIMatrix, self.buildName(mask, "resample"),True)
-        mriutil.applyResampleFsl(norm, b0, freesurferToDWIMatrix, self.buildName(norm, "resample"),True)
+        #every image share the freesurfer grid, the voxel mapping is computed once for all of them
+        resamples = [(anat, self.buildName(anat, "resample"), False)]
+        resamples.extend([(image, self.buildName(image, "resample"), True) for image in images])
+        mriutil.applyResamplesFsl(resamples, b0, freesurferToDWIMatrix, self.getNTreadsMrtrix())
 
         #brodmannLRegister =  self.buildName(brodmannRegister, "left_hemisphere")
         #brodmannRRegister =  self.buildName(brodmannRegister, "right_hemisphere")
@@ -64,8 +52,7 @@ class Registration(GenericTask):
 
     def __multiply(self, source, ribbon, target):
 
-        cmd = "mrcalc {} {} -mult {} -quiet".format(source, ribbon, target)
-        self.launchCommand(cmd)
+        self.info(mriutil.fslmaths(source, target, 'mul', ribbon))
         return target
 
 
@@ -22,14 +22,10 @@ class Atlasregistration(GenericTask):
         aal2 = self.getAtlasImage("aal2")
         networks7 = self.getAtlasImage("networks7")
 
-        brodmannRegister = mriutil.applyRegistrationMrtrix(brodmann, mrtrixMatrix, self.buildName(brodmann, "register"))
-        mriutil.applyResampleFsl(brodmann, b0, freesurferToDWI, self.buildName(brodmann, "resample"), True)
-
-        aal2Register = mriutil.applyRegistrationMrtrix(aal2, mrtrixMatrix, self.buildName(aal2, "register"))
-        mriutil.applyResampleFsl(aal2, b0, freesurferToDWI, self.buildName(aal2, "resample"), True)
-
-        networks7Register = mriutil.applyRegistrationMrtrix(networks7, mrtrixMatrix, self.buildName(networks7, "register"))
-        mriutil.applyResampleFsl(networks7, b0, freesurferToDWI, self.buildName(networks7, "resample"), True)
+        atlases = [brodmann, aal2, networks7]
+        mriutil.applyRegistrationsMrtrix([(atlas, self.buildName(atlas, "register")) for atlas in atlases], mrtrixMatrix)
+        mriutil.applyResamplesFsl([(atlas, self.buildName(atlas, "resample"), True) for atlas in atlases],
+                                  b0, freesurferToDWI, self.getNTreadsMrtrix())
 
 
     def meetRequirement(self):
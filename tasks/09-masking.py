@@ -32,16 +32,18 @@ class Masking(GenericTask):
         seed_gmwmi = self.__launch5tt2gmwmi(tt5Register)
 
         #create a area 253 mask and a 1014 mask
-        self.info(mriutil.mrcalc(aparcAsegResample, '253', self.buildName('aparc_aseg', ['253', 'mask'], 'nii.gz')))
-        self.info(mriutil.mrcalc(aparcAsegResample, '1024', self.buildName('aparc_aseg', ['1024', 'mask'],'nii.gz')))
+        structures = [([253], self.buildName('aparc_aseg', ['253', 'mask'], 'nii.gz')),
+                      ([1024], self.buildName('aparc_aseg', ['1024', 'mask'],'nii.gz'))]
 
         #produce optionnal mask
-        if self.get("start_seeds").strip():
-            self.__createRegionMaskFromAparcAseg(aparcAsegResample, 'start')
-        if self.get("stop_seeds").strip():
-            self.__createRegionMaskFromAparcAseg(aparcAsegResample, 'stop')
-        if self.get("exclude_seeds").strip():
-            self.__createRegionMaskFromAparcAseg(aparcAsegResample, 'exclude')
+        for operand in ['start', 'stop', 'exclude']:
+            if self.get("{}_seeds".format(operand)).strip():
+                structures.extend(self.__getRegionStructures(aparcAsegResample, operand))
+
+        #every structure is extracted in a single pass over the atlas, the size and the extent of each area are kept for qa
+        statistics = self.buildName(aparcAsegResample, 'labels', 'tsv')
+        for target in mriutil.extractStructures(aparcAsegResample, structures, statistics):
+            self.info("Extracted {}".format(target))
 
         #extract the white matter mask from the act
         whiteMatterAct = self.__extractWhiteMatterFrom5tt(tt5Resample)
@@ -51,16 +53,23 @@ class Masking(GenericTask):
         shutil.copy(colorLut, self.workingDir)
 
 
-    def __createRegionMaskFromAparcAseg(self, source, operand):
+    def __getRegionStructures(self, source, operand):
+        """Define the images of the regions listed into a seeds option
+
+        Args:
+            source: the parcellation atlas
+            operand: start, stop or exclude
 
+        Returns:
+            a list of (regions, target) tuples for the extracted regions and their mask
+        """
         option = "{}_seeds".format(operand)
         self.info("Extract {} regions from {} image".format(operand, source))
         regions = util.arrayOfInteger(self.get( option))
         self.info("Regions to extract: {}".format(regions))
 
         target = self.buildName(source, [operand, "extract"])
-        structures = mriutil.extractStructure(regions, source, target)
-        self.__createMask(structures)
+        return [(regions, target), (regions, self.buildName(target, 'mask'))]
 
 
     def __extractWhiteMatterFrom5tt(self, source):
@@ -104,11 +113,6 @@ class Masking(GenericTask):
         return self.rename(tmp, target)
 
 
-    def __createMask(self, source):
-        self.info("Create mask from {} images".format(source))
-        self.info(mriutil.fslmaths(source, self.buildName(source, 'mask'), 'bin'))
-
-
     def meetRequirement(self):
         return Images((self.getRegistrationImage("aparc_aseg", "resample"), 'resampled parcellation atlas'),
                     (self.getRegistrationImage("aparc_aseg", "register"), 'register parcellation atlas'),
@@ -1,12 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
-import amico
 
-amico.core.setup()
 
 from core.toad.generictask import GenericTask
 from lib.images import Images
-from lib import util
+from lib import util, mriutil, voxelmath
 from lib.mriutil import getBValues
 import shutil
 
@@ -87,7 +85,8 @@ class TensorFsl(GenericTask):
             os.rename(src, dst)
 
     def __fitNODDI(self, dwi, bVals, bVecs, bEnc, mask):
-
+        import amico
+        amico.core.setup()
 
         BValues = getBValues(dwi, bEnc)
         # Init amico
@@ -105,8 +104,7 @@ class TensorFsl(GenericTask):
         ae.save_results()
 
     def __mean(self, source1, source2, target):
-        cmd = "fslmaths {} -add {} -div 2 {}".format(source1, source2, target)
-        self.launchCommand(cmd)
+        self.info(mriutil.voxelwise([(voxelmath.mean(source1, source2), target)]))
 
     def isIgnore(self):
         return self.get("ignore")
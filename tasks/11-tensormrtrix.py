@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from core.toad.generictask import GenericTask
 from lib.images import Images
+from lib import mriutil, voxelmath
 
 __author__ = "Mathieu Desrosiers, Arnaud Bore"
 __copyright__ = "Copyright (C) 2016, TOAD"
@@ -63,11 +64,9 @@ class TensorMrtrix(GenericTask):
                 cmd += "-mask {} ".format(mask)
             self.launchCommand(cmd)
 
-        cmd = "mrmath {} {} mean {} -nthreads {} -quiet ".format(value2, value3, rdImage, self.getNTreadsMrtrix())
-        self.launchCommand(cmd)
-
-        cmd = "mrmath {} {} {} mean {} -nthreads {} -quiet ".format(adImage, value2, value3, mdImage, self.getNTreadsMrtrix())
-        self.launchCommand(cmd)
+        #both means are computed in a single pass over the eigenvalues
+        self.info(mriutil.voxelwise([(voxelmath.mean(value2, value3), rdImage),
+                                     (voxelmath.mean(adImage, value2, value3), mdImage)]))
 
 
     def isIgnore(self):
@@ -1,13 +1,7 @@
 # -*- coding: utf-8 -*-
-import numpy
-import nibabel
-import dipy.core.gradients
-import dipy.reconst.dti
-import dipy.segment.mask
-import dipy.reconst.dti
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
+from lib import mriutil
 
 
 __author__ = "Mathieu Desrosiers, Arnaud Bore"
@@ -31,6 +25,12 @@ class TensorDipy(GenericTask):
         self.__fit = self.__produceTensors(dwi, bValsFile, bVecsFile, mask, fitMethod)
 
     def __produceTensors(self, source, bValsFile, bVecsFile, mask, fitMethod):
+        import nibabel
+        import numpy
+        import dipy.core.gradients
+        import dipy.reconst.dti
+        import dipy.segment.mask
+
         self.info("Starting tensors creation from dipy on {}".format(source))
         dwiImage = nibabel.load(source)
         maskImage = nibabel.load(mask)
@@ -54,38 +54,38 @@ class TensorDipy(GenericTask):
         correctOrder = [0, 1, 3, 2, 4, 5]
         tensorsValuesReordered = tensorsValues[:, :, :, correctOrder]
         tensorsImage = nibabel.Nifti1Image(tensorsValuesReordered.astype(numpy.float32), dwiImage.get_affine())
-        nibabel.save(tensorsImage, self.buildName(source, "tensor"))
+        mriutil.saveImage(tensorsImage, self.buildName(source, "tensor"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.fa.astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.fa.astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "fa"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.ad.astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.ad.astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "ad"))
-        nibabel.save(nibabel.Nifti1Image(fit.rd.astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.rd.astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "rd"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.md.astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.md.astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "md"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[0].astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.evecs[0].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                              self.buildName(source, "v1"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[1].astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.evecs[1].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "v2"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[2].astype(numpy.float32),
+        mriutil.saveImage(nibabel.Nifti1Image(fit.evecs[2].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "v3"))
 
         faColor = numpy.clip(fit.fa, 0, 1)
         rgb = dipy.reconst.dti.color_fa(faColor, fit.evecs)
-        nibabel.save(nibabel.Nifti1Image(numpy.array(255 * rgb, 'uint8'),
+        mriutil.saveImage(nibabel.Nifti1Image(numpy.array(255 * rgb, 'uint8'),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "tensor_rgb"))
         return fit
@@ -1,13 +1,8 @@
 # -*- coding: utf-8 -*-
-import numpy
-import nibabel
-import dipy
-import dipy.direction
-import dipy.reconst.csdeconv
-
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib.mriutil import getlmax
+from lib import mriutil
 
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
@@ -39,6 +34,12 @@ class HardiDipy(GenericTask):
 
 
     def __produceMetrics(self, source, bValsFile, bVecsFile, mask):
+        import nibabel
+        import numpy
+        import dipy
+        import dipy.direction
+        import dipy.reconst.csdeconv
+
         self.info("Starting fODF creation from dipy on {}".format(source))
 
         dwiImage = nibabel.load(source)
@@ -85,7 +86,7 @@ class HardiDipy(GenericTask):
         csdCoeffImage = nibabel.Nifti1Image(
                 csdCoeff.astype(numpy.double), dwiImage.get_affine()
                 )
-        nibabel.save(csdCoeffImage, target)
+        mriutil.saveImage(csdCoeffImage, target)
 
 
         #GFA
@@ -95,7 +96,7 @@ class HardiDipy(GenericTask):
         csdCoeffImage = nibabel.Nifti1Image(
                 gfa.astype(numpy.float32), dwiImage.get_affine()
                 )
-        nibabel.save(csdCoeffImage, target)
+        mriutil.saveImage(csdCoeffImage, target)
 
 
         #NUFO
@@ -107,7 +108,7 @@ class HardiDipy(GenericTask):
                     nuDirs[x,y,z] = numpy.count_nonzero(csdPeaks.peak_dirs[x,y,z]!=0)/3
 
         numDirsImage = nibabel.Nifti1Image(nuDirs.astype(numpy.float32), dwiImage.get_affine())
-        nibabel.save(numDirsImage, target)
+        mriutil.saveImage(numDirsImage, target)
 
         #Data for qa
         self.__dwiData = dwiData
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import numpy
 import os
 from core.toad.generictask import GenericTask
 from lib import mriutil
@@ -289,6 +288,8 @@ class TractographyMrtrix(GenericTask):
             The resulting .cvs file name
 
         """
+        import numpy
+
         matrix = numpy.genfromtxt(source, delimiter=' ')
         matrix = numpy.add(matrix, numpy.matrix.transpose(matrix))
 
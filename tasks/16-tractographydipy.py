@@ -43,7 +43,7 @@ class TractographyDipy(GenericTask):
         #concatenate grey and kernel information from act
         includeData  = numpy.logical_or(actData[:,:,:,0], actData[:,:,:,1])
         includeImage = nibabel.Nifti1Image(includeData.astype(numpy.float32), actImage.get_affine())
-        nibabel.save(includeImage, self.buildName(act, "include"))
+        mriutil.saveImage(includeImage, self.buildName(act, "include"))
         excludeData = actData[:,:,:,3]
 
         step_det = self.config.getfloat('tractographydipy', 'step_det')
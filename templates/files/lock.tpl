@@ -1,5 +1,5 @@
 Subject $name is currently locked.
-Which mean a $lock file have been found.
+Which mean a $lock file have been found, held by $owner.
 
 Is a jobs currently running for $name?
 